@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import os
+import marshal
+import concurrent.futures
+
+from merge_fun import plan_merge, code_plan, merge_code, link_merged
+
+# below this number of groups the pool costs more than it saves.
+MIN_PARALLEL_GROUPS = 4
+
+# merge_func options which are decided by plan_merge / link_merged in the parent process.
+PLAN_OPTIONS = ("share_globals", "hoist_globals", "signature", "arg_maps")
+LINK_OPTIONS = ("error_hook", "profile_hooks")
+
+
+def _split_options(options):
+    plan_options = {k: v for k, v in options.items() if k in PLAN_OPTIONS}
+    link_options = {k: v for k, v in options.items() if k in LINK_OPTIONS}
+    code_options = {k: v for k, v in options.items() if k not in PLAN_OPTIONS and k not in LINK_OPTIONS}
+    return plan_options, code_options, link_options
+
+
+def _merge_worker(payload):
+    """子进程中执行，输入输出都是 marshal 后的 bytes"""
+    func_name, codes, plan, code_options = marshal.loads(payload)
+    code = merge_code(func_name, list(codes), plan, **dict(code_options))
+    return marshal.dumps(code)
+
+
+def _normalize_group(group, options):
+    if len(group) == 2:
+        func_name, funcs = group
+        group_options = options
+    else:
+        func_name, funcs, group_options = group
+        group_options = dict(options, **group_options)
+    return func_name, list(funcs), group_options
+
+
+def merge_many(groups, max_workers=None, executor=None, **options):
+    """并行合并多组函数，返回与 groups 顺序一致的合并函数列表。
+    groups 的元素为 (func_name, funcs) 或 (func_name, funcs, options)，options 为 merge_func 的参数。
+    字节码变换在子进程中进行，__globals__, __defaults__, __closure__ 在当前进程绑定"""
+    jobs = []
+    for group in groups:
+        func_name, funcs, group_options = _normalize_group(group, options)
+        plan_options, code_options, link_options = _split_options(group_options)
+        plan = plan_merge(funcs, **plan_options)
+        codes = [func.__code__ for func in funcs]
+        try:
+            payload = marshal.dumps((
+                func_name,
+                tuple(codes),
+                code_plan(plan),
+                tuple(code_options.items()),
+            ))
+        except ValueError:  # consts or defaults with unmarshallable objects, merge in this process.
+            payload = None
+        jobs.append((func_name, funcs, codes, plan, code_options, link_options, payload))
+
+    remote = [job for job in jobs if job[6] is not None]
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    results = {}
+    if remote and (executor is not None or (max_workers > 1 and len(remote) >= MIN_PARALLEL_GROUPS)):
+        own_executor = executor is None
+        if own_executor:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(max_workers, len(remote)))
+        try:
+            # map keeps the order of the inputs, whatever order the workers finish in.
+            chunksize = max(1, len(remote) // (max_workers * 4))
+            for job, data in zip(remote, executor.map(_merge_worker, [job[6] for job in remote], chunksize=chunksize)):
+                results[id(job)] = marshal.loads(data)
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+    merged = []
+    for job in jobs:
+        func_name, funcs, codes, plan, code_options, link_options, payload = job
+        code = results.get(id(job))
+        if code is None:
+            code = merge_code(func_name, codes, plan, **code_options)
+        merged.append(link_merged(code, funcs, plan, **link_options))
+    return merged
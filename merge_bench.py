@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""合并函数的性能测试。
+
+    python merge_bench.py -o bench.json
+    python merge_bench.py -o new.json --compare bench.json --options '{"optimize": true}'
+
+runtime: 合并后的函数与依次调用原函数的耗时，函数个数 N 为 RUNTIME_SIZES，函数体为 BODIES 中的几种。
+merge: merge_func 的耗时随函数大小（语句数）、EXTENDED_ARG 个数、函数个数的变化。
+每项取多次测量的中位数，并记录四分位距与中位数之比（spread）作为噪声。
+结果写为 JSON，--compare 与之前的结果比较，有项目变慢超过 --threshold 加上两次结果中较大的 spread 时返回 1。
+"""
+
+import gc
+import sys
+import dis
+import json
+import time
+import platform
+import argparse
+import contextlib
+
+from merge_fun import MERGER_VERSION, merge_func
+
+RUNTIME_SIZES = (1, 10, 100, 1000)
+QUICK_RUNTIME_SIZES = (1, 10, 100)
+MERGE_STATEMENTS = (10, 100, 300, 1000, 3000)
+QUICK_MERGE_STATEMENTS = (10, 100, 300)
+MERGE_SEGMENTS = (1, 10, 50)
+QUICK_MERGE_SEGMENTS = (1, 10)
+
+# callbacks called per measurement, the number of rounds is this divided by N.
+TARGET_CALLS = 20000
+QUICK_TARGET_CALLS = 2000
+REPEAT = 7
+MERGE_REPEAT = 5
+
+# callback bodies, {i} makes every function different, closures are made by a factory.
+BODIES = {
+    "trivial": '''
+def cb_{i}(self, dt):
+    return dt
+''',
+    "attrs": '''
+def cb_{i}(self, dt):
+    self.a = self.a + dt
+    self.b = self.b * 0.5 + self.a
+    if self.c:
+        self.d += {i}
+''',
+    "closure": '''
+def make_{i}(scale):
+    state = [0]
+    def cb_{i}(self, dt):
+        state[0] += dt * scale
+        return state[0]
+    return cb_{i}
+cb_{i} = make_{i}({i})
+''',
+    "try_finally": '''
+def cb_{i}(self, dt):
+    try:
+        self.a += dt
+    finally:
+        self.b += 1
+''',
+}
+
+
+class Entity(object):
+    __slots__ = ("a", "b", "c", "d")
+
+    def __init__(self):
+        self.a = 0
+        self.b = 0.0
+        self.c = True
+        self.d = 0
+
+
+def make_callbacks(body, n):
+    """n 个函数体相同、常量不同的函数"""
+    namespace = {}
+    source = "".join(BODIES[body].format(i=i) for i in range(n))
+    exec(compile(source, f"<bench {body}>", "exec"), namespace)
+    return [namespace[f"cb_{i}"] for i in range(n)]
+
+
+def make_large_callbacks(statements, n):
+    """每个函数 statements 条语句，属性名、常量都不同，超过 256 个时需要 EXTENDED_ARG"""
+    namespace = {}
+    lines = []
+    for i in range(n):
+        lines.append(f"def cb_{i}(self, dt):")
+        lines.extend(f"    self.a{i}_{k} = {i * statements + k}" for k in range(statements))
+    exec(compile("\n".join(lines), "<bench large>", "exec"), namespace)
+    return [namespace[f"cb_{i}"] for i in range(n)]
+
+
+@contextlib.contextmanager
+def gc_disabled():
+    """与 timeit 相同，测量时关闭 gc，避免回收的时机影响结果"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def median_spread(samples):
+    """(中位数, 四分位距 / 中位数)"""
+    samples = sorted(samples)
+    n = len(samples)
+    median = (samples[(n - 1) // 2] + samples[n // 2]) / 2
+    spread = (samples[(3 * n) // 4] - samples[n // 4]) / median if median else 0.0
+    return median, spread
+
+
+def median_ns(func, args, number, repeat=REPEAT):
+    """调用 number 次的耗时除以 number，返回 repeat 次的 (中位数, spread)"""
+    samples = []
+    with gc_disabled():
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            for _ in range(number):
+                func(*args)
+            samples.append((time.perf_counter_ns() - start) / number)
+    return median_spread(samples)
+
+
+def sequential(funcs):
+    def run(self, dt):
+        for f in funcs:
+            f(self, dt)
+    return run
+
+
+def bench_runtime(sizes, target_calls, options):
+    results = []
+    for body in BODIES:
+        for n in sizes:
+            funcs = make_callbacks(body, n)
+            merged = merge_func(f"bench_{body}", funcs, **options)
+            number = max(1, target_calls // n)
+            seq_ns, _ = median_ns(sequential(funcs), (Entity(), 1), number)
+            merged_ns, spread = median_ns(merged, (Entity(), 1), number)
+            results.append({
+                "body": body,
+                "n": n,
+                "sequential_ns": seq_ns,
+                "merged_ns": merged_ns,
+                "merged_spread": spread,
+                "speedup": seq_ns / merged_ns,
+            })
+    return results
+
+
+def bench_merge(statements, segments, options):
+    results = []
+    for size in statements:
+        for n in segments:
+            funcs = make_large_callbacks(size, n)
+            samples = []
+            with gc_disabled():
+                for _ in range(MERGE_REPEAT):
+                    start = time.perf_counter_ns()
+                    merged = merge_func("bench_large", funcs, **options)
+                    samples.append((time.perf_counter_ns() - start) / 1e6)
+            merge_ms, spread = median_spread(samples)
+            code = merged.__code__
+            results.append({
+                "statements": size,
+                "segments": n,
+                "merge_ms": merge_ms,
+                "merge_spread": spread,
+                "code_bytes": len(code.co_code),
+                "extended_args": sum(ins.opname == "EXTENDED_ARG" for ins in dis.get_instructions(code)),
+            })
+    return results
+
+
+def run_benchmarks(quick=False, parts=("runtime", "merge"), options=None):
+    options = options or {}
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "merger_version": MERGER_VERSION,
+            "options": options,
+            "quick": quick,
+        },
+    }
+    if "runtime" in parts:
+        report["runtime"] = bench_runtime(
+            QUICK_RUNTIME_SIZES if quick else RUNTIME_SIZES, QUICK_TARGET_CALLS if quick else TARGET_CALLS, options,
+        )
+    if "merge" in parts:
+        report["merge"] = bench_merge(
+            QUICK_MERGE_STATEMENTS if quick else MERGE_STATEMENTS, QUICK_MERGE_SEGMENTS if quick else MERGE_SEGMENTS,
+            options,
+        )
+    return report
+
+
+# key fields, the measured field and its noise field of each part, smaller is better.
+COMPARE_FIELDS = {
+    "runtime": (("body", "n"), "merged_ns", "merged_spread"),
+    "merge": (("statements", "segments"), "merge_ms", "merge_spread"),
+}
+
+
+def compare_reports(old, new, threshold=0.1):
+    """按 key 匹配两次结果，返回 [(part, key, old, new, ratio, regressed), ]，ratio 为 new / old。
+    变慢超过 threshold 加上两次结果中较大的 spread 时算作 regressed，只在一边有的项目跳过"""
+    rows = []
+    for part, (keys, field, noise_field) in COMPARE_FIELDS.items():
+        before = {tuple(item[k] for k in keys): item for item in old.get(part, ())}
+        for item in new.get(part, ()):
+            key = tuple(item[k] for k in keys)
+            if key not in before or not before[key][field]:
+                continue
+            ratio = item[field] / before[key][field]
+            noise = max(before[key].get(noise_field, 0.0), item.get(noise_field, 0.0))
+            rows.append((part, key, before[key][field], item[field], ratio, ratio > 1 + threshold + noise))
+    return rows
+
+
+def print_report(report):
+    for item in report.get("runtime", ()):
+        print("runtime %-12s n=%-5d sequential %10.1f ns  merged %10.1f ns  x%.2f" % (
+            item["body"], item["n"], item["sequential_ns"], item["merged_ns"], item["speedup"]))
+    for item in report.get("merge", ()):
+        print("merge   statements=%-5d segments=%-3d %9.2f ms  %7d bytes  %5d EXTENDED_ARG" % (
+            item["statements"], item["segments"], item["merge_ms"], item["code_bytes"], item["extended_args"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmarks of merged functions and of the merger")
+    parser.add_argument("-o", "--output", help="write the results as json")
+    parser.add_argument("--compare", help="json results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown ratio, default 0.1")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes and fewer calls")
+    parser.add_argument("--part", action="append", choices=("runtime", "merge"), help="run only this part")
+    parser.add_argument("--options", default="{}", help="merge_func options as json, e.g. '{\"optimize\": true}'")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.quick, tuple(args.part or ("runtime", "merge")), json.loads(args.options))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if not args.compare:
+        return 0
+
+    with open(args.compare) as f:
+        old = json.load(f)
+    regressed = 0
+    for part, key, before, after, ratio, slower in compare_reports(old, report, args.threshold):
+        print("%-7s %-20s %12.2f -> %12.2f  %6.1f%%%s" % (
+            part, "/".join(map(str, key)), before, after, (ratio - 1) * 100, "  REGRESSED" if slower else ""))
+        regressed += slower
+    print("%d regressions" % regressed)
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""合并函数的预编译工具。
+
+    python merge_compile.py spec.json -o merged_callbacks.pyc
+
+spec.json:
+
+    {"groups": [{"name": "on_tick", "funcs": ["game.player:Player.tick", "game.npc:tick"], "options": {}}]}
+
+options 为 merge_func 的参数，signature 使用参数列表字符串，如 {"signature": "self, dt, ctx=None"}。
+
+生成的 .pyc 模块导入时只导入源模块、绑定 __globals__, __defaults__, __closure__，不做字节码变换。
+同时生成 <output>.manifest.json 记录源文件的 hash，源文件、spec、解释器或合并器版本变化时重新生成。
+"""
+
+import os
+import sys
+import json
+import zlib
+import marshal
+import hashlib
+import types
+import argparse
+import importlib
+import importlib.util
+
+from merge_fun import MERGER_VERSION, ISOLATE_NAMES, PROFILE_COUNTER_NAMES, plan_merge, merge_code
+from merge_diskcache import CODE_KEY_FIELDS
+
+# merge_func options which are decided by plan_merge.
+PLAN_OPTIONS = ("share_globals", "hoist_globals", "signature", "arg_maps")
+
+# fingerprint of a source function, run by the generator and pasted into the generated module.
+# it covers the fields of the disk cache key, nested code objects and frozensets are normalized
+# so the value does not depend on the hash seed.
+FINGERPRINT_SOURCE = '''\
+def _fingerprint(code, fields=%r):
+    def norm(value):
+        if type(value) is tuple:
+            return tuple(norm(v) for v in value)
+        if type(value) is frozenset:
+            return ("frozenset",) + tuple(sorted(repr(norm(v)) for v in value))
+        if type(value) is _types.CodeType:
+            return ("code", _fingerprint(value, fields))
+        return value
+    return _zlib.crc32(_marshal.dumps(tuple(norm(getattr(code, f)) for f in fields), 2))
+''' % (CODE_KEY_FIELDS,)
+
+_namespace = {"_zlib": zlib, "_marshal": marshal, "_types": types}
+exec(FINGERPRINT_SOURCE, _namespace)
+code_fingerprint = _namespace["_fingerprint"]
+del _namespace
+
+# runtime of the generated module, only depends on the standard library.
+MODULE_TEMPLATE = '''\
+# generated by merge_compile, do not edit.
+import sys as _sys
+import zlib as _zlib
+import time as _time
+import traceback as _traceback
+import types as _types
+import marshal as _marshal
+import importlib as _importlib
+
+
+def _resolve(ref):
+    module, qualname = ref.split(":")
+    obj = _importlib.import_module(module)
+    for part in qualname.split("."):
+        obj = getattr(obj, part)
+    return getattr(obj, "__func__", obj)
+
+
+def _error_hook(exc, func):
+    print("Exception in merged function %%s.%%s:" %% (func.__module__, func.__qualname__), file=_sys.stderr)
+    _traceback.print_exception(exc)
+
+
+%s
+
+def _link(name, code, refs, crcs, shared, renames, signature_defaults, free_maps):
+    funcs = [_resolve(ref) for ref in refs]
+    for ref, func, crc in zip(refs, funcs, crcs):
+        if _fingerprint(func.__code__) != crc:
+            raise ImportError("merged function %%s is stale, %%s changed, rebuild it with merge_compile" %% (name, ref))
+    if shared:
+        func_globals = funcs[0].__globals__
+    else:
+        func_globals = {}
+        for func, rename in zip(funcs, renames):
+            rename = dict(rename)
+            for k, v in func.__globals__.items():
+                if k in rename:
+                    func_globals[rename[k]] = v
+                elif k not in func_globals:
+                    func_globals[k] = v
+    defaults = []
+    for func in funcs:
+        if func.__defaults__:
+            defaults.extend(func.__defaults__)
+    # closure cells shared by several functions are merged into one free variable.
+    closure = [None] * (max((max(m) for m in free_maps if m), default=-1) + 1)
+    for ref, func, free_map in zip(refs, funcs, free_maps):
+        for k, cell in zip(free_map, func.__closure__ or ()):
+            if closure[k] is None:
+                closure[k] = cell
+            elif closure[k] is not cell:
+                raise ImportError("merged function %%s is stale, closure of %%s changed" %% (name, ref))
+    if signature_defaults is not None:
+        defaults = signature_defaults[0] or ()
+    # free variables added by the merge: enable flags, isolate mode cells, profile counters.
+    extra = dict(zip(%r, (Exception, _error_hook, tuple(funcs))))
+    calls, time_ns, clock = %r
+    extra[clock] = _time.perf_counter_ns
+    for fv in code.co_freevars[len(closure):]:
+        if fv == calls or fv == time_ns:
+            closure.append(_types.CellType([0] * len(funcs)))
+        else:
+            closure.append(_types.CellType(extra.get(fv, True)))
+    func = _types.FunctionType(code, func_globals, name, tuple(defaults), tuple(closure))
+    if signature_defaults is not None and signature_defaults[1]:
+        func.__kwdefaults__ = dict(signature_defaults[1])
+    return func
+
+
+for _group in _marshal.loads(%r):
+    globals()[_group[0]] = _link(*_group)
+del _group
+'''
+
+
+def resolve_ref(ref):
+    """解析 "module:qualname" 为函数对象"""
+    module, sep, qualname = ref.partition(":")
+    if not sep:
+        raise ValueError("function reference must be module:qualname, got %r" % ref)
+    obj = importlib.import_module(module)
+    for part in qualname.split("."):
+        obj = getattr(obj, part)
+    return getattr(obj, "__func__", obj)  # classmethod
+
+
+def load_spec(path):
+    with open(path, "rb") as f:
+        spec = json.loads(f.read())
+    for group in spec["groups"]:
+        if not group["name"].isidentifier():
+            raise ValueError("group name must be an identifier, got %r" % group["name"])
+    return spec
+
+
+def _file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def build_manifest(spec_path, spec):
+    """记录判断产物是否过期需要的信息"""
+    sources = {}
+    for group in spec["groups"]:
+        for ref in group["funcs"]:
+            module = sys.modules[ref.partition(":")[0]]
+            path = os.path.abspath(module.__file__)
+            sources[path] = _file_hash(path)
+    return {
+        "magic": importlib.util.MAGIC_NUMBER.hex(),
+        "merger_version": MERGER_VERSION,
+        "spec": _file_hash(spec_path),
+        "sources": sources,
+    }
+
+
+def is_stale(spec_path, output):
+    """产物不存在，或 manifest 中的任一项与当前不一致时返回 True"""
+    try:
+        with open(output + ".manifest.json", "rb") as f:
+            manifest = json.loads(f.read())
+    except (OSError, ValueError):
+        return True
+    if not os.path.exists(output):
+        return True
+    if manifest.get("magic") != importlib.util.MAGIC_NUMBER.hex() or manifest.get("merger_version") != MERGER_VERSION:
+        return True
+    try:
+        if manifest.get("spec") != _file_hash(spec_path):
+            return True
+        for path, digest in manifest.get("sources", {}).items():
+            if _file_hash(path) != digest:
+                return True
+    except OSError:
+        return True
+    return False
+
+
+def compile_group(group):
+    """合并一组函数，返回生成模块中的一项 (name, code, refs, crcs, shared, renames, signature_defaults, free_maps)"""
+    funcs = [resolve_ref(ref) for ref in group["funcs"]]
+    options = dict(group.get("options", {}))
+    plan_options = {k: options.pop(k) for k in PLAN_OPTIONS if k in options}
+    if options.get("profile") == "hooks":
+        raise ValueError("group %s: profile hooks can not be precompiled, use counters" % group["name"])
+    plan = plan_merge(funcs, **plan_options)
+    code = merge_code(
+        group["name"], [func.__code__ for func in funcs], plan, def_argcount=group.get("def_argcount"),
+        merged_firstlineno=group.get("merged_firstlineno", 0), **options,
+    )
+    return (
+        group["name"],
+        code,
+        tuple(group["funcs"]),
+        tuple(code_fingerprint(func.__code__) for func in funcs),
+        plan["globals_shared"],
+        tuple(tuple(r.items()) for r in plan["renames"]),
+        (plan["defaults"], plan["kwdefaults"]) if "signature" in plan else None,
+        tuple(map(tuple, plan["free_maps"])),
+    )
+
+
+def _write_atomic(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def compile_spec(spec_path, output):
+    """合并 spec 中的所有函数组，写入 output (.pyc) 和 output.manifest.json"""
+    spec = load_spec(spec_path)
+    groups = tuple(compile_group(group) for group in spec["groups"])
+    source = MODULE_TEMPLATE % (FINGERPRINT_SOURCE, ISOLATE_NAMES, PROFILE_COUNTER_NAMES, marshal.dumps(groups))
+    module_name = os.path.splitext(os.path.basename(output))[0]
+    code = compile(source, "<merged %s>" % module_name, "exec")
+    # sourceless .pyc: magic, flags, mtime and size are not checked without a source file.
+    data = importlib.util.MAGIC_NUMBER + bytes(12) + marshal.dumps(code)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    _write_atomic(output, data)
+    _write_atomic(output + ".manifest.json", json.dumps(build_manifest(spec_path, spec), indent=2).encode())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ahead-of-time merge of function groups into a .pyc module")
+    parser.add_argument("spec", help="json spec file of function groups")
+    parser.add_argument("-o", "--output", required=True, help="output .pyc path")
+    parser.add_argument("-p", "--path", action="append", default=[], help="add to sys.path to import the sources")
+    parser.add_argument("--force", action="store_true", help="rebuild even if the output is up to date")
+    parser.add_argument("--check", action="store_true", help="only check, exit with 1 if the output is stale")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        stale = is_stale(args.spec, args.output)
+        print("%s is %s" % (args.output, "stale" if stale else "up to date"))
+        return 1 if stale else 0
+    if not args.force and not is_stale(args.spec, args.output):
+        print("%s is up to date" % args.output)
+        return 0
+    sys.path[:0] = [os.path.abspath(p) for p in args.path]
+    compile_spec(args.spec, args.output)
+    print("wrote %s" % args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
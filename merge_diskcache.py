@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import marshal
+import hashlib
+import tempfile
+import importlib.util
+
+from merge_fun import MERGER_VERSION, MergeVerifyError, plan_merge, merge_code, link_merged, verify_code
+
+CACHE_SUFFIX = ".mcode"
+CACHE_HEADER = importlib.util.MAGIC_NUMBER + MERGER_VERSION.to_bytes(4, "little")
+
+# fields of the input code objects which decide the merged code.
+CODE_KEY_FIELDS = (
+    "co_code",
+    "co_consts",
+    "co_names",
+    "co_varnames",
+    "co_cellvars",
+    "co_freevars",
+    "co_exceptiontable",
+    "co_linetable",
+    "co_argcount",
+    "co_posonlyargcount",
+    "co_kwonlyargcount",
+    "co_nlocals",
+    "co_flags",
+    "co_firstlineno",
+    # the merged co_filename and the segment table come from these.
+    "co_filename",
+    "co_name",
+    "co_qualname",
+)
+
+
+def merge_cache_key(func_name, codes, plan, def_argcount=None, merged_firstlineno=0, options=None):
+    """磁盘缓存的 key，输入的 code 对象、合并参数、解释器版本、合并器版本任一变化都会改变 key"""
+    h = hashlib.sha256(CACHE_HEADER)
+    # marshal version 2 writes no object references, the bytes only depend on the values.
+    # frozenset constants are written in iteration order, which may differ between processes
+    # with different hash seeds, this only costs a cache miss.
+    h.update(marshal.dumps((
+        func_name,
+        def_argcount,
+        merged_firstlineno,
+        tuple(sorted((options or {}).items())),
+        tuple(tuple(sorted(r.items())) for r in plan["renames"]),
+        tuple(plan["hoisted"]),
+        tuple(plan["freevars"]),
+        tuple(map(tuple, plan["free_maps"])),
+        plan.get("signature"),
+        plan.get("arg_maps"),
+        plan.get("arg_inits"),
+    ), 2))
+    for code in codes:
+        h.update(marshal.dumps(tuple(getattr(code, f) for f in CODE_KEY_FIELDS), 2))
+    return h.hexdigest()
+
+
+def load_cached_code(cache_dir, key):
+    """读取缓存的 code 对象，不存在或损坏时返回 None"""
+    path = os.path.join(cache_dir, key + CACHE_SUFFIX)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    code = None
+    if data[:len(CACHE_HEADER)] == CACHE_HEADER:
+        try:
+            code = marshal.loads(data[len(CACHE_HEADER):])
+        except (EOFError, ValueError, TypeError):
+            code = None
+    if code is None:
+        # corrupted or written by another version.
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    try:
+        os.utime(path)  # mtime is the last use, for prune_merge_cache
+    except OSError:
+        pass
+    return code
+
+
+def store_cached_code(cache_dir, key, code):
+    """原子写入缓存：先写同目录下的临时文件，再 os.replace。code 无法 marshal 时不写入，返回是否写入"""
+    try:
+        data = CACHE_HEADER + marshal.dumps(code)
+    except ValueError:  # consts with unmarshallable objects
+        return False
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=key, suffix=".tmp", dir=cache_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(cache_dir, key + CACHE_SUFFIX))
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return True
+
+
+def merge_func_disk_cached(cache_dir, func_name, funcs, def_argcount=None, debug=1, merged_firstlineno=0,
+                           pooled=False, share_globals=True, optimize=False, hoist_globals=False, guards=False,
+                           returns="last", isolate=False, error_hook=None, signature=None, arg_maps=None,
+                           profile=None, profile_hooks=None, verify=True):
+    """带磁盘缓存的 merge_func。命中时直接用缓存的 code 重新绑定 __globals__, __defaults__, __closure__，
+    不再做字节码变换"""
+    plan = plan_merge(
+        funcs, share_globals=share_globals, hoist_globals=hoist_globals, signature=signature, arg_maps=arg_maps,
+    )
+    codes = [func.__code__ for func in funcs]
+    options = {
+        "pooled": pooled, "optimize": optimize, "guards": guards, "returns": returns, "isolate": isolate,
+        "profile": profile,
+    }
+    try:
+        key = merge_cache_key(func_name, codes, plan, def_argcount, merged_firstlineno, options)
+    except ValueError:  # consts or defaults with unmarshallable objects, nothing to cache.
+        key = None
+    code = load_cached_code(cache_dir, key) if key is not None else None
+    if code is not None and verify:
+        try:
+            verify_code(code)
+        except MergeVerifyError:
+            code = None  # a damaged entry is replaced by a new merge
+    if code is None:
+        code = merge_code(
+            func_name, codes, plan, def_argcount=def_argcount, debug=debug,
+            merged_firstlineno=merged_firstlineno, verify=verify, **options,
+        )
+        try:
+            if key is not None:
+                store_cached_code(cache_dir, key, code)
+        except OSError:
+            pass  # the cache is an optimization only
+    return link_merged(code, funcs, plan, error_hook=error_hook, profile_hooks=profile_hooks)
+
+
+def prune_merge_cache(cache_dir, max_entries=None, max_age=None):
+    """删除超过 max_age 秒未使用的缓存，以及超过 max_entries 个时最久未使用的缓存。返回删除的个数"""
+    now = time.time()
+    entries = []
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return 0
+    for name in names:
+        path = os.path.join(cache_dir, name)
+        if name.endswith(".tmp"):
+            # left by a crashed writer, a live writer replaces it within milliseconds.
+            try:
+                if now - os.stat(path).st_mtime > 3600:
+                    os.remove(path)
+            except OSError:
+                pass
+            continue
+        if not name.endswith(CACHE_SUFFIX):
+            continue
+        try:
+            entries.append((os.stat(path).st_mtime, path))
+        except OSError:
+            pass
+
+    entries.sort(reverse=True)
+    removed = 0
+    for i, (mtime, path) in enumerate(entries):
+        if (max_entries is not None and i >= max_entries) or (max_age is not None and now - mtime > max_age):
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
@@ -2,14 +2,57 @@
 
 import sys
 import dis
+import time
+import inspect
+import traceback
 import types
 import opcode
-import queue
+import bisect
+import functools
+import collections
 
 assert sys.version_info.major == 3 and sys.version_info.minor == 11, "For python 3.11 only."
 
 cache_entries = opcode._inline_cache_entries
 
+# bump when the generated code changes for the same input, invalidates the disk cache.
+MERGER_VERSION = 4
+
+# free variable names of the enable flags in guards mode, followed by the index of the function.
+GUARD_PREFIX = ".enabled_"
+
+# free variable names of isolate mode: exception types caught, error hook, tuple of the merged functions.
+ISOLATE_NAMES = (".catch", ".error_hook", ".segment_funcs")
+
+# how the merged function returns the results of the functions, see aggregate_returns.
+RETURN_MODES = ("last", "list", "tuple", "any", "all")
+# fast local of the result list in list/tuple mode, hoisted globals are "." + identifier.
+RESULTS_NAME = "..results"
+
+# CO_VARARGS | CO_VARKEYWORDS, taken from the signature instead of the first function.
+VARARG_FLAGS = inspect.CO_VARARGS | inspect.CO_VARKEYWORDS
+# name of the function defined by a signature string.
+SIGNATURE_TEMPLATE_NAME = "_merged_signature"
+# keys of plan used by merge_code.
+CODE_PLAN_KEYS = ("renames", "hoisted", "freevars", "free_maps", "signature", "arg_maps", "arg_inits")
+
+# profile modes of merge_code: None, inline counters, user enter/exit hooks.
+PROFILE_MODES = (None, "counters", "hooks")
+# free variable names of the profile modes.
+PROFILE_COUNTER_NAMES = (".profile_calls", ".profile_time_ns", ".perf_counter_ns")
+PROFILE_HOOK_NAMES = (".profile_enter", ".profile_exit")
+# fast local of the perf_counter_ns() sample taken when a function starts, counters mode.
+PROFILE_START_NAME = "..profile_start"
+# BINARY_OP arguments.
+NB_SUBTRACT = 10
+NB_INPLACE_ADD = 13
+
+# first item of the segment table constant at the end of co_consts, see segment_table.
+SEGMENT_TABLE_TAG = "..segment_table"
+
+# max number of merged functions kept by merge_func_cached.
+MERGE_CACHE_MAXSIZE = 256
+
 backward_jrel = (
     opcode.opmap["JUMP_BACKWARD_NO_INTERRUPT"],
     opcode.opmap["JUMP_BACKWARD"],
@@ -19,6 +62,43 @@ backward_jrel = (
     opcode.opmap["POP_JUMP_BACKWARD_IF_TRUE"],
 )
 
+UNCONDITIONAL_JUMPS = (
+    opcode.opmap["JUMP_FORWARD"],
+    opcode.opmap["JUMP_BACKWARD"],
+    opcode.opmap["JUMP_BACKWARD_NO_INTERRUPT"],
+)
+
+NO_FALLTHROUGH = (
+    opcode.opmap["RETURN_VALUE"],
+    opcode.opmap["RERAISE"],
+    opcode.opmap["RAISE_VARARGS"],
+)
+
+# forward <-> backward variants of relative jumps.
+JUMP_FLIP = {}
+for _fwd, _bwd in (
+    ("JUMP_FORWARD", "JUMP_BACKWARD"),
+    ("POP_JUMP_FORWARD_IF_FALSE", "POP_JUMP_BACKWARD_IF_FALSE"),
+    ("POP_JUMP_FORWARD_IF_TRUE", "POP_JUMP_BACKWARD_IF_TRUE"),
+    ("POP_JUMP_FORWARD_IF_NONE", "POP_JUMP_BACKWARD_IF_NONE"),
+    ("POP_JUMP_FORWARD_IF_NOT_NONE", "POP_JUMP_BACKWARD_IF_NOT_NONE"),
+):
+    JUMP_FLIP[opcode.opmap[_fwd]] = opcode.opmap[_bwd]
+    JUMP_FLIP[opcode.opmap[_bwd]] = opcode.opmap[_fwd]
+
+# conditional jumps and their inverted condition.
+INVERT_JUMP = {}
+for _a, _b in (("FALSE", "TRUE"), ("NONE", "NOT_NONE")):
+    for _direction in ("FORWARD", "BACKWARD"):
+        INVERT_JUMP[opcode.opmap[f"POP_JUMP_{_direction}_IF_{_a}"]] = opcode.opmap[f"POP_JUMP_{_direction}_IF_{_b}"]
+        INVERT_JUMP[opcode.opmap[f"POP_JUMP_{_direction}_IF_{_b}"]] = opcode.opmap[f"POP_JUMP_{_direction}_IF_{_a}"]
+
+# unconditional jumps which can be threaded and folded, JUMP_BACKWARD_NO_INTERRUPT is kept as is.
+THREADABLE_JUMPS = (
+    opcode.opmap["JUMP_FORWARD"],
+    opcode.opmap["JUMP_BACKWARD"],
+)
+
 FAST_2_DEREF = {
     opcode.opmap['LOAD_FAST']: opcode.opmap['LOAD_DEREF'],
     opcode.opmap['STORE_FAST']: opcode.opmap['STORE_DEREF'],
@@ -66,7 +146,7 @@ def write_exception_table(enties):
     for entry in enties:
         arr = []
         _write_varint(arr, entry[0] // 2)  # start
-        arr[0] |= 0b1000000
+        arr[0] |= 0b10000000  # start of an entry
         _write_varint(arr, (entry[1] - entry[0]) // 2)  # length
         _write_varint(arr, entry[2] // 2)  # target
         _write_varint(arr, entry[3])  # depth,lasti
@@ -74,25 +154,817 @@ def write_exception_table(enties):
     return res
 
 
-def next_entry_index(linetable, start):
-    ret = -1
-    for i in range(start + 1, len(linetable)):
-        if linetable[i] & 0b10000000:
-            ret = i
-            break
-    return ret
+def _iter_instructions(co_code):
+    """遍历字节码，返回 (start, offset, op, arg, next_offset)。
+    start 包含前置的 EXTENDED_ARG，offset 指向指令本身，next_offset 跳过 CACHE"""
+    arg = 0
+    i = start = 0
+    n = len(co_code)
+    while i < n:
+        op = co_code[i]
+        arg = arg << 8 | co_code[i + 1]
+        if op == opcode.EXTENDED_ARG:
+            i += 2
+            continue
+        nxt = i + 2 + cache_entries[op] * 2
+        yield start, i, op, arg if op >= opcode.HAVE_ARGUMENT else None, nxt
+        arg = 0
+        i = start = nxt
+
+
+def jump_target(offset, op, arg):
+    """相对跳转指令的目标字节偏移"""
+    if op in backward_jrel:
+        return offset + 2 - arg * 2
+    return offset + 2 + arg * 2
+
+
+def compute_stacksize(co_code, exc_entries):
+    """抽象解释字节码，计算精确的最大栈深度。exc_entries 为 parse_exception_table 格式"""
+    instrs = {}
+    order = []
+    for start, offset, op, arg, nxt in _iter_instructions(co_code):
+        instrs[start] = (offset, op, arg, nxt)
+        order.append(start)
+
+    # exception handler reached from an offset: (target, depth at handler)
+    handler_of = {}
+    for start, end, target, dl in exc_entries:
+        depth = (dl >> 1) + (dl & 1) + 1  # saved depth, lasti, exception
+        i = bisect.bisect_left(order, start)
+        while i < len(order) and order[i] < end:
+            handler_of[order[i]] = (target, depth)
+            i += 1
+
+    depths = {}
+    maxdepth = 0
+    stack = [(order[0], 0)] if order else []
+    while stack:
+        offset, depth = stack.pop()
+        while True:
+            # Paths join with the same depth: a replaced RETURN_VALUE pops its value before
+            # the jump. Each offset is walked once, an unequal join is an error of the merge.
+            if offset in depths:
+                if depths[offset] != depth:
+                    raise MergeVerifyError(f"stack depth {depth} != {depths[offset]} at offset {offset}")
+                break
+            depths[offset] = depth
+            if offset in handler_of:
+                target, hdepth = handler_of[offset]
+                maxdepth = max(maxdepth, hdepth)
+                stack.append((target, hdepth))
+            opoffset, op, arg, nxt = instrs[offset]
+            if op in opcode.hasjrel:
+                jdepth = depth + dis.stack_effect(op, arg, jump=True)
+                maxdepth = max(maxdepth, jdepth)
+                assert jdepth >= 0, f"stack underflow at {offset}"
+                stack.append((jump_target(opoffset, op, arg), jdepth))
+                if op in UNCONDITIONAL_JUMPS:
+                    break
+                depth += dis.stack_effect(op, arg, jump=False)
+            elif op in NO_FALLTHROUGH:
+                break
+            elif op == opcode.opmap["RETURN_GENERATOR"]:
+                depth += 1  # the value sent into the new generator, popped by the next POP_TOP
+            else:
+                depth += dis.stack_effect(op, arg)
+            assert depth >= 0, f"stack underflow at {offset}"
+            maxdepth = max(maxdepth, depth)
+            if nxt >= len(co_code):
+                break
+            offset = nxt
+    return maxdepth
+
+
+class MergeVerifyError(Exception):
+    """合并后的 code 没有通过 verify_code 的检查"""
+
+
+def check_code(code):
+    """检查 code 对象，返回问题的列表：指令、跳转目标、常量/名字/slot 下标、异常表、
+    每条路径上的栈深度、行号表。只依赖 code 对象，合并后的和编译器生成的 code 都适用"""
+    problems = []
+    co_code = code.co_code
+    n = len(co_code)
+    if n % 2:
+        return [f"co_code has odd length {n}"]
+
+    # decode, boundaries are the starts of instructions including their EXTENDED_ARG prefix.
+    instrs = {}  # start -> (offset, op, arg, next_offset)
+    order = []
+    i = start = 0
+    arg = 0
+    while i < n:
+        op, oparg = co_code[i], co_code[i + 1]
+        arg = arg << 8 | oparg
+        if op == opcode.EXTENDED_ARG:
+            i += 2
+            continue
+        if opcode.opname[op].startswith("<") or op == opcode.opmap["CACHE"]:
+            problems.append(f"invalid opcode {op} at {i}")
+            return problems
+        nxt = i + 2 + cache_entries[op] * 2
+        if nxt > n:
+            problems.append(f"inline cache of {opcode.opname[op]} at {i} runs past the end")
+            return problems
+        instrs[start] = (i, op, arg if op >= opcode.HAVE_ARGUMENT else None, nxt)
+        order.append(start)
+        arg = 0
+        i = start = nxt
+    if start != n:
+        problems.append(f"EXTENDED_ARG at {start} has no instruction")
+    if not order:
+        return problems + ["empty co_code"]
+
+    nvarnames = len(code.co_varnames)
+    localsplus = list(code.co_varnames) + [cv for cv in code.co_cellvars if cv not in code.co_varnames]
+    localsplus += code.co_freevars
+    derefs = set(code.co_cellvars) | set(code.co_freevars)
+    for start in order:
+        offset, op, arg, nxt = instrs[start]
+        name = opcode.opname[op]
+        if op in opcode.hasconst and arg >= len(code.co_consts):
+            problems.append(f"{name} at {offset}: const index {arg} out of range")
+        elif op in opcode.hasname:
+            index = arg >> 1 if op == opcode.opmap["LOAD_GLOBAL"] else arg
+            if index >= len(code.co_names):
+                problems.append(f"{name} at {offset}: name index {index} out of range")
+        elif op in opcode.haslocal and arg >= nvarnames:
+            problems.append(f"{name} at {offset}: local slot {arg} out of range")
+        elif op in opcode.hasfree:
+            if arg >= len(localsplus):
+                problems.append(f"{name} at {offset}: slot {arg} out of range")
+            elif localsplus[arg] not in derefs or (op == opcode.opmap["MAKE_CELL"] and arg >= len(localsplus) - len(code.co_freevars)):
+                problems.append(f"{name} at {offset}: slot {arg} ({localsplus[arg]}) is not a cell")
+        elif op == opcode.opmap["COPY_FREE_VARS"] and (arg != len(code.co_freevars) or start != 0):
+            problems.append(f"COPY_FREE_VARS {arg} at {offset}, {len(code.co_freevars)} free variables")
+        elif op in opcode.hasjrel:
+            target = jump_target(offset, op, arg)
+            if target not in instrs:
+                problems.append(f"{name} at {offset}: target {target} is not an instruction")
+
+    exc_entries = parse_exception_table(code)
+    handler_of = {}
+    for start, end, target, dl in exc_entries:
+        if not (0 <= start < end <= n) or start not in instrs or (end != n and end not in instrs):
+            problems.append(f"exception table entry {start}-{end} is not on instruction boundaries")
+            continue
+        if target not in instrs:
+            problems.append(f"exception handler {target} is not an instruction")
+            continue
+        i = bisect.bisect_left(order, start)
+        while i < len(order) and order[i] < end:
+            handler_of[order[i]] = (target, dl >> 1, dl & 1)
+            i += 1
+    if problems:
+        return problems
+
+    # every path must reach each instruction with the same stack depth.
+    depths = {}
+    todo = [(order[0], 0, None)]
+    while todo:
+        start, depth, source = todo.pop()
+        if start not in instrs:
+            problems.append(f"execution falls off the end of co_code after {source}")
+            continue
+        if start in depths:
+            if depths[start] != depth:
+                problems.append(f"stack depth {depth} from {source} != {depths[start]} at {start}")
+            continue
+        depths[start] = depth
+        offset, op, arg, nxt = instrs[start]
+        if start in handler_of:
+            target, saved, lasti = handler_of[start]
+            if saved > depth:
+                problems.append(f"exception table depth {saved} > stack depth {depth} at {start}")
+            todo.append((target, saved + lasti + 1, start))
+        if op in opcode.hasjrel:
+            jdepth = depth + dis.stack_effect(op, arg, jump=True)
+            todo.append((jump_target(offset, op, arg), jdepth, start))
+            if op in UNCONDITIONAL_JUMPS:
+                continue
+            depth += dis.stack_effect(op, arg, jump=False)
+        elif op in NO_FALLTHROUGH:
+            depth += dis.stack_effect(op, arg)
+            if depth < 0:
+                problems.append(f"stack underflow at {start}")
+            continue
+        elif op == opcode.opmap["RETURN_GENERATOR"]:
+            depth += 1  # the value sent into the new generator
+        else:
+            depth += dis.stack_effect(op, arg)
+        if depth < 0:
+            problems.append(f"stack underflow at {start}")
+            continue
+        if depth > code.co_stacksize:
+            problems.append(f"stack depth {depth} at {start} exceeds co_stacksize {code.co_stacksize}")
+        todo.append((nxt, depth, start))
+
+    npositions = sum(1 for _ in code.co_positions())
+    if npositions != n // 2:
+        problems.append(f"co_linetable covers {npositions} code units, co_code has {n // 2}")
+    return problems
+
+
+def verify_code(code):
+    """check_code 发现问题时抛出 MergeVerifyError，在安装合并后的函数之前调用"""
+    problems = check_code(code)
+    if problems:
+        more = f" (and {len(problems) - 10} more)" if len(problems) > 10 else ""
+        raise MergeVerifyError(f"{code.co_name}: " + "; ".join(problems[:10]) + more)
+
+
+class Label(object):
+    """跳转目标、异常处理入口的符号标签，layout 时才确定偏移"""
+    __slots__ = ("offset",)
+
+    def __init__(self):
+        self.offset = -1
+
+    def __repr__(self):
+        return f"<Label {id(self):#x} @{self.offset}>"
+
+
+class Instr(object):
+    """一条指令。arg 不含 EXTENDED_ARG；跳转指令的目标为 target(Label)；
+    exc 为 (handler Label, depth, lasti) 或 None；pos 为 co_positions() 中的位置"""
+    __slots__ = ("op", "arg", "target", "exc", "pos")
+
+    def __init__(self, op, arg=0, target=None, exc=None, pos=None):
+        self.op = op
+        self.arg = arg
+        self.target = target
+        self.exc = exc
+        self.pos = pos
+
+    def __repr__(self):
+        arg = self.target if self.target is not None else self.arg
+        return f"<Instr {opcode.opname[self.op]} {arg}>"
+
+
+NO_LOCATION = (None, None, None, None)
+
+
+def decode_instructions(code):
+    """把 code 解码为 Instr 和 Label 的列表，跳转目标和异常表都转为 Label"""
+    positions = list(code.co_positions())
+    instrs = []
+    starts = []
+    labels = {}  # byte offset -> Label
+    for start, offset, op, arg, nxt in _iter_instructions(code.co_code):
+        ins = Instr(op, arg or 0, pos=positions[start // 2])
+        if op in opcode.hasjrel:
+            target = jump_target(offset, op, arg)
+            ins.target = labels.get(target) or labels.setdefault(target, Label())
+        instrs.append(ins)
+        starts.append(start)
+
+    for start, end, target, dl in parse_exception_table(code):
+        handler = labels.get(target) or labels.setdefault(target, Label())
+        exc = (handler, dl >> 1, dl & 1)
+        i = bisect.bisect_left(starts, start)
+        while i < len(starts) and starts[i] < end:
+            instrs[i].exc = exc
+            i += 1
 
+    res = []
+    for start, ins in zip(starts, instrs):
+        label = labels.pop(start, None)
+        if label is not None:
+            res.append(label)
+        res.append(ins)
+    assert not labels, f"jump target not on instruction boundary: {list(labels)}"
+    return res
 
-def merge_func(func_name, funcs, def_argcount=None, debug=1, merged_firstlineno=0):
-    func_info = dict()
-    context = {
+
+def _ext_count(arg):
+    """arg 需要的 EXTENDED_ARG 个数"""
+    if arg < 0x100:
+        return 0
+    if arg < 0x10000:
+        return 1
+    if arg < 0x1000000:
+        return 2
+    return 3
+
+
+def _jump_arg(ins, start, size):
+    """跳转指令在 start 处，大小为 size 时的参数，必要时翻转跳转方向"""
+    opoffset = start + (size - 1 - cache_entries[ins.op]) * 2
+    target = ins.target.offset
+    if target > opoffset:
+        if ins.op in backward_jrel:
+            ins.op = JUMP_FLIP[ins.op]
+        return (target - opoffset - 2) // 2
+    if ins.op not in backward_jrel:
+        ins.op = JUMP_FLIP[ins.op]
+    return (opoffset + 2 - target) // 2
+
+
+def _write_location_varint(out, val):
+    while val >= 64:
+        out.append(64 | (val & 63))
+        val >>= 6
+    out.append(val)
+
+
+def _write_location_svarint(out, val):
+    _write_location_varint(out, ((-val) << 1) | 1 if val < 0 else val << 1)
+
+
+def _write_location_entry(out, length, pos, line):
+    """写入一个 location entry，返回新的当前行号。@see Objects/locations.md"""
+    lineno, end_lineno, col, end_col = pos
+    if lineno is None or lineno < 0:
+        out.append(0x80 | (15 << 3) | (length - 1))
+        return line
+    delta = lineno - line
+    if col is None or end_col is None:
+        if end_lineno is None or end_lineno == lineno:
+            out.append(0x80 | (13 << 3) | (length - 1))
+            _write_location_svarint(out, delta)
+            return lineno
+        col = end_col = -1
+    elif end_lineno == lineno:
+        if delta == 0 and col < 80 and 0 <= end_col - col < 16:
+            out.append(0x80 | ((col >> 3) << 3) | (length - 1))
+            out.append(((col & 7) << 4) | (end_col - col))
+            return line
+        if 0 <= delta < 3 and col < 128 and end_col < 128:
+            out.append(0x80 | ((10 + delta) << 3) | (length - 1))
+            out.append(col)
+            out.append(end_col)
+            return lineno
+    out.append(0x80 | (14 << 3) | (length - 1))
+    _write_location_svarint(out, delta)
+    _write_location_varint(out, (end_lineno if end_lineno is not None else lineno) - lineno)
+    _write_location_varint(out, col + 1)
+    _write_location_varint(out, end_col + 1)
+    return lineno
+
+
+def encode_linetable(locations, firstlineno):
+    """把 [(size, pos), ...] 编码为 co_linetable，size 以 code unit 计"""
+    out = bytearray()
+    line = firstlineno
+    for size, pos in locations:
+        while size > 0:
+            length = min(size, 8)
+            line = _write_location_entry(out, length, pos or NO_LOCATION, line)
+            size -= length
+    return bytes(out)
+
+
+def assemble(instrs, firstlineno):
+    """布局 Instr/Label 列表，返回 (co_code, co_linetable, exc_entries)"""
+    code, locations, exc_entries = layout_instrs(instrs)
+    return code, encode_linetable(locations, firstlineno), exc_entries
+
+
+def layout_instrs(instrs):
+    """布局 Instr/Label 列表，返回 (co_code, locations, exc_entries)，locations 为 [(size, pos), ]。
+    只对跳转指令做不动点迭代，确定 EXTENDED_ARG 的数量"""
+    sizes = []
+    jumps = []
+    for i, ins in enumerate(instrs):
+        if type(ins) is Label:
+            sizes.append(0)
+            continue
+        if ins.target is not None:
+            jumps.append(i)
+            sizes.append(1 + cache_entries[ins.op])
+        else:
+            sizes.append(_ext_count(ins.arg) + 1 + cache_entries[ins.op])
+
+    starts = [0] * len(instrs)
+    changed = True
+    while changed:
+        offset = 0
+        for i, ins in enumerate(instrs):
+            starts[i] = offset
+            if type(ins) is Label:
+                ins.offset = offset
+            offset += sizes[i] * 2
+        changed = False
+        for i in jumps:
+            ins = instrs[i]
+            ins.arg = _jump_arg(ins, starts[i], sizes[i])
+            # Sizes only grow, so the iteration always terminates.
+            size = _ext_count(ins.arg) + 1 + cache_entries[ins.op]
+            if size > sizes[i]:
+                sizes[i] = size
+                changed = True
+
+    code = bytearray()
+    locations = []
+    exc_entries = []
+    entry = None
+    for i, ins in enumerate(instrs):
+        if type(ins) is Label:
+            continue
+        size = sizes[i]
+        arg = ins.arg
+        for shift in range((size - 1 - cache_entries[ins.op]) * 8, 0, -8):
+            code.append(opcode.EXTENDED_ARG)
+            code.append((arg >> shift) & 0xFF)
+        code.append(ins.op)
+        code.append(arg & 0xFF)
+        code.extend(bytes(cache_entries[ins.op] * 2))
+        locations.append((size, ins.pos))
+
+        if entry is not None and ins.exc != entry[4]:
+            exc_entries.append(entry[:4])
+            entry = None
+        if entry is None and ins.exc is not None:
+            handler, depth, lasti = ins.exc
+            entry = [starts[i], 0, handler.offset, depth << 1 | lasti, ins.exc]
+        if entry is not None:
+            entry[1] = starts[i] + size * 2
+    if entry is not None:
+        exc_entries.append(entry[:4])
+    return bytes(code), locations, exc_entries
+
+
+def _label_index(instrs):
+    return {ins: i for i, ins in enumerate(instrs) if type(ins) is Label}
+
+
+def remove_unreachable(instrs):
+    """删除从函数入口、跳转和异常处理都无法到达的指令"""
+    labels = _label_index(instrs)
+    reachable = [False] * len(instrs)
+    stack = [0]
+    while stack:
+        i = stack.pop()
+        while i < len(instrs) and not reachable[i]:
+            reachable[i] = True
+            ins = instrs[i]
+            i += 1
+            if type(ins) is Label:
+                continue
+            if ins.exc is not None:
+                stack.append(labels[ins.exc[0]])
+            if ins.target is not None:
+                stack.append(labels[ins.target])
+                if ins.op in UNCONDITIONAL_JUMPS:
+                    break
+            elif ins.op in NO_FALLTHROUGH:
+                break
+    return [ins for i, ins in enumerate(instrs) if reachable[i]]
+
+
+def remove_nops(instrs):
+    """删除 NOP 和第一个之后的 RESUME。跳转指向 Label，删除后 Label 自然指向下一条指令"""
+    res = []
+    resumed = False
+    for ins in instrs:
+        if type(ins) is not Label:
+            if ins.op == opcode.opmap["NOP"]:
+                continue
+            if ins.op == opcode.opmap["RESUME"] and ins.arg == 0:
+                # _co_firsttraceable is the first RESUME, the others only check the eval breaker.
+                if resumed:
+                    continue
+                resumed = True
+        res.append(ins)
+    return res
+
+
+def _first_instr(instrs, i):
+    """i 及之后第一条指令（非 Label）的位置"""
+    while i < len(instrs) and type(instrs[i]) is Label:
+        i += 1
+    return i
+
+
+def thread_jumps(instrs):
+    """跳转的目标是无条件跳转时，直接跳到最终目标。只在跳转方向不变时处理，保证向后跳转仍会检查 eval breaker"""
+    labels = _label_index(instrs)
+    for i, ins in enumerate(instrs):
+        if type(ins) is Label or ins.op not in opcode.hasjrel:
+            continue
+        backward = ins.op in backward_jrel
+        target = ins.target
+        seen = {target}
+        while True:
+            j = _first_instr(instrs, labels[target])
+            if j == len(instrs):
+                break
+            nxt = instrs[j]
+            if nxt.op not in THREADABLE_JUMPS or nxt.target in seen:
+                break
+            if (labels[nxt.target] < i) != backward:
+                break
+            target = nxt.target
+            seen.add(target)
+        ins.target = target
+
+
+def invert_conditional_jumps(instrs):
+    """POP_JUMP_IF_X L1; JUMP L2; L1: 合并为 POP_JUMP_IF_NOT_X L2"""
+    labels = _label_index(instrs)
+    res = []
+    i = 0
+    while i < len(instrs):
+        ins = instrs[i]
+        res.append(ins)
+        i += 1
+        if type(ins) is Label or ins.op not in INVERT_JUMP or i >= len(instrs):
+            continue
+        jump = instrs[i]  # not a jump target when it directly follows the conditional jump.
+        if type(jump) is Label or jump.op not in THREADABLE_JUMPS:
+            continue
+        if labels[ins.target] <= i or _first_instr(instrs, labels[ins.target]) != _first_instr(instrs, i + 1):
+            continue
+        op = INVERT_JUMP[ins.op]
+        if (op in backward_jrel) != (jump.op in backward_jrel):
+            op = JUMP_FLIP[op]
+        ins.op = op
+        ins.target = jump.target
+        i += 1
+    return res
+
+
+def remove_jumps_to_next(instrs):
+    """删除跳到下一条指令的无条件跳转，条件跳转替换为 POP_TOP"""
+    labels = _label_index(instrs)
+    res = []
+    for i, ins in enumerate(instrs):
+        if type(ins) is not Label and ins.target is not None and labels[ins.target] > i:
+            if _first_instr(instrs, labels[ins.target]) == _first_instr(instrs, i + 1):
+                if ins.op in THREADABLE_JUMPS:
+                    continue
+                if ins.op in INVERT_JUMP:
+                    ins.op, ins.arg, ins.target = opcode.opmap["POP_TOP"], 0, None
+        res.append(ins)
+    return res
+
+
+def optimize_instrs(instrs):
+    """合并后的优化，重复执行直到指令数量不再变化"""
+    instrs = remove_unreachable(instrs)
+    while True:
+        count = len(instrs)
+        instrs = remove_nops(instrs)
+        thread_jumps(instrs)
+        instrs = invert_conditional_jumps(instrs)
+        instrs = remove_jumps_to_next(instrs)
+        instrs = remove_unreachable(instrs)
+        if len(instrs) == count:
+            return instrs
+
+
+def _global_names(code, nested=True):
+    """code 读取和写入（STORE_GLOBAL/DELETE_GLOBAL）的全局变量名，nested 时包括嵌套的 code"""
+    loads = set()
+    stores = set()
+    for _, _, op, arg, _ in _iter_instructions(code.co_code):
+        if op == opcode.opmap["LOAD_GLOBAL"]:
+            loads.add(code.co_names[arg >> 1])
+        elif op == opcode.opmap["LOAD_NAME"]:
+            loads.add(code.co_names[arg])
+        elif op in (opcode.opmap["STORE_GLOBAL"], opcode.opmap["DELETE_GLOBAL"]):
+            stores.add(code.co_names[arg])
+    if nested:
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                sub_loads, sub_stores = _global_names(const)
+                loads |= sub_loads
+                stores |= sub_stores
+    return loads, stores
+
+
+def shared_globals(funcs):
+    """如果所有函数都能直接使用第一个函数的 __globals__，返回它，否则返回 None。
+    其他函数用到的全局变量在两个 dict 中都必须是同一个对象（或都不存在），且不能写全局变量"""
+    shared = funcs[0].__globals__
+    for func in funcs[1:]:
+        fglobals = func.__globals__
+        if fglobals is shared:
+            continue
+        if fglobals.get("__builtins__") is not shared.get("__builtins__"):
+            return None
+        loads, stores = _global_names(func.__code__)
+        if stores:
+            return None
+        for name in loads:
+            if fglobals.get(name, shared) is not shared.get(name, shared):
+                return None
+    return shared
+
+
+_unbound = object()
+
+
+def _global_binding(func, name):
+    value = func.__globals__.get(name, _unbound)
+    if value is _unbound:
+        value = func.__builtins__.get(name, _unbound)
+    return value
+
+
+def hoistable_globals(funcs):
+    """可以在合并函数开头读取一次的全局变量名：被两个以上函数直接读取，没有任何函数写入，
+    在读取它的函数中绑定到同一个对象"""
+    users = collections.defaultdict(list)
+    stores = set()
+    for func in funcs:
+        stores |= _global_names(func.__code__)[1]
+        loads = _global_names(func.__code__, nested=False)[0]
+        for name in loads:
+            users[name].append(func)
+
+    res = []
+    for name, fs in users.items():
+        if len(fs) < 2 or name in stores:
+            continue
+        value = _global_binding(fs[0], name)
+        if value is _unbound or any(_global_binding(f, name) is not value for f in fs[1:]):
+            continue
+        res.append(name)
+    return res
+
+
+def plan_globals(funcs, share_globals=True):
+    """决定合并后的 __globals__。返回 (func_globals, globals_shared, renames)，
+    renames[idx] 为第 idx 个函数需要重命名的全局变量 {name: new_name}"""
+    # reference the module dict directly, copy and rename only when names really conflict.
+    if share_globals:
+        shared = shared_globals(funcs)
+        if shared is not None:
+            return shared, True, [{} for _ in funcs]
+
+    func_globals = dict()
+    renames = [merge_globals(func_globals, func, idx) for idx, func in enumerate(funcs)]
+    return func_globals, False, renames
+
+
+def merge_globals(func_globals, func, idx):
+    """把 func.__globals__ 合并到 func_globals，返回 func 需要重命名的全局变量 {name: new_name}"""
+    code = func.__code__
+    fglobals = func.__globals__
+    rename = {}
+    for _, _, op, arg, _ in _iter_instructions(code.co_code):
+        if op == opcode.opmap["LOAD_GLOBAL"]:
+            name = code.co_names[arg >> 1]
+        elif op in (opcode.opmap["STORE_GLOBAL"], opcode.opmap["DELETE_GLOBAL"]):
+            name = code.co_names[arg]
+        else:
+            continue
+        # fix func globals has same key but different value
+        if name in func_globals and name in fglobals and func_globals[name] != fglobals[name]:
+            rename[name] = "%s_%s" % (name, idx)
+
+    for k, v in fglobals.items():
+        if k in rename:
+            func_globals[rename[k]] = v
+        elif k not in func_globals:
+            func_globals[k] = v
+    return rename
+
+
+def param_count(code):
+    """参数个数，包括仅限关键字参数和 *args, **kwargs。参数在 co_varnames 的开头"""
+    return (
+        code.co_argcount + code.co_kwonlyargcount
+        + bool(code.co_flags & inspect.CO_VARARGS) + bool(code.co_flags & inspect.CO_VARKEYWORDS)
+    )
+
+
+def signature_template(signature):
+    """signature 为函数或者参数列表字符串，如 "self, dt, ctx=None, *, force=False"，返回定义签名的函数"""
+    if isinstance(signature, str):
+        namespace = {}
+        exec(f"def {SIGNATURE_TEMPLATE_NAME}({signature}):\n    pass", namespace)
+        return namespace[SIGNATURE_TEMPLATE_NAME]
+    return signature
+
+
+def _param_defaults(func):
+    """{参数名: 默认值}"""
+    code = func.__code__
+    defaults = func.__defaults__ or ()
+    names = code.co_varnames[code.co_argcount - len(defaults):code.co_argcount]
+    res = dict(zip(names, defaults))
+    res.update(func.__kwdefaults__ or {})
+    return res
+
+
+def plan_signature(funcs, signature, arg_maps=None):
+    """决定合并后函数的签名和每个函数的参数映射。返回 (sig, maps, inits, defaults, kwdefaults)
+
+    arg_maps[idx] 为第 idx 个函数的 {参数名: 合并后的参数名或 None}，没有给出的参数映射到同名参数。
+    映射为 None 或者合并后没有同名参数的参数被丢弃，成为这个函数自己的局部变量，
+    在函数开头赋值为它的默认值，没有默认值时为 None，*args, **kwargs 为空的 tuple, dict"""
+    template = signature_template(signature)
+    tcode = template.__code__
+    params = tcode.co_varnames[:param_count(tcode)]
+    sig = {
+        "argcount": tcode.co_argcount,
+        "posonlyargcount": tcode.co_posonlyargcount,
+        "kwonlyargcount": tcode.co_kwonlyargcount,
+        "flags": tcode.co_flags & VARARG_FLAGS,
+        "params": params,
+    }
+    maps = []
+    inits = []
+    for idx, func in enumerate(funcs):
+        code = func.__code__
+        arg_map = (arg_maps[idx] if arg_maps is not None else None) or {}
+        nparams = param_count(code)
+        fparams = code.co_varnames[:nparams]
+        unknown = set(arg_map) - set(fparams)
+        if unknown:
+            raise ValueError(f"{func.__qualname__} has no parameters {sorted(unknown)}")
+        varargs = code.co_argcount + code.co_kwonlyargcount
+        defaults = _param_defaults(func)
+        mapping = {}
+        init = []
+        for i, name in enumerate(fparams):
+            target = arg_map[name] if name in arg_map else (name if name in params else None)
+            if target is not None:
+                if target not in params:
+                    raise ValueError(f"{func.__qualname__}: {target} is not a parameter of the merged function")
+                mapping[name] = target
+                continue
+            # dropped, a local of this function only.
+            local = f".{idx}.{name}"
+            mapping[name] = local
+            if name in defaults:
+                init.append((local, "const", defaults[name]))
+            elif i < varargs:
+                init.append((local, "const", None))
+            elif i == nparams - 1 and code.co_flags & inspect.CO_VARKEYWORDS:
+                init.append((local, "dict", None))
+            else:
+                init.append((local, "const", ()))
+        maps.append(mapping)
+        inits.append(init)
+    return sig, maps, inits, template.__defaults__, template.__kwdefaults__
+
+
+def plan_closure(funcs):
+    """按 cell 的身份合并 __closure__。返回 (closure, freevars, free_maps)，
+    free_maps[idx][j] 为第 idx 个函数的第 j 个 free variable 在合并后 closure 中的位置"""
+    closure = []
+    freevars = []
+    free_maps = []
+    index = {}  # id(cell) -> position in closure, the cells are kept alive by closure.
+    for func in funcs:
+        free_map = []
+        for name, cell in zip(func.__code__.co_freevars, func.__closure__ or ()):
+            k = index.get(id(cell))
+            if k is None:
+                k = index[id(cell)] = len(closure)
+                closure.append(cell)
+                freevars.append(name)
+            free_map.append(k)
+        free_maps.append(free_map)
+    return closure, freevars, free_maps
+
+
+def plan_merge(funcs, share_globals=True, hoist_globals=False, signature=None, arg_maps=None):
+    """合并前需要函数对象才能决定的内容。merge_code 只使用其中可以 marshal 的部分，见 CODE_PLAN_KEYS"""
+    func_globals, globals_shared, renames = plan_globals(funcs, share_globals)
+    plan = {
+        "func_globals": func_globals,  # __globals__ of the merged function
+        "globals_shared": globals_shared,  # func_globals is the __globals__ of the inputs, not a copy
+        "renames": renames,  # [{name: new_name}, ] for each function
+        "hoisted": hoistable_globals(funcs) if hoist_globals else [],  # globals loaded once into fast locals
+    }
+    closure, freevars, free_maps = plan_closure(funcs)
+    plan["closure"] = closure  # __closure__ of the merged function, shared cells once
+    plan["freevars"] = freevars  # co_freevars of the merged function, before the extra names
+    plan["free_maps"] = free_maps  # [[position in closure, ], ] for each function
+    if signature is not None:
+        sig, maps, inits, defaults, kwdefaults = plan_signature(funcs, signature, arg_maps)
+        plan["signature"] = sig  # argcount, posonlyargcount, kwonlyargcount, flags, params
+        plan["arg_maps"] = maps  # [{param: merged param or hidden local}, ] for each function
+        plan["arg_inits"] = inits  # [[(hidden local, "const" or "dict", value), ], ] for each function
+        plan["defaults"] = defaults  # __defaults__ of the merged function
+        plan["kwdefaults"] = kwdefaults  # __kwdefaults__ of the merged function
+    elif arg_maps is not None:
+        raise ValueError("arg_maps needs a signature")
+    return plan
+
+
+def code_plan(plan):
+    """plan 中 merge_code 使用的部分，可以 marshal（默认值不能 marshal 时除外）"""
+    return {key: plan[key] for key in CODE_PLAN_KEYS if key in plan}
+
+
+def new_context(pooled=False):
+    """合并函数的 context，记录合并后 code 对象的各个字段"""
+    return {
         "co_names": list(),
         "co_varnames": list(),
         "co_consts": list(),
+        "pooled": pooled,  # share one slot between equal co_consts / co_names entries
+        "const_pool": dict(),  # _const_key(value) -> index of co_consts
+        "name_pool": dict(),  # name -> index of co_names
         "co_freevars": list(),
         "co_cellvars": list(),
         "co_code": bytes(),
-        "co_lnotab": None,
         "co_nlocals": 0,
         "co_argcount": 0,
         "co_posonlyargcount": 0,  # * 参数
@@ -101,273 +973,196 @@ def merge_func(func_name, funcs, def_argcount=None, debug=1, merged_firstlineno=
         "co_flags": 0,
         "co_linetable": bytes(),
         "co_exceptiontable": bytes(),
-        "co_codelen": 0,  # length of bytecode
-        "func_globals": dict(),  # __globals__
-        "func_defaults": list(),  # __defaults__
-        "func_closure": list(),  # __closure__
         "slot_mapping_name": [],
         "name_mapping_slot": {},
+        "hoisted": {},  # global name -> fast local slot which holds it
+        "free_offset": 0,  # fast local slot of the first free variable
     }
-    # assert that all functions have the same signature.
-    context["co_argcount"] = def_argcount if def_argcount is not None else funcs[0].__code__.co_argcount
-    context["co_posonlyargcount"] = funcs[0].__code__.co_posonlyargcount
-    context["co_kwonlyargcount"] = funcs[0].__code__.co_kwonlyargcount
-    context["co_flags"] = funcs[0].__code__.co_flags
+
+
+def merge_code(func_name, codes, plan, def_argcount=None, debug=1, merged_firstlineno=0, pooled=False,
+               optimize=False, guards=False, returns="last", isolate=False, profile=None, verify=True):
+    """合并 code 对象。只做字节码变换，不需要函数对象，plan 由 plan_merge 生成。
+    verify 为 True 时用 verify_code 检查生成的 code，有问题时抛出 MergeVerifyError"""
+    assert returns in RETURN_MODES, f"returns must be one of {RETURN_MODES}"
+    assert profile in PROFILE_MODES, f"profile must be one of {PROFILE_MODES}"
+    func_info = dict()
+    context = new_context(pooled)
+    sig = plan.get("signature")
+    if sig is None:
+        # without a signature, all functions have the signature of the first one.
+        context["co_argcount"] = def_argcount if def_argcount is not None else codes[0].co_argcount
+        context["co_posonlyargcount"] = codes[0].co_posonlyargcount
+        context["co_kwonlyargcount"] = codes[0].co_kwonlyargcount
+        context["co_flags"] = codes[0].co_flags
+    else:
+        context["co_argcount"] = sig["argcount"]
+        context["co_posonlyargcount"] = sig["posonlyargcount"]
+        context["co_kwonlyargcount"] = sig["kwonlyargcount"]
+        context["co_flags"] = codes[0].co_flags & ~VARARG_FLAGS | sig["flags"]
 
     # merge co_varnames, co_cellvars before convert opcode.
-    c_vns = list()
+    seg_locals = [segment_locals(code, idx, plan) for idx, code in enumerate(codes)]
+    c_vns = list(sig["params"]) if sig is not None else list()
     c_cvs = list()
-    for i, func in enumerate(funcs):
-        code = func.__code__
-        vns = code.co_varnames
-        cvs = code.co_cellvars
+    s_vns = set(c_vns)
+    s_cvs = set()
+    for vns, cvs in seg_locals:
         for vn in vns:
-            if vn not in c_vns and vn in vns and vn in cvs:  # argument names
+            if vn not in s_vns and vn in cvs:  # argument names
                 c_vns.append(vn)
-            elif vn not in c_vns and vn not in cvs and vn not in c_cvs:  # local variable names and not cell.
+                s_vns.add(vn)
+            elif vn not in s_vns and vn not in cvs and vn not in s_cvs:  # local variable names and not cell.
                 c_vns.append(vn)
+                s_vns.add(vn)
         for cv in cvs:
-            if cv not in c_cvs:
+            if cv not in s_cvs:
                 c_cvs.append(cv)
-                if cv not in vns and cv in c_vns:
+                s_cvs.add(cv)
+                if cv not in vns and cv in s_vns:
                     c_vns.remove(cv)
+                    s_vns.discard(cv)
+
+    # globals loaded by several functions are loaded once into fast locals.
+    hoisted = plan["hoisted"]
+    for name in hoisted:
+        c_vns.append(f".{name}")
+        s_vns.add(f".{name}")
+    if profile == "counters":
+        c_vns.append(PROFILE_START_NAME)
+        s_vns.add(PROFILE_START_NAME)
+    collect = returns in ("list", "tuple")
+    if collect:
+        c_vns.append(RESULTS_NAME)
+        s_vns.add(RESULTS_NAME)
 
     context['co_varnames'] = c_vns
     context['co_cellvars'] = c_cvs
 
-    names = c_vns + list(set(c_cvs) - set(c_vns))
+    # fast locals layout of CodeType: varnames, then cellvars which are not varnames.
+    names = c_vns + [cv for cv in c_cvs if cv not in s_vns]
     context['slot_mapping_name'] = names
     for i, name in enumerate(names):
         context['name_mapping_slot'][name] = i
 
     merged_code = list()
 
-    # generate MAKE_CELL
+    # free variables: those of the functions deduplicated by cell, then one enable flag for each function.
+    context["free_offset"] = len(names)
+    nfree = len(plan["freevars"])
+    guard_names = [f"{GUARD_PREFIX}{idx}" for idx in range(len(codes))] if guards else []
+    isolate_names = list(ISOLATE_NAMES) if isolate else []
+    profile_names = list(PROFILE_COUNTER_NAMES if profile == "counters" else PROFILE_HOOK_NAMES if profile else ())
+    extra_names = guard_names + isolate_names + profile_names
+    profile_slot = len(names) + nfree + len(guard_names) + len(isolate_names)
+    if nfree or extra_names:
+        merged_code.append(Instr(opcode.opmap['COPY_FREE_VARS'], nfree + len(extra_names), pos=NO_LOCATION))
+
+    # generate MAKE_CELL, slots past 255 get EXTENDED_ARG from the assembler.
     for cv in c_cvs:
-        merged_code.append(opcode.opmap['MAKE_CELL'])
-        sloti = context['name_mapping_slot'][cv]
-        assert 0 <= sloti < 256, "fast slot index need be in [0, 256)"  # TODO: heng, deal with EXTENDED_ARG?
-        merged_code.append(sloti)
-
-    # MAKE_CELL location entries, 0b10000000 & 0b01111000
-    # @see Objects/locations.md
-    context['co_linetable'] += bytes([0b11111000] * len(c_cvs))
-    context['co_codelen'] = len(merged_code)
-
-    for idx, func in enumerate(funcs):
-        data = func_info[idx] = {}
-        data["func"] = func
-        data["idx"] = idx
-        data["code_obj"] = code_obj = func.__code__
-        data["co_code"] = code_obj.co_code
-        data["co_consts"] = code_obj.co_consts
-        data["co_filename"] = code_obj.co_filename
-        data["co_lnotab"] = code_obj.co_lnotab
-        data["co_name"] = func_name  # function name
-        data["co_names"] = code_obj.co_names
-        data["co_renames"] = []  # [(old_name, new_name), ]
-        data["co_nlocals"] = code_obj.co_nlocals
-        data["co_stacksize"] = code_obj.co_stacksize
-        data["co_varnames"] = code_obj.co_varnames
-        data["co_firstlineno"] = code_obj.co_firstlineno
-        data["co_cellvars"] = code_obj.co_cellvars
-        data["co_freevars"] = code_obj.co_freevars
-        data['co_linetable'] = code_obj.co_linetable
-        data["co_exceptiontable"] = parse_exception_table(code_obj)
-        data["func_globals"] = func.__globals__
-        data["func_defaults"] = func.__defaults__
-        data["func_closure"] = func.__closure__
-
-        names = list(code_obj.co_varnames) + list(set(code_obj.co_cellvars) - set(code_obj.co_varnames))
-        data['slot_mapping_name'] = names
-        data['name_mapping_slot'] = {}
-        for i, name in enumerate(names):
-            data['name_mapping_slot'][name] = i
-
-        cocode = list(code_obj.co_code)
-        linetable = list(code_obj.co_linetable)
-        lti = 0  # linetable index
-        nei = next_entry_index(linetable, 0)
-        is_last = idx == len(funcs) - 1
-        cl = data["co_codelen"] = len(cocode)
-
-        # convert opcode and maintain linetable
-        tmpcode = []
-        inserts = queue.Queue()
-        jumps = []  # record jump opcode
-        i = 0
-        tmplinetable = []
-        while i < cl:
-            fi = i
-            while cocode[fi] == opcode.opmap['EXTENDED_ARG']:
-                fi += 2
-            op = cocode[fi]
-
-            if op >= opcode.HAVE_ARGUMENT:
-                if op in opcode.hasjrel:
-                    jumps.append([i, len(tmpcode), fi + 2 - i, 0])
-
-                if op == opcode.opmap['LOAD_CONST'] and cocode[fi + 2] == opcode.opmap['RETURN_VALUE'] and not is_last:
-                    codes = make_jump_forward((cl - i) // 2)
-                    jumps.append([i, len(tmpcode), len(codes), 0])
-                    tmpcode.extend(codes)
-                    pbs = linetable[lti:nei]
-                    pbs[0] &= 0b11111000
-                    pbs[0] |= (len(codes) // 2) - 1
-                    tmplinetable.extend(pbs)
-                    lti = nei
-                    nei = next_entry_index(linetable, lti)
-
-                    if (fi - i + 2) < len(codes):
-                        dels = (len(codes) - (fi - i + 2)) // 2
-                        for _ in range(dels):
-                            tmpcode.extend([opcode.opmap['NOP'], 0])
-                            # Number of instructions is increased, append a position entry.
-                            tmplinetable.append(0b10000000)
-                    else:
-                        inserted = (len(codes) - (fi - i + 2)) // 2
-                        for _ in range(inserted):
-                            inserts.put(i)
-                    # Replace RETURN_VALUE by NOP, to keep the number of instructions constant.
-                    tmpcode.extend([opcode.opmap['NOP'], 0])
-                    fi += 2
-                else:
-                    try:
-                        handler = REGISTER_HANDLES[op]
-                    except:
-                        raise Exception(f"opcode [{op}]:{opcode.opname[op]} dont have converter.")
-                    result, inserted = handler(cocode[i: fi + 2], context, data)
-                    tmpcode.extend(result)
-                    pbs = linetable[lti:nei]
-                    pbs[0] &= 0b11111000
-                    pbs[0] |= (len(result) // 2 + cache_entries[op]) - 1
-                    tmplinetable.extend(pbs)
-                    for _ in range(inserted):
-                        inserts.put(i)
-                fi += 2
-            else:  # opcode with no argument.
-                if op == opcode.opmap['RETURN_VALUE'] and not is_last:
-                    # Replace with JUMP_FORWARD
-                    codes = make_jump_forward((cl - fi) // 2)
-                    inserted = (len(codes) - 2) // 2
-                    jumps.append([i, len(tmpcode), len(codes), 0])
-                    tmpcode.extend(codes)
-                    pbs = linetable[lti:nei]
-                    pbs[0] &= 0b11111000
-                    pbs[0] |= (len(codes) // 2 - 1)
-                    tmplinetable.extend(pbs)
-                    for _ in range(inserted):
-                        inserts.put(i)
-                else:
-                    tmpcode.extend(cocode[fi: fi + 2])
-                    tmplinetable.extend(linetable[lti:nei])
-                fi += 2
-
-            lti = nei
-            nei = next_entry_index(linetable, lti)
-            # CACHE
-            if cache_entries[op] > 0:
-                tmpcode.extend(cocode[fi: fi + cache_entries[op] * 2])
-                fi += cache_entries[op] * 2
-
-            i = fi
-
-        # after converted, deal with relative jump opcode.
-        allinserted = []
-        while not inserts.empty():
-            iat = inserts.get()
-            allinserted.append(iat)
-            for jump in jumps:
-                jcodes = cocode[jump[0]: jump[0] + jump[2]]
-                jarg = 0
-                for i in range(-1, -len(jcodes), -2):
-                    jarg |= jcodes[i] << (abs(i) // 2 * 8)
-                jop = jcodes[-2]
-                cover = True
-                if jop not in backward_jrel:
-                    cover = jump[0] < iat < jump[0] + jump[2] + jarg * 2
-                else:
-                    cover = jump[0] - jarg * 2 <= iat < jump[0]
-
-                if not cover:
-                    continue
-
-                if jarg == 0xFF or jarg == 0xFFFF or jarg == 0xFFFFFF:
-                    inserts.put(jump[0])
-
-                jump[3] = jarg + 1 if jump[3] == 0 else jump[3] + 1
-
-        # reversed order to avoid tmpcode index error.
-        for jump in reversed(jumps):
-            if not jump[3] == 0:
-                jarg = jump[3]
-                cvt = []
-                jop = cocode[jump[0]: jump[0] + jump[2]][-2]
-                while jarg > 0:
-                    word = jarg & 0xFF
-                    jarg = jarg >> 8
-                    if cvt:
-                        cvt = [opcode.EXTENDED_ARG, word] + cvt
-                    else:
-                        cvt = [jop, word]
-                tmpcode = tmpcode[0: jump[1]] + cvt + tmpcode[jump[1] + jump[2]:]
-
-        # deal with exception table.
-        if data['co_exceptiontable']:
-            exc_deltas = [0, 0, 0] * len(data['co_exceptiontable'])
-            for i in range(len(data['co_exceptiontable'])):
-                entry = data['co_exceptiontable'][i]
-                start = entry[0]
-                end = entry[1] - 2
-                target = entry[2]
-                for isa in allinserted:
-                    if isa <= start:
-                        exc_deltas[i*3+0] += 2
-                        exc_deltas[i*3+1] += 2
-                        exc_deltas[i*3+2] += 2
-
-                    if start < isa <= end:
-                        exc_deltas[i*3+1] += 2
-                        exc_deltas[i*3+2] += 2
-
-                    if end < isa <= target:
-                        exc_deltas[i*3+2] += 2
-
-            for i in range(len(data['co_exceptiontable'])):
-                entry = data['co_exceptiontable'][i]
-
-                entry[0] = entry[0] + exc_deltas[i*3+0] + context['co_codelen']
-                entry[1] = entry[1] + exc_deltas[i*3+1] + context['co_codelen']
-                entry[2] = entry[2] + exc_deltas[i*3+2] + context['co_codelen']
+        merged_code.append(Instr(opcode.opmap['MAKE_CELL'], context['name_mapping_slot'][cv], pos=NO_LOCATION))
+
+    # generate hoisted LOAD_GLOBAL after our own RESUME, the frame is not complete before the first RESUME.
+    if hoisted or collect:
+        merged_code.append(Instr(opcode.opmap['RESUME'], 0, pos=NO_LOCATION))
+    if collect:
+        # preallocated result list: [None] * len(codes)
+        merged_code.append(Instr(opcode.opmap['BUILD_LIST'], 0, pos=NO_LOCATION))
+        merged_code.append(Instr(opcode.opmap['LOAD_CONST'], pool_const(context, (None,) * len(codes)), pos=NO_LOCATION))
+        merged_code.append(Instr(opcode.opmap['LIST_EXTEND'], 1, pos=NO_LOCATION))
+        merged_code.append(Instr(opcode.opmap['STORE_FAST'], context['name_mapping_slot'][RESULTS_NAME], pos=NO_LOCATION))
+    if hoisted:
+        for name in hoisted:
+            sloti = context['hoisted'][name] = context['name_mapping_slot'][f".{name}"]
+            merged_code.append(Instr(opcode.opmap['LOAD_GLOBAL'], pool_name(context, name) << 1, pos=NO_LOCATION))
+            merged_code.append(Instr(opcode.opmap['STORE_FAST'], sloti, pos=NO_LOCATION))
+
+    owners = {}  # id(Instr) -> index of the function it comes from, for the segment table
+    end = Label()  # shared RETURN_VALUE of any/all mode
+    handlers = []  # [(handler, idx, next_head), ] of isolate mode
+    for idx, code_obj in enumerate(codes):
+        data = func_info[idx] = segment_data(func_name, code_obj, idx, plan["renames"][idx], *seg_locals[idx])
+        data["free_map"] = plan["free_maps"][idx]
+
+        # without pool, co_consts and co_names of the function are appended as a whole.
+        data["consts_offset"] = len(context["co_consts"])
+        data["names_offset"] = len(context["co_names"])
+        if not pooled:
+            context["co_consts"].extend(data["co_consts"])
+            context["co_names"].extend(data["co_names"])
+
+        tmpcode = convert_segment(context, data)
+        if plan.get("arg_inits"):
+            tmpcode = init_segment_args(tmpcode, context, plan["arg_inits"][idx])
+        if profile:
+            tmpcode = profile_segment(tmpcode, context, idx, profile, profile_slot)
+        next_head = Label()
+        if guards:
+            tmpcode = guard_segment(tmpcode, len(names) + nfree + idx, next_head)
+        if collect:
+            tmpcode = aggregate_returns(tmpcode, next_head, context, returns, index=idx)
+        elif idx != len(codes) - 1:
+            if returns == "last":
+                tmpcode = chain_returns(tmpcode, next_head)
+            else:
+                tmpcode = aggregate_returns(tmpcode, next_head, context, returns, end=end)
+        if isolate:
+            # every instruction not in a try block of the function goes to the handler of the function.
+            handler = Label()
+            handlers.append((handler, idx, next_head))
+            exc = (handler, 0, 0)
+            for ins in tmpcode:
+                if type(ins) is Instr and ins.exc is None:
+                    ins.exc = exc
+        if idx == len(codes) - 1 and not collect and (guards or isolate):
+            # the last function is skipped to the end, the result when no function decides it.
+            tmpcode.append(next_head)
+            tmpcode.append(Instr(opcode.opmap['LOAD_CONST'], pool_const(context, returns == "all" or None), pos=NO_LOCATION))
+            tmpcode.append(Instr(opcode.opmap['RETURN_VALUE'], pos=NO_LOCATION))
 
         # merge to context.
+        owners.update((id(ins), idx) for ins in tmpcode if type(ins) is Instr)
         merged_code += tmpcode
-        context["co_names"].extend(data["co_names"])
-        if data["co_renames"]:
-            context["co_names"].extend(e[1] for e in data["co_renames"])  # extend new names
-        context["co_consts"].extend(data["co_consts"])
-        context["co_freevars"].extend(data["co_freevars"])
-        context["co_stacksize"] = max(data["co_stacksize"], context["co_stacksize"])
-        context["co_exceptiontable"] += write_exception_table(data["co_exceptiontable"])
-        context["co_codelen"] = len(merged_code)
-        context['co_linetable'] += bytes(tmplinetable)
-
-        # fix func globals has same key but different value
-        if data["func_globals"]:
-            renames = {e[0]: e[1] for e in data["co_renames"]}
-            for k, v in data["func_globals"].items():
-                if k in renames:
-                    context["func_globals"][renames[k]] = v
-                elif k not in context["func_globals"]:
-                    context["func_globals"][k] = v
-
-        if data["func_defaults"]:
-            context["func_defaults"].extend(data["func_defaults"])
-        if data["func_closure"]:
-            context["func_closure"].extend(data["func_closure"])
-
-    # generate merged function.
-    context["co_code"] = bytes(merged_code)
+    context["co_freevars"].extend(plan["freevars"])
+    context["co_freevars"].extend(extra_names)
+    if collect:
+        merged_code.append(Instr(opcode.opmap['LOAD_FAST'], context['name_mapping_slot'][RESULTS_NAME], pos=NO_LOCATION))
+        if returns == "tuple":
+            merged_code.append(Instr(opcode.opmap['LIST_TO_TUPLE'], pos=NO_LOCATION))
+        merged_code.append(Instr(opcode.opmap['RETURN_VALUE'], pos=NO_LOCATION))
+    elif returns != "last" and len(codes) > 1:
+        merged_code.append(end)
+        merged_code.append(Instr(opcode.opmap['RETURN_VALUE'], pos=NO_LOCATION))
+
+    # exception handlers of isolate mode are put at the end, out of the normal path.
+    if isolate:
+        free_slot = len(names) + nfree + len(guard_names)
+        cleanup = Label()
+        for handler, idx, next_head in handlers:
+            exit_code = profile_exit(context, idx, profile, profile_slot, None, NO_LOCATION) if profile else []
+            handler_code = isolate_handler(context, handler, idx, next_head, cleanup, free_slot, exit_code)
+            owners.update((id(ins), idx) for ins in handler_code if type(ins) is Instr)
+            merged_code += handler_code
+        merged_code += [
+            cleanup,
+            Instr(opcode.opmap['COPY'], 3, pos=NO_LOCATION),
+            Instr(opcode.opmap['POP_EXCEPT'], pos=NO_LOCATION),
+            Instr(opcode.opmap['RERAISE'], 1, pos=NO_LOCATION),
+        ]
+
+    # generate merged code.
+    unoptimized = merged_code  # keeps the ids in owners alive
+    owners = {id(ins): owners.get(id(ins)) for ins in merged_code if type(ins) is Instr}
+    if optimize:
+        merged_code = optimize_instrs(merged_code)
+    co_code, locations, exc_entries = layout_instrs(merged_code)
+    ranges = segment_ranges(merged_code, owners, locations)
+    del unoptimized
+    context["co_consts"].append(segment_table_const(ranges, codes))
+    context["co_code"] = co_code
+    context["co_linetable"] = encode_linetable(locations, merged_firstlineno)
+    context["co_exceptiontable"] = write_exception_table(exc_entries)
+    context["co_stacksize"] = compute_stacksize(co_code, exc_entries)
     context['co_nlocals'] = len(context['co_varnames'])
     for k, v in context.items():
         if type(v) is list:
@@ -378,13 +1173,13 @@ def merge_func(func_name, funcs, def_argcount=None, debug=1, merged_firstlineno=
         context["co_posonlyargcount"],  # int, 函数的仅限位置 形参 的总数（包括具有默认值的参数）
         context["co_kwonlyargcount"],  # int, 函数的仅限关键字 形参 的数量（包括具有默认值的参数
         context["co_nlocals"],  # number of local varialbes (except cell)
-        context["co_stacksize"] + 10,  # int, 取max_stacksize+1, +1 是为了避免内存crash
+        context["co_stacksize"],  # int, 由 compute_stacksize 计算的精确值
         context["co_flags"],  # bitmap: 1=optimized | 2=newlocals | 4=*arg | 8=**arg
         context["co_code"],  # bytes of raw compiled bytecode
         context["co_consts"],  # tuple of constants used in the bytecode
         context["co_names"],  # tuple of names of local variables
         context["co_varnames"],  # tuple of names of arguments and local variables
-        f"merge_funcion_generated__{func_name}.py",  # filename
+        merged_filename(func_name, codes),  # filename
         func_name,  # str, function name
         func_name,  # qualname
         merged_firstlineno,  # 需要能设置firstlino,否则tracy会无法正确识别函数名
@@ -393,188 +1188,692 @@ def merge_func(func_name, funcs, def_argcount=None, debug=1, merged_firstlineno=
         context["co_freevars"],  # the names of the free variables.
         context["co_cellvars"],  # the names of the local variables that are referenced by nested functions.
     )
-    func_generated = types.FunctionType(
-        mycode_obj,  # code object
-        context.get("func_globals", {}),  # __globals__
-        func_name,  # __name__
-        context.get("func_defaults", ()),  # __default__
-        context.get("func_closure", ()),  # __closure__
-    )
-    return func_generated
+    if verify:
+        verify_code(mycode_obj)
+    return mycode_obj
+
+
+def merged_filename(func_name, codes):
+    """合并后的 co_filename：所有函数在同一个文件中时使用这个文件，行号表保留了原来的行号，
+    traceback、采样 profiler 可以直接显示源码；否则为生成的文件名，由 segment_table 找到原函数"""
+    filenames = {code.co_filename for code in codes}
+    if len(filenames) == 1:
+        return filenames.pop()
+    return f"merge_funcion_generated__{func_name}.py"
+
+
+def segment_ranges(instrs, owners, locations):
+    """按布局后的指令大小计算每个函数的字节码范围 ((start, end, idx), )。
+    owners 为 {id(Instr): 所属函数的序号}，None 为合并时生成的指令；优化时新生成的指令沿用上一条指令"""
+    ranges = []
+    offset = 0
+    owner = None
+    for ins, (size, _) in zip([ins for ins in instrs if type(ins) is Instr], locations):
+        owner = owners.get(id(ins), owner)
+        if owner is not None:
+            if ranges and ranges[-1][2] == owner and ranges[-1][1] == offset:
+                ranges[-1][1] = offset + size * 2
+            else:
+                ranges.append([offset, offset + size * 2, owner])
+        offset += size * 2
+    return tuple(map(tuple, ranges))
+
+
+def segment_table_const(ranges, codes):
+    """放在 co_consts 末尾的 side table，不被任何指令引用，随 code 对象 marshal"""
+    infos = tuple((code.co_qualname, code.co_filename, code.co_firstlineno) for code in codes)
+    return (SEGMENT_TABLE_TAG, ranges, infos)
+
+
+def segment_locals(code, idx, plan):
+    """函数的 co_varnames, co_cellvars 在合并后函数中的名字。
+    参数按 plan 的 arg_maps 改名，与合并后的参数同名的其他局部变量改为 .idx.name，避免覆盖参数"""
+    arg_maps = plan.get("arg_maps")
+    if arg_maps is None:
+        return code.co_varnames, code.co_cellvars
+    arg_map = arg_maps[idx]
+    params = plan["signature"]["params"]
+
+    def rename(name):
+        if name in arg_map:
+            return arg_map[name]
+        return f".{idx}.{name}" if name in params else name
+    return tuple(map(rename, code.co_varnames)), tuple(map(rename, code.co_cellvars))
+
+
+def segment_data(func_name, code_obj, idx, renames, varnames=None, cellvars=None):
+    """合并中一个函数的信息，convert_* 通过它读取原 code 对象的字段。
+    varnames, cellvars 为 segment_locals 改名后的 co_varnames, co_cellvars"""
+    if varnames is None:
+        varnames, cellvars = code_obj.co_varnames, code_obj.co_cellvars
+    data = {}
+    data["idx"] = idx
+    data["code_obj"] = code_obj
+    data["co_consts"] = code_obj.co_consts
+    data["co_filename"] = code_obj.co_filename
+    data["co_name"] = func_name  # function name
+    data["co_names"] = code_obj.co_names
+    data["renames"] = renames  # {name: new_name}
+    data["rename_slots"] = {}  # new_name -> index of co_names
+    data["co_nlocals"] = code_obj.co_nlocals
+    data["co_varnames"] = varnames
+    data["co_firstlineno"] = code_obj.co_firstlineno
+    data["co_cellvars"] = cellvars
+    data["co_freevars"] = code_obj.co_freevars
+
+    vns = set(varnames)
+    names = list(varnames) + [cv for cv in cellvars if cv not in vns]
+    data['slot_mapping_name'] = names
+    data['name_mapping_slot'] = {}
+    for i, name in enumerate(names):
+        data['name_mapping_slot'][name] = i
+    return data
+
+
+def convert_segment(context, data, instrs=None):
+    """转换一个函数的字节码，返回 Instr/Label 列表。RETURN_VALUE 保持不变，由 chain_returns 处理。
+    调用前需要设置 data 的 consts_offset, names_offset。instrs 为已经 decode_instructions 的指令，
+    参数仍是原 code 对象中的下标，转换时原地修改"""
+    if instrs is None:
+        instrs = decode_instructions(data["code_obj"])
+    # jump targets and exception handlers are labels, so nothing to relocate here.
+    tmpcode = []
+    for ins in instrs:
+        if type(ins) is Label:
+            tmpcode.append(ins)
+            continue
+
+        op = ins.op
+        if op == opcode.opmap['LOAD_GLOBAL'] and data["co_names"][ins.arg >> 1] in context["hoisted"]:
+            if ins.arg & 0x01:
+                tmpcode.append(Instr(opcode.opmap['PUSH_NULL'], exc=ins.exc, pos=ins.pos))
+            ins.op = opcode.opmap['LOAD_FAST']
+            ins.arg = context["hoisted"][data["co_names"][ins.arg >> 1]]
+        elif op >= opcode.HAVE_ARGUMENT:
+            try:
+                handler = REGISTER_HANDLES[op]
+            except KeyError:
+                raise Exception(f"opcode [{op}]:{opcode.opname[op]} dont have converter.")
+            handler(ins, context, data)
+        tmpcode.append(ins)
+    return tmpcode
+
+
+def init_segment_args(instrs, context, inits):
+    """在函数的 RESUME 之后给被丢弃的参数赋默认值，inits 见 plan_signature"""
+    if not inits:
+        return instrs
+    for i, ins in enumerate(instrs):
+        if type(ins) is Instr and ins.op == opcode.opmap['RESUME']:
+            break
+    else:
+        i = -1
+    pos = instrs[i].pos if i >= 0 else NO_LOCATION
+    init = []
+    for name, kind, value in inits:
+        if kind == "dict":
+            init.append(Instr(opcode.opmap['BUILD_MAP'], 0, pos=pos))
+        else:
+            init.append(Instr(opcode.opmap['LOAD_CONST'], pool_const(context, value), pos=pos))
+        store = 'STORE_DEREF' if name in context['co_cellvars'] else 'STORE_FAST'
+        init.append(Instr(opcode.opmap[store], context['name_mapping_slot'][name], pos=pos))
+    return instrs[:i + 1] + init + instrs[i + 1:]
 
 
-def convert_co_names(opbytes, context, data):
-    """由于合并了co_names,全局变量读取的位置变更"""
-    arg = 0
-    op = opbytes[-2]
-    for i in range(-1, -len(opbytes), -2):
-        arg |= opbytes[i] << (abs(i) // 2 * 8)
+def guard_segment(instrs, slot, next_head):
+    """在函数的 RESUME 之后检查 slot 中的 enable flag，为假时跳过整个函数"""
+    for i, ins in enumerate(instrs):
+        if type(ins) is Instr and ins.op == opcode.opmap['RESUME']:
+            break
+    else:
+        i = -1
+    pos = instrs[i].pos if i >= 0 else NO_LOCATION
+    guard = [
+        Instr(opcode.opmap['LOAD_DEREF'], slot, pos=pos),
+        Instr(opcode.opmap['POP_JUMP_FORWARD_IF_FALSE'], 0, next_head, pos=pos),
+    ]
+    return instrs[:i + 1] + guard + instrs[i + 1:]
 
-    offset = len(context.get("co_names"))
-    arg += offset
 
+def chain_returns(instrs, next_head):
+    """把 RETURN_VALUE 替换为跳转到 next_head（下一个函数的开头），next_head 放在末尾"""
     res = []
-    if arg == 0:
-        res = [op, 0]
-    while arg > 0:
-        word = arg & 0xFF
-        arg = arg >> 8
-        if res:
-            res = [opcode.EXTENDED_ARG, word] + res
+    prev = None
+    for ins in instrs:
+        if type(ins) is Label:
+            res.append(ins)
+            prev = None
+            continue
+
+        if ins.op == opcode.opmap['RETURN_VALUE']:
+            if prev is not None and prev.op == opcode.opmap['LOAD_CONST']:
+                # The constant is dropped, replace LOAD_CONST by JUMP_FORWARD and RETURN_VALUE by NOP.
+                prev.op, prev.arg, prev.target = opcode.opmap['JUMP_FORWARD'], 0, next_head
+                ins.op = opcode.opmap['NOP']
+                res.append(ins)
+            else:
+                # Pop the return value, so every function starts with an empty stack.
+                ins.op = opcode.opmap['POP_TOP']
+                res.append(ins)
+                res.append(make_jump_forward(next_head, ins.exc, ins.pos))
         else:
-            res = [op, word]
-    return res, (len(res) - len(opbytes)) // 2
+            res.append(ins)
+        prev = ins
+    res.append(next_head)
+    return res
 
 
-def convert_co_renames(opbytes, context, data):
-    """由于合并了func_globals, co_names, 全局变量读取的位置变更，重命名"""
-    arg = 0
-    op = opbytes[-2]
-    for i in range(-1, -len(opbytes), -2):
-        arg |= opbytes[i] << (abs(i) // 2 * 8)
+def aggregate_returns(instrs, next_head, context, mode, end=None, index=None):
+    """按 mode 处理 RETURN_VALUE，next_head 放在末尾。
+    any/all: 结果为真/假时跳到 end 返回，否则丢弃，与 or/and 连接各函数的结果相同；
+    list/tuple: 结果保存到预先分配的结果列表的第 index 项"""
+    res = []
+    prev = None
+    for ins in instrs:
+        if type(ins) is Label:
+            res.append(ins)
+            prev = None
+            continue
+
+        if ins.op != opcode.opmap['RETURN_VALUE']:
+            res.append(ins)
+        elif mode in ("any", "all") and prev is not None and prev.op == opcode.opmap['LOAD_CONST']:
+            if bool(context["co_consts"][prev.arg]) == (mode == "any"):
+                res.append(ins)  # the constant decides the result, return it directly.
+            else:
+                # The constant is dropped, replace LOAD_CONST by JUMP_FORWARD and RETURN_VALUE by NOP.
+                prev.op, prev.arg, prev.target = opcode.opmap['JUMP_FORWARD'], 0, next_head
+                ins.op = opcode.opmap['NOP']
+                res.append(ins)
+        elif mode in ("any", "all"):
+            ins.op = opcode.opmap['JUMP_IF_TRUE_OR_POP' if mode == "any" else 'JUMP_IF_FALSE_OR_POP']
+            ins.target = end
+            res.append(ins)
+            res.append(make_jump_forward(next_head, ins.exc, ins.pos))
+        else:
+            # results[index] = value
+            ins.op, ins.arg = opcode.opmap['LOAD_FAST'], context['name_mapping_slot'][RESULTS_NAME]
+            res.append(ins)
+            res.append(Instr(opcode.opmap['LOAD_CONST'], pool_const(context, index), exc=ins.exc, pos=ins.pos))
+            res.append(Instr(opcode.opmap['STORE_SUBSCR'], exc=ins.exc, pos=ins.pos))
+            res.append(make_jump_forward(next_head, ins.exc, ins.pos))
+        prev = ins
+    res.append(next_head)
+    return res
 
-    offset = len(context.get("co_names"))
-    pushnull = arg & 0x01
-    if op == opcode.opmap["LOAD_GLOBAL"]:
-        namei = arg >> 1
-    else:
-        namei = arg
 
-    name = data["co_names"][namei]
-    if (
-        name in context.get("func_globals")
-        and name in data.get("func_globals")
-        and context.get("func_globals")[name] != data.get("func_globals")[name]
-    ):
-        # rename
-        newname = "%s_%s" % (name, data["idx"])
-        data.get("co_renames").append((name, newname))
-        offset = len(context.get("co_names")) + len(data.get("co_names")) + len(data.get("co_renames")) - 1
-        current = offset
-    else:
-        offset = len(context.get("co_names"))
-        current = namei + offset
+def isolate_handler(context, handler, idx, next_head, cleanup, free_slot, exit_code=()):
+    """isolate 模式下第 idx 个函数的异常处理：
+    except .catch as e: .error_hook(e, .segment_funcs[idx])，执行 exit_code，然后跳到下一个函数的开头"""
+    exc = (cleanup, 1, 1)
+    reraise = Label()
+    catch_slot, hook_slot, funcs_slot = free_slot, free_slot + 1, free_slot + 2
+
+    def instr(name, arg=0, target=None, exc=exc):
+        return Instr(opcode.opmap[name], arg, target, exc, NO_LOCATION)
+
+    return [
+        handler,
+        instr('PUSH_EXC_INFO'),
+        instr('LOAD_DEREF', catch_slot),
+        instr('CHECK_EXC_MATCH'),
+        instr('POP_JUMP_FORWARD_IF_FALSE', 0, reraise),
+        instr('PUSH_NULL'),
+        instr('LOAD_DEREF', hook_slot),
+        instr('COPY', 3),
+        instr('LOAD_DEREF', funcs_slot),
+        instr('LOAD_CONST', pool_const(context, idx)),
+        instr('BINARY_SUBSCR'),
+        instr('PRECALL', 2),
+        instr('CALL', 2),
+        instr('POP_TOP'),
+        instr('POP_TOP'),
+        instr('POP_EXCEPT', exc=None),
+        *exit_code,
+        instr('JUMP_FORWARD', 0, next_head, exc=None),
+        reraise,
+        instr('RERAISE', 0),
+    ]
+
+
+def profile_segment(instrs, context, idx, mode, slot):
+    """在函数的 RESUME 之后、每个 RETURN_VALUE 之前插入 profile 代码。
+    counters: calls[idx] += 1，记录 perf_counter_ns()，返回时 time_ns[idx] += perf_counter_ns() - start；
+    hooks: 调用 enter(idx), exit(idx)。抛出异常离开的函数不调用 exit，isolate 模式下由异常处理调用"""
+    res = []
+    entered = False
+    for ins in instrs:
+        if type(ins) is Instr and ins.op == opcode.opmap['RETURN_VALUE']:
+            res += profile_exit(context, idx, mode, slot, ins.exc, ins.pos)
+        res.append(ins)
+        if not entered and type(ins) is Instr and ins.op == opcode.opmap['RESUME']:
+            res += profile_enter(context, idx, mode, slot, ins.pos)
+            entered = True
+    if not entered:
+        res[0:0] = profile_enter(context, idx, mode, slot, NO_LOCATION)
+    return res
 
-    if op == opcode.opmap["LOAD_GLOBAL"]:
-        arg = (current << 1) | (0x01 if pushnull else 0x00)
-    else:
-        arg = current
 
-    res = []
-    if arg == 0:
-        res = [op, 0]
-    while arg > 0:
-        word = arg & 0xFF
-        arg = arg >> 8
-        if res:
-            res = [opcode.EXTENDED_ARG, word] + res
+def _profile_call(context, idx, hook_slot, exc, pos):
+    """hook(idx)，栈不变"""
+    return [
+        Instr(opcode.opmap['PUSH_NULL'], exc=exc, pos=pos),
+        Instr(opcode.opmap['LOAD_DEREF'], hook_slot, exc=exc, pos=pos),
+        Instr(opcode.opmap['LOAD_CONST'], pool_const(context, idx), exc=exc, pos=pos),
+        Instr(opcode.opmap['PRECALL'], 1, exc=exc, pos=pos),
+        Instr(opcode.opmap['CALL'], 1, exc=exc, pos=pos),
+        Instr(opcode.opmap['POP_TOP'], exc=exc, pos=pos),
+    ]
+
+
+def _profile_add(context, idx, list_slot, value, exc, pos):
+    """list[idx] += value，value 为计算增量的指令，栈不变"""
+    def instr(name, arg=0):
+        return Instr(opcode.opmap[name], arg, exc=exc, pos=pos)
+    return [
+        instr('LOAD_DEREF', list_slot),
+        instr('LOAD_CONST', pool_const(context, idx)),
+        instr('COPY', 2),
+        instr('COPY', 2),
+        instr('BINARY_SUBSCR'),
+        *value,
+        instr('BINARY_OP', NB_INPLACE_ADD),
+        # list, idx, new value -> new value, list, idx for STORE_SUBSCR.
+        instr('SWAP', 3),
+        instr('SWAP', 2),
+        instr('STORE_SUBSCR'),
+    ]
+
+
+def _perf_counter_ns(slot, exc, pos):
+    return [
+        Instr(opcode.opmap['PUSH_NULL'], exc=exc, pos=pos),
+        Instr(opcode.opmap['LOAD_DEREF'], slot, exc=exc, pos=pos),
+        Instr(opcode.opmap['PRECALL'], 0, exc=exc, pos=pos),
+        Instr(opcode.opmap['CALL'], 0, exc=exc, pos=pos),
+    ]
+
+
+def profile_enter(context, idx, mode, slot, pos):
+    if mode == "hooks":
+        return _profile_call(context, idx, slot, None, pos)
+    calls_slot, clock_slot = slot, slot + 2
+    one = [Instr(opcode.opmap['LOAD_CONST'], pool_const(context, 1), pos=pos)]
+    return _profile_add(context, idx, calls_slot, one, None, pos) + _perf_counter_ns(clock_slot, None, pos) + [
+        Instr(opcode.opmap['STORE_FAST'], context['name_mapping_slot'][PROFILE_START_NAME], pos=pos),
+    ]
+
+
+def profile_exit(context, idx, mode, slot, exc, pos):
+    if mode == "hooks":
+        return _profile_call(context, idx, slot + 1, exc, pos)
+    time_slot, clock_slot = slot + 1, slot + 2
+    elapsed = _perf_counter_ns(clock_slot, exc, pos) + [
+        Instr(opcode.opmap['LOAD_FAST'], context['name_mapping_slot'][PROFILE_START_NAME], exc=exc, pos=pos),
+        Instr(opcode.opmap['BINARY_OP'], NB_SUBTRACT, exc=exc, pos=pos),
+    ]
+    return _profile_add(context, idx, time_slot, elapsed, exc, pos)
+
+
+def default_error_hook(exc, func):
+    """isolate 模式下默认的 error hook，打印异常，继续执行下一个函数"""
+    print(f"Exception in merged function {func.__module__}.{func.__qualname__}:", file=sys.stderr)
+    traceback.print_exception(exc)
+
+
+def link_merged(code, funcs, plan, error_hook=None, profile_hooks=None):
+    """用合并后的 code 和原函数的 __globals__, __defaults__, plan 中合并后的 closure 生成函数"""
+    func_defaults = []
+    for func in funcs:
+        if func.__defaults__:
+            func_defaults.extend(func.__defaults__)
+    func_closure = list(plan["closure"])
+    # free variables added by merge_code.
+    for name in code.co_freevars[len(func_closure):]:
+        if name == ISOLATE_NAMES[0]:
+            value = Exception
+        elif name == ISOLATE_NAMES[1]:
+            value = error_hook or default_error_hook
+        elif name == ISOLATE_NAMES[2]:
+            value = tuple(funcs)
+        elif name in PROFILE_COUNTER_NAMES[:2]:
+            value = [0] * len(funcs)  # calls, time_ns of each function
+        elif name == PROFILE_COUNTER_NAMES[2]:
+            value = time.perf_counter_ns
+        elif name in PROFILE_HOOK_NAMES:
+            if profile_hooks is None:
+                raise ValueError("profile hooks mode needs profile_hooks=(enter, exit)")
+            value = profile_hooks[PROFILE_HOOK_NAMES.index(name)]
         else:
-            res = [op, word]
+            value = True  # enable flag
+        func_closure.append(types.CellType(value))
+    if "signature" in plan:
+        func_defaults = plan["defaults"] or ()
+    func = types.FunctionType(
+        code,  # code object
+        plan["func_globals"],  # __globals__
+        code.co_name,  # __name__
+        tuple(func_defaults),  # __default__
+        tuple(func_closure),  # __closure__
+    )
+    if plan.get("kwdefaults"):
+        func.__kwdefaults__ = dict(plan["kwdefaults"])
+    return func
 
-    return res, (len(res) - len(opbytes)) // 2
 
+def merge_func(func_name, funcs, def_argcount=None, debug=1, merged_firstlineno=0, pooled=False, share_globals=True,
+               optimize=False, hoist_globals=False, guards=False, returns="last", isolate=False, error_hook=None,
+               signature=None, arg_maps=None, profile=None, profile_hooks=None, verify=True):
+    plan = plan_merge(
+        funcs, share_globals=share_globals, hoist_globals=hoist_globals, signature=signature, arg_maps=arg_maps,
+    )
+    code = merge_code(
+        func_name, [func.__code__ for func in funcs], plan, def_argcount=def_argcount, debug=debug,
+        merged_firstlineno=merged_firstlineno, pooled=pooled, optimize=optimize, guards=guards, returns=returns,
+        isolate=isolate, profile=profile, verify=verify,
+    )
+    return link_merged(code, funcs, plan, error_hook=error_hook, profile_hooks=profile_hooks)
 
-def convert_co_consts(opbytes, context, data):
-    """由于合并了co_consts,常量读取的位置变更"""
-    arg = 0
-    op = opbytes[-2]
-    for i in range(-1, -len(opbytes), -2):
-        arg |= opbytes[i] << (abs(i) // 2 * 8)
 
-    offset = len(context.get("co_consts"))
-    arg += offset
+def segment_flags(func):
+    """guards 模式下每个函数的 enable flag，为 cell 的列表。修改 cell_contents 即可开关对应的函数"""
+    code = func.__code__
+    return [
+        cell for name, cell in zip(code.co_freevars, func.__closure__ or ())
+        if name.startswith(GUARD_PREFIX)
+    ]
 
-    res = []
-    if arg == 0:
-        res = [op, 0]
-    while arg > 0:
-        word = arg & 0xFF
-        arg = arg >> 8
-        if res:
-            res = [opcode.EXTENDED_ARG, word] + res
-        else:
-            res = [op, word]
-    return res, (len(res) - len(opbytes)) // 2
 
+def set_segment_enabled(func, idx, enabled):
+    """开关 guards 模式合并的第 idx 个函数，不需要重新合并"""
+    segment_flags(func)[idx].cell_contents = bool(enabled)
 
-def convert_varnames(opbytes, context, data):
-    """由于合并了co_varnames,局部变量读取的位置变更"""
-    arg = 0
-    op = opbytes[-2]
-    for i in range(-1, -len(opbytes), -2):
-        arg |= opbytes[i] << (abs(i) // 2 * 8)
 
-    name = data['co_varnames'][arg]
-    if name in context['co_cellvars']:
-        op = FAST_2_DEREF[op]
-        arg = context['name_mapping_slot'][name]
+def set_error_hook(func, error_hook):
+    """替换 isolate 模式合并的函数的 error hook，error_hook(exc, func)"""
+    code = func.__code__
+    cell = func.__closure__[code.co_freevars.index(ISOLATE_NAMES[1])]
+    cell.cell_contents = error_hook or default_error_hook
+
+
+def _profile_cells(func):
+    code = func.__code__
+    cells = dict(zip(code.co_freevars, func.__closure__ or ()))
+    return [cells[name] for name in PROFILE_COUNTER_NAMES[:2]]
+
+
+def profile_stats(func):
+    """counters 模式合并的函数中每个函数的 (调用次数, 耗时 ns) 列表"""
+    calls, time_ns = _profile_cells(func)
+    return list(zip(calls.cell_contents, time_ns.cell_contents))
+
+
+def reset_profile_stats(func):
+    """清零 counters 模式的统计"""
+    for cell in _profile_cells(func):
+        lst = cell.cell_contents
+        lst[:] = [0] * len(lst)
+
+
+def set_profile_hooks(func, enter, exit):
+    """替换 hooks 模式合并的函数的 enter(idx), exit(idx)"""
+    code = func.__code__
+    for name, hook in zip(PROFILE_HOOK_NAMES, (enter, exit)):
+        func.__closure__[code.co_freevars.index(name)].cell_contents = hook
+
+
+def segment_table(code):
+    """merge_code 记录的 side table (ranges, infos)，不是合并的 code 时返回 None。
+    ranges 为 ((start, end, idx), )，字节偏移；infos[idx] 为原函数的 (qualname, filename, firstlineno)"""
+    consts = code.co_consts
+    if consts and type(consts[-1]) is tuple and len(consts[-1]) == 3 and consts[-1][0] == SEGMENT_TABLE_TAG:
+        return consts[-1][1], consts[-1][2]
+    return None
+
+
+@functools.lru_cache(maxsize=MERGE_CACHE_MAXSIZE)
+def _code_lines(code):
+    """每个 code unit 的行号"""
+    return tuple(pos[0] for pos in code.co_positions())
+
+
+def resolve_lasti(code, lasti):
+    """合并后 code 的字节偏移 lasti（frame.f_lasti, tb_lasti）对应的 (idx, qualname, filename, lineno)。
+    不是合并的 code 时 idx 为 None，其余为 code 自己的；lasti 在合并时生成的指令上时 idx 为 None"""
+    lines = _code_lines(code)
+    lineno = lines[lasti // 2] if 0 <= lasti // 2 < len(lines) else None
+    table = segment_table(code)
+    if table is not None:
+        ranges, infos = table
+        i = bisect.bisect_right(ranges, (lasti, float("inf"))) - 1
+        if i >= 0 and ranges[i][0] <= lasti < ranges[i][1]:
+            qualname, filename, _ = infos[ranges[i][2]]
+            return ranges[i][2], qualname, filename, lineno
+    return None, code.co_qualname, code.co_filename, lineno
+
+
+def resolve_frame(frame):
+    """栈帧当前执行的原函数 (idx, qualname, filename, lineno)，采样 profiler 使用"""
+    return resolve_lasti(frame.f_code, frame.f_lasti)
+
+
+def extract_merged_tb(tb, limit=None):
+    """与 traceback.extract_tb 相同，合并函数的栈帧换成原函数的名字和文件名"""
+    frames = traceback.StackSummary()
+    while tb is not None and (limit is None or len(frames) < limit):
+        code = tb.tb_frame.f_code
+        _, qualname, filename, lineno = resolve_lasti(code, tb.tb_lasti)
+        frames.append(traceback.FrameSummary(filename, tb.tb_lineno if lineno is None else lineno, qualname))
+        tb = tb.tb_next
+    return frames
+
+
+# merge cache: key -> [funcs, members, func_generated], in LRU order.
+_merge_cache = collections.OrderedDict()
+# id(func) -> set of cache keys which contain the func, to find entries made stale by hot reload.
+_merge_cache_members = dict()
+
+
+def _merge_members(func):
+    """合并函数时用到的 func 的属性，__code__, __defaults__, __kwdefaults__ 可以被重新赋值"""
+    return func.__code__, func.__globals__, func.__closure__, func.__defaults__, func.__kwdefaults__
+
+
+def _merge_cache_key(func_name, funcs, def_argcount, merged_firstlineno, options):
+    # The entry holds the member objects, so these ids can not be reused while the entry is alive;
+    # a hit still checks them with `is`.
+    members = tuple(tuple(id(obj) for obj in _merge_members(f)) for f in funcs)
+    options = tuple((k, _freeze_option(v)) for k, v in sorted(options.items()))
+    return (func_name, def_argcount, merged_firstlineno, members, options)
+
+
+def _merge_cache_fresh(entry):
+    """缓存的各个函数的属性都没有被替换"""
+    return all(
+        all(a is b for a, b in zip(_merge_members(f), members))
+        for f, members in zip(entry[0], entry[1])
+    )
+
+
+def _freeze_option(value):
+    """arg_maps 等 list, dict 参数转换为可以 hash 的 tuple"""
+    if isinstance(value, dict):
+        return tuple((k, _freeze_option(v)) for k, v in sorted(value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze_option(v) for v in value)
+    return value
+
+
+def _merge_cache_remove(key):
+    entry = _merge_cache.pop(key, None)
+    if entry is None:
+        return
+    for f in entry[0]:
+        keys = _merge_cache_members.get(id(f))
+        if keys is None:
+            continue
+        keys.discard(key)
+        if not keys:
+            del _merge_cache_members[id(f)]
+
+
+def _merge_cache_drop_stale(func):
+    """删除 func 的 __code__ 被替换（热更新）或者默认参数被重新赋值后失效的缓存"""
+    keys = _merge_cache_members.get(id(func))
+    if not keys:
+        return
+    for key in list(keys):
+        if not _merge_cache_fresh(_merge_cache[key]):
+            _merge_cache_remove(key)
+
+
+def merge_func_cached(func_name, funcs, def_argcount=None, debug=1, merged_firstlineno=0, **options):
+    """带 LRU 缓存的 merge_func。以 __code__, __globals__, __closure__, __defaults__, __kwdefaults__ 的身份为 key，
+    复用已生成的合并函数。options 为 merge_func 的其他参数，也是 key 的一部分"""
+    key = _merge_cache_key(func_name, funcs, def_argcount, merged_firstlineno, options)
+    entry = _merge_cache.get(key)
+    if entry is not None:
+        if _merge_cache_fresh(entry):
+            _merge_cache.move_to_end(key)
+            return entry[2]
+        _merge_cache_remove(key)
+
+    for f in funcs:
+        _merge_cache_drop_stale(f)
+
+    func_generated = merge_func(
+        func_name, funcs, def_argcount=def_argcount, debug=debug, merged_firstlineno=merged_firstlineno, **options
+    )
+    funcs = tuple(funcs)
+    _merge_cache[key] = [funcs, tuple(_merge_members(f) for f in funcs), func_generated]
+    for f in funcs:
+        _merge_cache_members.setdefault(id(f), set()).add(key)
+
+    while len(_merge_cache) > MERGE_CACHE_MAXSIZE:
+        _merge_cache_remove(next(iter(_merge_cache)))
+    return func_generated
+
+
+def invalidate_merge_cache(func=None):
+    """删除包含 func 的缓存，func 为 None 时清空缓存"""
+    if func is None:
+        _merge_cache.clear()
+        _merge_cache_members.clear()
+        return
+    for key in list(_merge_cache_members.get(id(func), ())):
+        _merge_cache_remove(key)
+
+
+def _const_key(value):
+    """常量的 pool key。类型不同的常量不共用，1, 1.0, True 和 0.0, -0.0 都是不同的常量"""
+    t = type(value)
+    if t is tuple:
+        return t, tuple(_const_key(v) for v in value)
+    if t is frozenset:
+        return t, frozenset(_const_key(v) for v in value)
+    if t is float or t is complex:
+        return t, value, repr(value)
+    if t in (int, bool, str, bytes, type(None), type(Ellipsis)):
+        return t, value
+    return t, id(value)  # code objects etc.
+
+
+def pool_const(context, value):
+    """value 在合并后 co_consts 中的位置，pooled 模式下复用同类型同值的常量"""
+    if context["pooled"]:
+        key = _const_key(value)
+        i = context["const_pool"].get(key)
+        if i is not None:
+            return i
+        context["const_pool"][key] = len(context["co_consts"])
+    context["co_consts"].append(value)
+    return len(context["co_consts"]) - 1
+
+
+def pool_name(context, name):
+    """name 在合并后 co_names 中的位置，pooled 模式下相同的名字只保留一个"""
+    if context["pooled"]:
+        i = context["name_pool"].get(name)
+        if i is not None:
+            return i
+        name = sys.intern(name)
+        context["name_pool"][name] = len(context["co_names"])
+    context["co_names"].append(name)
+    return len(context["co_names"]) - 1
+
+
+def convert_co_names(ins, context, data):
+    """由于合并了co_names,全局变量读取的位置变更"""
+    if context["pooled"]:
+        ins.arg = pool_name(context, data["co_names"][ins.arg])
     else:
-        arg = context.get("co_varnames").index(name)
+        ins.arg += data["names_offset"]
 
-    res = []
-    if arg == 0:
-        res = [op, 0]
-    while arg > 0:
-        word = arg & 0xFF
-        arg = arg >> 8
-        if res:
-            res = [opcode.EXTENDED_ARG, word] + res
-        else:
-            res = [op, word]
-    return res, (len(res) - len(opbytes)) // 2
 
+def convert_co_renames(ins, context, data):
+    """由于合并了func_globals, co_names, 全局变量读取的位置变更，重命名"""
+    arg = ins.arg
+    pushnull = arg & 0x01
+    if ins.op == opcode.opmap["LOAD_GLOBAL"]:
+        namei = arg >> 1
+    else:
+        namei = arg
+
+    name = data["co_names"][namei]
+    newname = data["renames"].get(name)
+    if newname is not None:
+        current = data["rename_slots"].get(newname)
+        if current is None:
+            current = data["rename_slots"][newname] = pool_name(context, newname)
+    elif context["pooled"]:
+        current = pool_name(context, name)
+    else:
+        current = namei + data["names_offset"]
 
-def convert_closure(opbytes, context, data):
-    """由于合并了 co_cellvars，cell index 需要变更"""
-    arg = 0
-    op = opbytes[-2]
-    for i in range(-1, -len(opbytes), -2):
-        arg |= opbytes[i] << (abs(i) // 2 * 8)
+    if ins.op == opcode.opmap["LOAD_GLOBAL"]:
+        ins.arg = (current << 1) | (0x01 if pushnull else 0x00)
+    else:
+        ins.arg = current
 
-    name = data['slot_mapping_name'][arg]
-    arg = context['name_mapping_slot'][name]
 
-    res = []
-    if arg == 0:
-        res = [op, 0]
-    while arg > 0:
-        word = arg & 0xFF
-        arg = arg >> 8
-        if res:
-            res = [opcode.EXTENDED_ARG, word] + res
-        else:
-            res = [op, word]
+def convert_co_consts(ins, context, data):
+    """由于合并了co_consts,常量读取的位置变更"""
+    if context["pooled"]:
+        ins.arg = pool_const(context, data["co_consts"][ins.arg])
+    else:
+        ins.arg += data["consts_offset"]
+
+
+def convert_varnames(ins, context, data):
+    """由于合并了co_varnames,局部变量读取的位置变更"""
+    name = data['co_varnames'][ins.arg]
+    if name in context['co_cellvars']:
+        ins.op = FAST_2_DEREF[ins.op]
+    ins.arg = context['name_mapping_slot'][name]
+
 
-    return res, (len(res) - len(opbytes)) // 2
+def convert_closure(ins, context, data):
+    """由于合并了 co_cellvars，cell index 需要变更。free variable 按 free_map 换算到合并后的位置"""
+    nlocals = len(data['slot_mapping_name'])
+    if ins.arg >= nlocals:
+        ins.arg = context['free_offset'] + data['free_map'][ins.arg - nlocals]
+        return
+    name = data['slot_mapping_name'][ins.arg]
+    ins.arg = context['name_mapping_slot'][name]
 
 
-def convert_default(opbytes, context, data):
+def convert_default(ins, context, data):
     """参数不做任何变化"""
-    return opbytes, 0
 
 
-def convert_nop(opbytes, context, data):
+def convert_nop(ins, context, data):
     """全部替换为NOP"""
-    for i in range(0, len(opbytes), 2):
-        opbytes[i] = opcode.opmap['NOP']
-        opbytes[i + 1] = 0
-    return opbytes, 0
+    ins.op = opcode.opmap['NOP']
+    ins.arg = 0
 
 
-def make_jump_forward(delta):
-    op = opcode.opmap["JUMP_FORWARD"]
-    arg = delta
-    res = []
-    if arg == 0:
-        res = [op, 0]
-    while arg > 0:
-        word = arg & 0xFF
-        arg >>= 8
-        if res:
-            res = [opcode.EXTENDED_ARG, word] + res
-        else:
-            res = [op, word]
-    return res
+def make_jump_forward(target, exc=None, pos=None):
+    return Instr(opcode.opmap["JUMP_FORWARD"], 0, target, exc, pos)
 
 
 REGISTER_HANDLES = {
@@ -656,7 +1955,7 @@ REGISTER_HANDLES = {
     opcode.opmap["STORE_DEREF"]: convert_closure,
     opcode.opmap["DELETE_DEREF"]: convert_closure,
     opcode.opmap["LOAD_CLASSDEREF"]: convert_closure,
-    opcode.opmap["COPY_FREE_VARS"]: convert_closure,
+    opcode.opmap["COPY_FREE_VARS"]: convert_nop,  # COPY_FREE_VARS 提前到最前，复制所有的 free variables
 }
 
 
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""合并函数的随机差分测试。
+
+    python merge_fuzz.py --trials 500 --seed 1
+
+随机生成回调的函数体（分支、循环、try/except/finally、with、闭包、推导式、提前返回、异常），
+随机组合合并选项，比较合并后的函数与依次调用原函数的日志、返回值、异常。
+除了 merge_func（随机关闭 guards 的函数、signature/arg_maps、share_globals、共享的闭包 cell），
+还测试 MergeBuilder 的 append/remove 和 flatten_super/flatten_hierarchy 的随机继承链。
+verify 默认打开，verify_code 失败也算作不一致。有不一致时打印种子、选项和源码，返回 1。
+"""
+
+import sys
+import json
+import random
+import argparse
+import contextlib
+
+from merge_fun import merge_func, set_segment_enabled, MergeVerifyError
+from merge_group import call_sequential
+from merge_incremental import MergeBuilder
+from merge_super import flatten_super, flatten_hierarchy
+
+LOG = []
+
+# locals every generated callback initializes first, so they are never unbound.
+LOCALS = ("v0", "v1", "v2")
+
+# merge_func options tried by the harness, one value is picked for each.
+OPTION_CHOICES = {
+    "optimize": (False, True),
+    "pooled": (False, True),
+    "guards": (False, True),
+    "hoist_globals": (False, True),
+    "isolate": (False, True),
+    "returns": ("last", "list", "tuple", "any", "all"),
+    "profile": (None, "counters"),
+    "share_globals": (True, False),
+    "signature": (None, "self, dt, ctx=None", "self, delta"),
+}
+
+# MergeBuilder options tried by the harness.
+BUILDER_CHOICES = {
+    "optimize": (False, True),
+    "pooled": (False, True),
+    "share_globals": (True, False),
+}
+
+# flatten_super options tried by the harness.
+SUPER_CHOICES = {
+    "optimize": (False, True),
+    "pooled": (False, True),
+}
+
+# super() calls inserted into the subclass methods of a chain.
+SUPER_CALLS = ("super().cb(dt + 1)", "v0 = super().cb(dt)", "log('s', super().cb(dt, k=2))")
+
+DTS = (0, 1, 2, 3)
+
+
+def log(*args):
+    LOG.append(args)
+
+
+class Entity(object):
+    def __init__(self):
+        self.a = 1
+        self.items = [1, 2, 3]
+
+
+class Generator(object):
+    """生成一个模块的源码，其中的函数 cb_0 .. cb_{n-1} 签名都为 (self, dt)"""
+
+    def __init__(self, rnd, nested=False):
+        self.rnd = rnd
+        self.tag = 0
+        self.nested = nested  # functions are made by make(k), k is a cell shared by all of them
+
+    def expr(self, depth=0):
+        rnd = self.rnd
+        choices = ["dt", "self.a", "len(self.items)", rnd.choice(LOCALS), str(rnd.randint(-3, 9)), "G"]
+        if self.nested:
+            choices.append("k")
+        if depth < 2:
+            choices += ["binop", "call", "cond"]
+        kind = rnd.choice(choices)
+        if kind == "binop":
+            return f"({self.expr(depth + 1)} {rnd.choice('+-*')} {self.expr(depth + 1)})"
+        if kind == "call":
+            return f"{rnd.choice(('min', 'max'))}({self.expr(depth + 1)}, {self.expr(depth + 1)})"
+        if kind == "cond":
+            return f"({self.expr(depth + 1)} if {self.cond()} else {self.expr(depth + 1)})"
+        return kind
+
+    def cond(self):
+        return f"{self.expr(2)} {self.rnd.choice(('<', '>', '==', '!='))} {self.expr(2)}"
+
+    def log_stmt(self):
+        self.tag += 1
+        return f"log({self.tag}, {self.expr()})"
+
+    def block(self, indent, depth, in_loop, in_finally=False):
+        lines = []
+        for _ in range(self.rnd.randint(1, 3)):
+            lines += self.stmt(indent, depth, in_loop, in_finally)
+        return lines
+
+    def stmt(self, indent, depth, in_loop, in_finally):
+        rnd = self.rnd
+        pad = "    " * indent
+        kinds = ["log", "assign", "attr", "closure", "comprehension", "fstring"]
+        if self.nested:
+            kinds.append("nonlocal")
+        if depth < 3:
+            kinds += ["if", "for", "while", "try", "with"]
+        if not in_finally:
+            kinds += ["return", "raise"]
+        if in_loop:
+            kinds += ["break", "continue"]
+        kind = rnd.choice(kinds)
+        if kind == "log":
+            return [pad + self.log_stmt()]
+        if kind == "assign":
+            return [f"{pad}{rnd.choice(LOCALS)} = {self.expr()}"]
+        if kind == "attr":
+            return [f"{pad}self.a = {self.expr()}"]
+        if kind == "nonlocal":
+            return [f"{pad}k = {self.expr()}"]
+        if kind == "closure":
+            name = rnd.choice(LOCALS)
+            return [f"{pad}g = lambda k=1: {name} * k + dt", f"{pad}{self.log_stmt()[:-1]} + g())"]
+        if kind == "comprehension":
+            return [f"{pad}log('c', [x * {rnd.choice(LOCALS)} for x in self.items if x != dt])"]
+        if kind == "fstring":
+            return [f"{pad}log('f', f'{{dt}}-{{{rnd.choice(LOCALS)}}}')"]
+        if kind == "if":
+            lines = [f"{pad}if {self.cond()}:"] + self.block(indent + 1, depth + 1, in_loop, in_finally)
+            if rnd.random() < 0.5:
+                lines += [f"{pad}else:"] + self.block(indent + 1, depth + 1, in_loop, in_finally)
+            return lines
+        if kind == "for":
+            return [f"{pad}for i{depth} in range({rnd.randint(0, 3)}):"] + \
+                self.block(indent + 1, depth + 1, True, in_finally)
+        if kind == "while":
+            counter = f"w{depth}"
+            return [f"{pad}{counter} = 0", f"{pad}while {counter} < 3:", f"{pad}    {counter} += 1"] + \
+                self.block(indent + 1, depth + 1, True, in_finally)
+        if kind == "try":
+            lines = [f"{pad}try:"] + self.block(indent + 1, depth + 1, in_loop, in_finally)
+            lines += [f"{pad}except ZeroDivisionError as e:", f"{pad}    log('zde', str(e))"]
+            if rnd.random() < 0.5:
+                lines += self.block(indent + 1, depth + 1, in_loop, in_finally)
+            if rnd.random() < 0.5:
+                lines += [f"{pad}finally:"] + self.block(indent + 1, depth + 1, False, True)
+            return lines
+        if kind == "with":
+            return [f"{pad}with contextlib.nullcontext({self.expr()}) as cm{depth}:"] + \
+                self.block(indent + 1, depth + 1, in_loop, in_finally)
+        if kind == "return":
+            return [f"{pad}if {self.cond()}:", f"{pad}    return {self.expr()}"]
+        if kind == "raise":
+            return [f"{pad}if dt == {rnd.randint(0, 4)}:", f"{pad}    {self.expr()} // 0"]
+        return [f"{pad}if {self.cond()}:", f"{pad}    {kind}"]
+
+    def function(self, idx):
+        lines = [f"def cb_{idx}(self, dt):"]
+        if self.nested:
+            lines.append("    nonlocal k")
+        lines += [f"    {name} = {self.rnd.randint(0, 3)}" for name in LOCALS]
+        lines += self.block(1, 0, False)
+        if self.rnd.random() < 0.7:
+            lines.append(f"    return {self.expr()}")
+        return lines
+
+    def module(self, n):
+        lines = []
+        for idx in range(n):
+            lines += self.function(idx)
+        if self.nested:
+            names = ", ".join(f"cb_{idx}" for idx in range(n))
+            lines = ["def make(k):"] + ["    " + line for line in lines] + [f"    return [{names}]"]
+        return "\n".join(lines) + "\n"
+
+    def hierarchy(self, depth):
+        """生成继承链 L0 .. L{depth-1} 的源码，方法 cb(self, dt, k=1)，子类的 cb 在随机位置调用 super().cb"""
+        lines = []
+        for level in range(depth):
+            body = self.function(0)[1:]
+            if level:
+                # a statement of the function body, after the locals are initialized.
+                starts = [
+                    i for i, line in enumerate(body)
+                    if i >= len(LOCALS) and not line.startswith("     ")
+                    and not line.strip().startswith(("else", "except", "finally"))
+                ]
+                body.insert(self.rnd.choice(starts + [len(body)]), "    " + self.rnd.choice(SUPER_CALLS))
+            lines.append(f"class L{level}({f'L{level - 1}' if level else 'Entity'}):")
+            lines.append("    def cb(self, dt, k=1):")
+            lines += ["    " + line for line in body]
+        return "\n".join(lines) + "\n"
+
+
+def build_namespace(source):
+    namespace = {"log": log, "contextlib": contextlib, "G": 5, "Entity": Entity}
+    exec(compile(source, "<fuzz>", "exec"), namespace)
+    return namespace
+
+
+def build_funcs(source):
+    namespace = build_namespace(source)
+    if "make" in namespace:
+        return namespace["make"](1)
+    return [namespace[f"cb_{idx}"] for idx in range(sum(1 for k in namespace if k.startswith("cb_")))]
+
+
+def cell_resetter(funcs):
+    """返回一个函数，把 funcs 的闭包 cell 恢复为现在的值，每次调用前恢复，nonlocal 的修改不影响下一次"""
+    cells = {}
+    for func in funcs:
+        for cell in func.__closure__ or ():
+            cells[id(cell)] = (cell, cell.cell_contents)
+
+    def reset():
+        for cell, value in cells.values():
+            cell.cell_contents = value
+    return reset
+
+
+def observe(func, dt, reset=None, cls=Entity):
+    """调用 func，返回 (日志, 返回值或异常类型)"""
+    if reset is not None:
+        reset()
+    LOG.clear()
+    try:
+        result = ("ok", func(cls(), dt))
+    except Exception as e:
+        result = ("raise", type(e).__name__)
+    return list(LOG), result
+
+
+def error_hook(exc, func):
+    LOG.append(("error", type(exc).__name__))
+
+
+def skipped_func(returns):
+    """guards 关闭的函数在 call_sequential 中的替代：不执行，也不决定 any/all 的结果"""
+    default = True if returns == "all" else None
+
+    def skipped(self, dt):
+        return default
+    return skipped
+
+
+def random_arg_maps(rnd, signature, funcs):
+    if signature == "self, delta":
+        return [{"dt": "delta"} for _ in funcs]
+    if signature is not None:
+        # dt of some functions is dropped, a local initialized to None.
+        return [{"dt": None} if rnd.random() < 0.2 else None for _ in funcs]
+    return None
+
+
+def compare(reference, merged, reset, info, cls=Entity):
+    """比较 reference 与 merged 对每个 dt 的结果，不一致时返回加上了结果的 info"""
+    for dt in DTS:
+        expected = observe(reference, dt, reset, cls)
+        actual = observe(merged, dt, reset, cls)
+        if expected != actual:
+            return dict(info, dt=dt, expected=repr(expected), actual=repr(actual))
+    return None
+
+
+def merge_trial(rnd, fixed_options=None):
+    """merge_func 与依次调用比较"""
+    source = Generator(rnd, nested=rnd.random() < 0.3).module(rnd.randint(1, 6))
+    pool = build_funcs(source)
+    reset = cell_resetter(pool)
+    funcs = [rnd.choice(pool) for _ in range(rnd.randint(1, 8))]
+    options = {name: rnd.choice(values) for name, values in OPTION_CHOICES.items()}
+    options.update(fixed_options or {})
+    options["arg_maps"] = random_arg_maps(rnd, options["signature"], funcs)
+    info = {"kind": "merge", "options": options, "funcs": [f.__name__ for f in funcs], "source": source}
+    try:
+        merged = merge_func("fuzz", funcs, error_hook=error_hook, **options)
+    except MergeVerifyError as e:
+        return dict(info, error=str(e))
+    calls = list(funcs)
+    if options["guards"]:
+        disabled = [idx for idx in range(len(funcs)) if rnd.random() < 0.3]
+        for idx in disabled:
+            set_segment_enabled(merged, idx, False)
+            calls[idx] = skipped_func(options["returns"])
+        info["disabled"] = disabled
+    reference = call_sequential(
+        calls, options["returns"], options["isolate"], error_hook, options["signature"], options["arg_maps"],
+    )
+    return compare(reference, merged, reset, info)
+
+
+def builder_trial(rnd, fixed_options=None):
+    """MergeBuilder 随机 append/remove，每一步与依次调用比较"""
+    source = Generator(rnd, nested=rnd.random() < 0.3).module(rnd.randint(1, 6))
+    pool = build_funcs(source)
+    reset = cell_resetter(pool)
+    options = {name: rnd.choice(values) for name, values in BUILDER_CHOICES.items()}
+    options.update(fixed_options or {})
+    info = {"kind": "builder", "options": options, "steps": [], "source": source}
+    builder = MergeBuilder("fuzz", **options)
+    for _ in range(rnd.randint(1, 8)):
+        if len(builder) > 1 and rnd.random() < 0.3:
+            func = rnd.choice(builder.funcs)
+            builder.remove(func)
+            info["steps"].append("-" + func.__name__)
+        else:
+            func = rnd.choice(pool)
+            builder.append(func)
+            info["steps"].append("+" + func.__name__)
+        try:
+            merged = builder.build()
+        except MergeVerifyError as e:
+            return dict(info, error=str(e))
+        failure = compare(call_sequential(builder.funcs), merged, reset, info)
+        if failure is not None:
+            return failure
+    return None
+
+
+def super_trial(rnd, fixed_options=None):
+    """随机继承链的 flatten_super 或 flatten_hierarchy 与原来的 super 调用比较"""
+    depth = rnd.randint(2, 5)
+    source = Generator(rnd).hierarchy(depth)
+    namespace = build_namespace(source)
+    classes = [namespace[f"L{level}"] for level in range(depth)]
+    options = {name: rnd.choice(values) for name, values in SUPER_CHOICES.items()}
+    options.update(fixed_options or {})
+    hierarchy = rnd.random() < 0.5
+    info = {"kind": "hierarchy" if hierarchy else "super", "options": options, "source": source}
+    originals = [cls.__dict__["cb"] for cls in classes]
+    try:
+        if hierarchy:
+            flatten_hierarchy(classes[0], "cb", **options)
+        else:
+            flat = flatten_super(classes[-1], "cb", **options)
+            if flat is not None:
+                classes[-1].cb = flat
+    except MergeVerifyError as e:
+        return dict(info, error=str(e))
+
+    def with_originals(*args):
+        # super() of the reference calls the original parents, not the flattened ones.
+        current = [cls.__dict__["cb"] for cls in classes]
+        for cls, func in zip(classes, originals):
+            cls.cb = func
+        try:
+            return original(*args)
+        finally:
+            for cls, func in zip(classes, current):
+                cls.cb = func
+
+    for cls, original in zip(classes, originals):
+        merged = cls.__dict__["cb"]
+        if merged is original:
+            continue
+        failure = compare(with_originals, merged, None, dict(info, cls=cls.__name__), cls)
+        if failure is not None:
+            return failure
+    return None
+
+
+# kind of trial -> (test function, weight)
+TRIALS = {
+    "merge": (merge_trial, 6),
+    "builder": (builder_trial, 2),
+    "super": (super_trial, 2),
+}
+
+
+def run_trial(rnd, fixed_options=None, kind=None):
+    """一次测试，返回不一致的描述，没有时返回 None。kind 为 TRIALS 中的一种，None 时随机选择"""
+    if kind is None:
+        kind = rnd.choices(list(TRIALS), [weight for _, weight in TRIALS.values()])[0]
+    return TRIALS[kind][0](rnd, fixed_options)
+
+
+def run(trials, seed, fixed_options=None, max_failures=5, kind=None):
+    failures = []
+    for trial in range(trials):
+        rnd = random.Random(f"{seed}-{trial}")
+        failure = run_trial(rnd, fixed_options, kind)
+        if failure is not None:
+            failure["seed"], failure["trial"] = seed, trial
+            failures.append(failure)
+            if len(failures) >= max_failures:
+                break
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="randomized differential test of merged functions")
+    parser.add_argument("--trials", type=int, default=300)
+    parser.add_argument("--seed", default="0")
+    parser.add_argument("--options", default="{}", help="options to fix, as json")
+    parser.add_argument("--kind", choices=sorted(TRIALS), help="only run this kind of trial")
+    parser.add_argument("--max-failures", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    failures = run(args.trials, args.seed, json.loads(args.options), args.max_failures, args.kind)
+    for failure in failures:
+        print(json.dumps({k: v for k, v in failure.items() if k != "source"}, indent=2))
+        print(failure["source"])
+    print("%d trials, %d failures" % (args.trials, len(failures)))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
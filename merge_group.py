@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+
+import time
+import inspect
+import concurrent.futures
+
+from merge_fun import (
+    merge_func, merge_func_cached, default_error_hook, signature_template, plan_signature, profile_stats,
+    reset_profile_stats, PROFILE_COUNTER_NAMES,
+)
+
+_executor = None
+
+
+def default_executor():
+    """后台合并使用的单线程 executor"""
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="merge_func")
+    return _executor
+
+
+def _decided(res, returns):
+    """any/all 模式下 res 已经决定了结果"""
+    return (returns == "any" and res) or (returns == "all" and not res)
+
+
+def signature_adapter(func, signature, arg_map=None):
+    """用合并后的签名调用 func，参数按 arg_map 映射，与 merge_func 的 signature, arg_maps 一致。
+    被丢弃的参数不传入，func 使用自己的默认值，没有默认值时传入 None"""
+    sig = inspect.signature(signature_template(signature))
+    mapping = plan_signature([func], signature, [arg_map])[1][0]
+    params = list(inspect.signature(func).parameters.values())
+    positional = (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+
+    def run(*args, **kwargs):
+        bound = sig.bind(*args, **kwargs)
+        bound.apply_defaults()
+        values = bound.arguments
+        pos = []
+        kw = {}
+        by_keyword = False  # after a dropped positional parameter
+        for p in params:
+            target = mapping[p.name]
+            if target in values:
+                value = values[target]
+            elif p.default is p.empty and p.kind in positional + (p.KEYWORD_ONLY,):
+                value = None
+            else:
+                by_keyword = by_keyword or p.kind in positional or p.kind == p.VAR_POSITIONAL
+                continue
+            if p.kind == p.VAR_POSITIONAL:
+                pos.extend(value)
+            elif p.kind == p.VAR_KEYWORD:
+                kw.update(value)
+            elif p.kind in positional and not by_keyword:
+                pos.append(value)
+            else:
+                kw[p.name] = value
+        return func(*pos, **kw)
+    return run
+
+
+def call_sequential(funcs, returns="last", isolate=False, error_hook=None, signature=None, arg_maps=None):
+    """依次调用 funcs，返回值、异常的处理与 merge_func 的 returns, isolate, signature 一致"""
+    if signature is None:
+        calls = funcs
+    else:
+        calls = [
+            signature_adapter(f, signature, arg_maps[idx] if arg_maps is not None else None)
+            for idx, f in enumerate(funcs)
+        ]
+    catch = Exception if isolate else ()
+    hook = error_hook or default_error_hook
+    collect = returns in ("list", "tuple")
+    wrap = list if returns == "list" else tuple
+    default = True if returns == "all" else None
+
+    def run(*args, **kwargs):
+        results = []
+        res = default
+        for f, call in zip(funcs, calls):
+            try:
+                res = call(*args, **kwargs)
+            except catch as e:
+                hook(e, f)
+                res = default
+            if collect:
+                results.append(res)
+            elif _decided(res, returns):
+                break
+        return wrap(results) if collect else res
+    return run
+
+
+def call_chain(merged, delta, returns="last", isolate=False, error_hook=None, signature=None, arg_maps=None):
+    """调用合并后的函数，再依次调用之后加入的函数。arg_maps 为 delta 的参数映射"""
+    rest = call_sequential(delta, returns, isolate, error_hook, signature, arg_maps)
+    if returns in ("list", "tuple"):
+        wrap = list if returns == "list" else tuple
+
+        def run(*args, **kwargs):
+            return wrap([*merged(*args, **kwargs), *rest(*args, **kwargs)])
+        return run
+
+    def run(*args, **kwargs):
+        res = merged(*args, **kwargs)
+        if _decided(res, returns):
+            return res
+        return rest(*args, **kwargs)
+    return run
+
+
+def merged_profile(func, funcs):
+    """counters 模式合并的 func 中每个回调的统计 [(回调, calls, time_ns), ]，func 不是这样合并的函数时为空"""
+    code = getattr(func, "__code__", None)
+    if code is None or PROFILE_COUNTER_NAMES[0] not in code.co_freevars:
+        return []
+    return [(f, calls, time_ns) for f, (calls, time_ns) in zip(funcs, profile_stats(func))]
+
+
+def _add_stats(totals, rows):
+    """把 merged_profile 的结果累加到 totals {func: [calls, time_ns]}"""
+    for f, calls, time_ns in rows:
+        total = totals.setdefault(f, [0, 0])
+        total[0] += calls
+        total[1] += time_ns
+    return totals
+
+
+def _fold_stats(totals, rows):
+    """totals 加上 rows，返回新的 {func: (calls, time_ns)}，不修改 totals"""
+    totals = _add_stats({f: list(total) for f, total in totals.items()}, rows)
+    return {f: tuple(total) for f, total in totals.items()}
+
+
+class MergeHandle(object):
+    """后台线程中合并 funcs 的句柄。合并完成前调用句柄会依次调用各个函数，
+    完成后用一次赋值把 target 换成合并后的函数"""
+
+    def __init__(self, func_name, funcs, executor=None, **options):
+        self.funcs = tuple(funcs)
+        self.func = None  # merged function
+        self.error = None  # exception raised by merge_func
+        self.sequential = call_sequential(
+            self.funcs, options.get("returns", "last"), options.get("isolate", False), options.get("error_hook"),
+            options.get("signature"), options.get("arg_maps"),
+        )
+        self.target = self._fallback
+        self.submit_time = time.perf_counter()
+        self.install_time = None  # perf_counter() when the merged function was installed
+        self.merge_time = None  # seconds spent by merge_func in the worker
+        self.fallback_calls = 0
+        self.fallback_time = 0.0  # seconds spent in fallback calls
+        # merge_func_cached is not thread safe, the worker uses merge_func.
+        self.future = (executor or default_executor()).submit(self._merge, func_name, options)
+
+    def _merge(self, func_name, options):
+        start = time.perf_counter()
+        try:
+            func = merge_func(func_name, list(self.funcs), **options)
+        except Exception as e:
+            self.error = e
+            raise
+        self.merge_time = time.perf_counter() - start
+        self.func = func
+        self.install_time = time.perf_counter()
+        self.target = func
+        return func
+
+    def _fallback(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.sequential(*args, **kwargs)
+        finally:
+            self.fallback_calls += 1
+            self.fallback_time += time.perf_counter() - start
+
+    def profile_stats(self):
+        """counters 模式下合并函数中每个回调的 {func: (调用次数, 耗时 ns)}，合并完成前依次调用的回调不计入"""
+        return _fold_stats({}, merged_profile(self.func, self.funcs))
+
+    def reset_profile_stats(self):
+        if merged_profile(self.func, self.funcs):
+            reset_profile_stats(self.func)
+
+    def __call__(self, *args, **kwargs):
+        return self.target(*args, **kwargs)
+
+    def done(self):
+        return self.future.done()
+
+    def cancel(self):
+        """合并还未开始时取消"""
+        return self.future.cancel()
+
+    def result(self, timeout=None):
+        """等待合并完成，返回合并后的函数"""
+        return self.future.result(timeout)
+
+    def metrics(self):
+        """fallback 的使用情况。fallback_duration 为提交到合并完成的时间，未完成时为到现在的时间"""
+        end = self.install_time if self.install_time is not None else time.perf_counter()
+        return {
+            "done": self.func is not None,
+            "error": repr(self.error) if self.error is not None else None,
+            "merge_time": self.merge_time,
+            "fallback_duration": end - self.submit_time,
+            "fallback_calls": self.fallback_calls,
+            "fallback_time": self.fallback_time,
+        }
+
+
+def merge_func_async(func_name, funcs, executor=None, **options):
+    """在后台线程中合并，立即返回可以调用的 MergeHandle。options 为 merge_func 的参数"""
+    return MergeHandle(func_name, funcs, executor=executor, **options)
+
+
+class MergedCallbackGroup(object):
+    """一组签名相同的回调，调用时执行合并后的函数。
+
+    add, remove, reorder 只标记 dirty。合并前使用上一次合并的函数加上新加入的函数；有删除或调整顺序时依次调用各个回调。
+    调用开始时取出 runner，回调在执行中修改分组不影响本次调用，从下一次调用开始生效。
+    默认 background 为 True，调用不会等待合并：dirty 时提交后台合并，完成后的下一次调用换上合并后的函数。
+    background 为 False 是阻塞模式：lazy 为 True 时在下一次调用中同步合并，这次调用要等待合并；否则只在 flush 时合并。
+    签名不同的回调通过 options 的 signature 合并，arg_maps 为 {回调: arg_map}，没有给出的回调按参数名映射。
+    """
+
+    def __init__(self, name, funcs=(), lazy=True, background=True, executor=None, **options):
+        self.name = name
+        self.lazy = lazy
+        self.background = background
+        self.executor = executor
+        self.handle = None  # MergeHandle of the pending background merge
+        self.options = options  # merge_func options
+        self.returns = options.get("returns", "last")
+        self.isolate = options.get("isolate", False)
+        self.error_hook = options.get("error_hook")
+        self.signature = options.get("signature")
+        self.profile = options.get("profile")
+        self.profile_totals = {}  # func -> [calls, time_ns] of the replaced merged functions, counters mode
+        self.funcs = tuple(funcs)  # current members, replaced as a whole on every change
+        self.merged = call_sequential((), self.returns)  # merged function of merged_funcs
+        self.merged_funcs = ()
+        self.merge_error = None  # exception raised by the last merge, members are called one by one
+        self.dirty = False
+        self.runner = self.merged  # called by __call__, swapped by a single assignment
+        self._set(self.funcs)
+
+    def __len__(self):
+        return len(self.funcs)
+
+    def __contains__(self, func):
+        return any(f is func for f in self.funcs)
+
+    def add(self, func):
+        """在末尾加入回调"""
+        self._set(self.funcs + (func,))
+
+    def remove(self, func):
+        """删除第一个 func"""
+        for idx, f in enumerate(self.funcs):
+            if f is func:
+                self._set(self.funcs[:idx] + self.funcs[idx + 1:])
+                return
+        raise ValueError(f"{func!r} is not in group {self.name}")
+
+    def reorder(self, funcs):
+        """调整顺序，funcs 必须与当前的回调相同"""
+        funcs = tuple(funcs)
+        if sorted(map(id, funcs)) != sorted(map(id, self.funcs)):
+            raise ValueError(f"reorder of group {self.name} must keep the same callbacks")
+        self._set(funcs)
+
+    def invalidate(self):
+        """回调的 __code__ 被替换（热更新）后调用，下次重新合并"""
+        self.merged = call_sequential((), self.returns)
+        self.merged_funcs = ()
+        self._set(self.funcs)
+
+    def _set(self, funcs):
+        self.funcs = funcs
+        self.dirty = funcs != self.merged_funcs
+        self.runner = self._fallback() if self.dirty else self.merged
+
+    def _fallback(self):
+        """合并完成前使用的 runner"""
+        n = len(self.merged_funcs)
+        if n and self.funcs[:n] == self.merged_funcs:
+            return call_chain(
+                self.merged, self.funcs[n:], self.returns, self.isolate, self.error_hook, self.signature,
+                self._arg_maps(self.funcs)[n:] if self.signature is not None else None,
+            )
+        return self._sequential(self.funcs)
+
+    def _sequential(self, funcs):
+        return call_sequential(
+            funcs, self.returns, self.isolate, self.error_hook, self.signature, self._arg_maps(funcs),
+        )
+
+    def _arg_maps(self, funcs):
+        """成员的参数映射。分组的 arg_maps 为 {func: arg_map}，成员会增减，不能按位置给出"""
+        arg_maps = self.options.get("arg_maps")
+        if arg_maps is None:
+            return None
+        return [arg_maps.get(f) for f in funcs]
+
+    def _merge(self, funcs):
+        if not funcs:
+            return call_sequential((), self.returns)
+        if len(funcs) == 1 and self.returns == "last" and not self.isolate and self.signature is None \
+                and self.profile is None:
+            return funcs[0]
+        options = dict(self.options)
+        if self.signature is not None:
+            options["arg_maps"] = self._arg_maps(funcs)
+        if self.profile is not None:
+            # the counters belong to this group, a cached function would share them with other groups.
+            return merge_func(self.name, funcs, **options)
+        return merge_func_cached(self.name, funcs, **options)
+
+    def flush(self):
+        """立即合并，返回当前的 runner"""
+        if not self.dirty:
+            return self.runner
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        funcs = self.funcs
+        try:
+            merged = self._merge(funcs)
+        except Exception as e:
+            self._install(funcs, None, e)
+        else:
+            self._install(funcs, merged, None)
+        return self.runner
+
+    def _install(self, funcs, merged, error):
+        self._fold_profile()
+        self.merge_error = error
+        if error is not None:
+            # keep calling the members one by one, do not retry until the group changes.
+            merged = self._sequential(funcs)
+        self.merged, self.merged_funcs = merged, funcs
+        self._set(self.funcs)
+
+    def poll(self):
+        """后台合并：提交当前成员的合并，或换上已完成的合并，返回当前的 runner"""
+        handle = self.handle
+        if handle is not None and handle.funcs != self.funcs:
+            handle.cancel()  # members changed, the result would be discarded.
+            handle = None
+        if handle is None:
+            if len(self.funcs) < 2:
+                return self.flush()  # nothing to merge
+            options = dict(self.options)
+            if self.signature is not None:
+                options["arg_maps"] = self._arg_maps(self.funcs)
+            self.handle = MergeHandle(self.name, self.funcs, executor=self.executor, **options)
+        elif handle.done():
+            self.handle = None
+            self._install(handle.funcs, handle.func, handle.error)
+        return self.runner
+
+    def _fold_profile(self):
+        """合并函数被替换前，把它的统计累计到 profile_totals"""
+        _add_stats(self.profile_totals, merged_profile(self.merged, self.merged_funcs))
+
+    def profile_stats(self):
+        """counters 模式下每个回调的 {func: (调用次数, 耗时 ns)}，包括之前合并的函数的统计。
+        合并完成前依次调用的回调不计入"""
+        return _fold_stats(self.profile_totals, merged_profile(self.merged, self.merged_funcs))
+
+    def reset_profile_stats(self):
+        self.profile_totals = {}
+        if merged_profile(self.merged, self.merged_funcs):
+            reset_profile_stats(self.merged)
+
+    def __call__(self, *args, **kwargs):
+        runner = self.runner
+        if self.dirty:
+            if self.background:
+                runner = self.poll()
+            elif self.lazy:
+                runner = self.flush()
+        return runner(*args, **kwargs)
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+import types
+import opcode
+
+from merge_fun import (
+    Instr, Label, NO_LOCATION, new_context, segment_data, convert_segment, chain_returns, optimize_instrs,
+    layout_instrs, encode_linetable, compute_stacksize, write_exception_table, merge_globals, merged_filename,
+    segment_table_const, verify_code,
+)
+
+# appended to a segment for compute_stacksize, the chained RETURN_VALUE jumps to the end of the segment.
+_END_NOP = bytes((opcode.opmap["NOP"], 0))
+
+
+def _located(pos):
+    return pos is not None and pos[0] is not None and pos[0] >= 0
+
+
+def _line_chunk(locations):
+    """把一个函数的 locations 编码为可以拼接的 co_linetable 片段 (prefix, rest, end_line)。
+    line entry 记录相对上一行的行号差，只有第一个有行号的 entry 依赖前一个函数，拼接时才编码；
+    rest 相对于 prefix 最后一个 entry 的行号编码，end_line 为最后一个有行号的 entry 的行号，即下一个函数的起点"""
+    for k, (_, pos) in enumerate(locations):
+        if _located(pos):
+            break
+    else:
+        return locations, b"", None
+    end_line = locations[k][1][0]
+    rest = encode_linetable(locations[k + 1:], end_line)
+    for _, pos in locations[k + 1:]:
+        if _located(pos):
+            end_line = pos[0]
+    return locations[:k + 1], rest, end_line
+
+
+def _assemble_segment(instrs):
+    """布局一个函数，返回 (co_code, line_chunk, exc_entries, stacksize)，偏移都相对于函数开头"""
+    code, locations, exc_entries = layout_instrs(instrs)
+    return code, _line_chunk(locations), exc_entries, compute_stacksize(code + _END_NOP, exc_entries)
+
+
+class MergeBuilder(object):
+    """增量合并。保存每个函数转换、布局后的字节码、异常表、行号表片段，
+    append 只处理新加入的函数，remove 只重新处理被删除函数之后的函数，build 只做拼接。
+
+    与 merge_func 的区别：
+    - cell 变量也放在 co_varnames 中，新函数加入时已有的 fast slot 不变
+    - 删除函数后，它的局部变量、常量池中的项、合并的 __globals__、closure 中的 cell 保留
+    - 不支持 hoist_globals, guards, returns, isolate, signature, profile
+    """
+
+    def __init__(self, func_name, def_argcount=None, merged_firstlineno=0, pooled=False, share_globals=True,
+                 optimize=False, verify=True):
+        self.func_name = func_name
+        self.def_argcount = def_argcount
+        self.merged_firstlineno = merged_firstlineno
+        self.share_globals = share_globals
+        self.optimize = optimize
+        self.verify = verify  # verify_code the result of build_code
+        self.context = new_context(pooled)
+        self.func_globals = None
+        self.globals_shared = share_globals
+        self.segments = []  # one dict per function, in merge order
+        self.serial = 0  # suffix of renamed globals, never reused
+        self.closure = []  # merged __closure__, shared cells once
+        self.cell_index = {}  # id(cell) -> position in closure
+        self.func_generated = None
+
+    def __len__(self):
+        return len(self.segments)
+
+    @property
+    def funcs(self):
+        return [seg["func"] for seg in self.segments]
+
+    def _add_locals(self, code):
+        """合并 co_varnames, co_cellvars，返回新增的 cell 变量"""
+        context = self.context
+        slots = context["name_mapping_slot"]
+        new_cells = []
+        for name in code.co_varnames + code.co_cellvars:
+            if name not in slots:
+                slots[name] = len(context["co_varnames"])
+                context["co_varnames"].append(name)
+        for cv in code.co_cellvars:
+            if cv not in context["co_cellvars"]:
+                context["co_cellvars"].append(cv)
+                new_cells.append(cv)
+        context["slot_mapping_name"] = context["co_varnames"]
+        return new_cells
+
+    def _free_map(self, func):
+        """增量的 plan_closure，返回 func 的 free variable 在 closure 中的位置"""
+        free_map = []
+        for name, cell in zip(func.__code__.co_freevars, func.__closure__ or ()):
+            k = self.cell_index.get(id(cell))
+            if k is None:
+                k = self.cell_index[id(cell)] = len(self.closure)
+                self.closure.append(cell)
+                self.context["co_freevars"].append(name)
+            free_map.append(k)
+        return free_map
+
+    def _plan_globals(self, func):
+        """增量的 plan_globals，返回 func 需要重命名的全局变量"""
+        if self.func_globals is None:
+            self.func_globals = func.__globals__ if self.share_globals else dict()
+        if self.globals_shared:
+            if func.__globals__ is self.func_globals:
+                return {}
+            # a function from another module joins, switch to a merged copy.
+            shared, self.func_globals, self.globals_shared = self.func_globals, dict(), False
+            if self.segments:
+                self.func_globals.update(shared)
+        self.serial += 1
+        return merge_globals(self.func_globals, func, self.serial)
+
+    def _convert(self, seg):
+        """转换并布局一个函数"""
+        context = self.context
+        data = seg["data"]
+        data["consts_offset"] = len(context["co_consts"])
+        data["names_offset"] = len(context["co_names"])
+        data["rename_slots"] = {}
+        seg["pool_mark"] = (len(context["co_consts"]), len(context["co_names"]))
+        if not context["pooled"]:
+            context["co_consts"].extend(data["co_consts"])
+            context["co_names"].extend(data["co_names"])
+        self._relayout(seg)
+
+    def _convert_instrs(self, seg, chained):
+        """转换一个函数，chained 时 RETURN_VALUE 替换为跳到函数末尾。
+        与 merge_code 相同，optimize_instrs 在替换之后只运行一次"""
+        instrs = convert_segment(self.context, seg["data"])
+        if chained:
+            instrs = chain_returns(instrs, Label())
+        if self.optimize:
+            instrs = optimize_instrs(instrs)
+        return instrs
+
+    def _relayout(self, seg):
+        seg["chained"] = _assemble_segment(self._convert_instrs(seg, True))
+        seg["last"] = None  # only needed by the last function, made by build_code
+
+    def append(self, func):
+        """在末尾加入一个函数"""
+        code = func.__code__
+        if not self.segments and not self.context["co_varnames"]:
+            context = self.context
+            context["co_argcount"] = self.def_argcount if self.def_argcount is not None else code.co_argcount
+            context["co_posonlyargcount"] = code.co_posonlyargcount
+            context["co_kwonlyargcount"] = code.co_kwonlyargcount
+            context["co_flags"] = code.co_flags
+
+        renames = self._plan_globals(func)
+        free_map = self._free_map(func)
+        nlocals = len(self.context["co_varnames"])
+        new_cells = self._add_locals(code)
+        self.context["free_offset"] = len(self.context["co_varnames"])
+        moved = nlocals != len(self.context["co_varnames"])
+        for seg in self.segments:
+            # a plain local of an earlier function became a cell, its LOAD_FAST must be LOAD_DEREF now;
+            # new locals move the free variables which follow them.
+            if not seg["fast_names"].isdisjoint(new_cells) or (moved and seg["data"]["free_map"]):
+                self._relayout(seg)
+
+        seg = {
+            "func": func,
+            "code": code,
+            "data": segment_data(self.func_name, code, len(self.segments), renames),
+            "fast_names": set(code.co_varnames) - set(code.co_cellvars),
+        }
+        seg["data"]["free_map"] = free_map
+        self._convert(seg)
+        self.segments.append(seg)
+        self.func_generated = None
+
+    def remove(self, func):
+        """删除第一个 func，之后的函数需要重新转换"""
+        for idx, seg in enumerate(self.segments):
+            if seg["func"] is func:
+                break
+        else:
+            raise ValueError(f"{func!r} is not merged")
+        del self.segments[idx]
+        self.func_generated = None
+        if idx == len(self.segments):
+            return  # the removed one is the last, nothing after it.
+
+        # pools are append only, roll back to the state before the removed function.
+        context = self.context
+        nconsts, nnames = seg["pool_mark"]
+        del context["co_consts"][nconsts:]
+        del context["co_names"][nnames:]
+        context["const_pool"] = {k: v for k, v in context["const_pool"].items() if v < nconsts}
+        context["name_pool"] = {k: v for k, v in context["name_pool"].items() if v < nnames}
+        for seg in self.segments[idx:]:
+            self._convert(seg)
+
+    def build_code(self):
+        """拼接各个函数，生成合并后的 code 对象"""
+        context = self.context
+        assert self.segments, "nothing to merge"
+
+        # COPY_FREE_VARS and MAKE_CELL of all cells before the first RESUME.
+        prologue = []
+        if self.closure:
+            prologue.append(Instr(opcode.opmap["COPY_FREE_VARS"], len(self.closure), pos=NO_LOCATION))
+        prologue += [
+            Instr(opcode.opmap["MAKE_CELL"], context["name_mapping_slot"][cv], pos=NO_LOCATION)
+            for cv in context["co_cellvars"]
+        ]
+        code, locations, _ = layout_instrs(prologue)
+        line = self.merged_firstlineno
+        co_code = [code]
+        linetable = [encode_linetable(locations, line)]
+        exc_entries = []
+        stacksize = 0
+        offset = len(code)
+        ranges = []
+        last = self.segments[-1]
+        if last["last"] is None:
+            last["last"] = _assemble_segment(self._convert_instrs(last, False))
+        for idx, seg in enumerate(self.segments):
+            code, (prefix, rest, end_line), entries, depth = \
+                seg["last"] if seg is last else seg["chained"]
+            ranges.append((offset, offset + len(code), idx))
+            co_code.append(code)
+            linetable.append(encode_linetable(prefix, line))
+            linetable.append(rest)
+            if end_line is not None:
+                line = end_line
+            for start, end, target, dl in entries:
+                exc_entries.append((start + offset, end + offset, target + offset, dl))
+            stacksize = max(stacksize, depth)
+            offset += len(code)
+
+        codes = [seg["code"] for seg in self.segments]
+        code = types.CodeType(
+            context["co_argcount"],
+            context["co_posonlyargcount"],
+            context["co_kwonlyargcount"],
+            len(context["co_varnames"]),
+            stacksize,
+            context["co_flags"],
+            b"".join(co_code),
+            tuple(context["co_consts"]) + (segment_table_const(tuple(ranges), codes),),
+            tuple(context["co_names"]),
+            tuple(context["co_varnames"]),
+            merged_filename(self.func_name, codes),
+            self.func_name,
+            self.func_name,
+            self.merged_firstlineno,
+            b"".join(linetable),
+            write_exception_table(exc_entries),
+            tuple(context["co_freevars"]),
+            tuple(context["co_cellvars"]),
+        )
+        if self.verify:
+            verify_code(code)
+        return code
+
+    def build(self):
+        """生成合并后的函数，没有变化时返回上次的结果"""
+        if self.func_generated is None:
+            func_defaults = []
+            for seg in self.segments:
+                func = seg["func"]
+                if func.__defaults__:
+                    func_defaults.extend(func.__defaults__)
+            self.func_generated = types.FunctionType(
+                self.build_code(), self.func_globals, self.func_name, tuple(func_defaults), tuple(self.closure)
+            )
+        return self.func_generated
@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+
+import dis
+import types
+import opcode
+import inspect
+import builtins
+
+from merge_fun import (
+    Instr, Label, NO_LOCATION, UNCONDITIONAL_JUMPS, NO_FALLTHROUGH, VARARG_FLAGS, decode_instructions, new_context,
+    plan_merge, shared_globals, segment_data, convert_segment, optimize_instrs, layout_instrs, segment_ranges,
+    segment_table_const, encode_linetable, write_exception_table, compute_stacksize, merged_filename, verify_code,
+    pool_const, make_jump_forward,
+)
+
+# a parent which is one of these can not be spliced, its return is not the value of the call.
+NOT_INLINE_FLAGS = (
+    inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE | inspect.CO_ASYNC_GENERATOR
+)
+
+
+def _stack_depths(instrs):
+    """decode_instructions 结果中每条指令执行前的栈深度 {id(Instr): depth}，无法到达的指令不在其中"""
+    labels = {ins: i for i, ins in enumerate(instrs) if type(ins) is Label}
+    depths = {}
+    todo = [(0, 0)]
+    while todo:
+        i, depth = todo.pop()
+        while i < len(instrs):
+            ins = instrs[i]
+            i += 1
+            if type(ins) is Label:
+                continue
+            if id(ins) in depths:
+                break
+            depths[id(ins)] = depth
+            if ins.exc is not None:
+                handler, saved, lasti = ins.exc
+                todo.append((labels[handler], saved + lasti + 1))
+            arg = ins.arg if ins.op >= opcode.HAVE_ARGUMENT else None
+            if ins.target is not None:
+                todo.append((labels[ins.target], depth + dis.stack_effect(ins.op, arg, jump=True)))
+                if ins.op in UNCONDITIONAL_JUMPS:
+                    break
+                depth += dis.stack_effect(ins.op, arg, jump=False)
+            elif ins.op in NO_FALLTHROUGH:
+                break
+            elif ins.op == opcode.opmap["RETURN_GENERATOR"]:
+                depth += 1
+            else:
+                depth += dis.stack_effect(ins.op, arg)
+    return depths
+
+
+def _super_calls(code, instrs):
+    """无参数 super() 调用开头 LOAD_GLOBAL super 在 instrs 中的下标"""
+    res = []
+    for k, ins in enumerate(instrs[:-2]):
+        if type(ins) is Instr and ins.op == opcode.opmap["LOAD_GLOBAL"] and ins.arg & 0x01 and \
+                code.co_names[ins.arg >> 1] == "super":
+            precall, call = instrs[k + 1], instrs[k + 2]
+            if type(precall) is Instr and precall.op == opcode.opmap["PRECALL"] and precall.arg == 0 and \
+                    type(call) is Instr and call.op == opcode.opmap["CALL"]:
+                res.append(k)
+    return res
+
+
+def _super_site(func, name, instrs):
+    """函数中唯一的、语句级的 super().name(...) 调用，返回 {"index", "call", "nargs", "kwnames"}，没有时返回 None。
+    index 为 LOAD_GLOBAL super 的下标，call 为 PRECALL n 的下标。
+    要求栈为空，不在 try/with 中，参数是没有跳转的表达式，只有位置参数和关键字参数"""
+    code = func.__code__
+    if func.__globals__.get("super", func.__builtins__.get("super")) is not builtins.super:
+        return None
+    method = opcode.opmap["LOAD_METHOD"]
+    sites = [
+        k for k in _super_calls(code, instrs)
+        if k + 3 < len(instrs) and type(instrs[k + 3]) is Instr and instrs[k + 3].op == method and
+        code.co_names[instrs[k + 3].arg] == name
+    ]
+    if len(sites) != 1:
+        return None
+    k = sites[0]
+    depths = _stack_depths(instrs)
+    if depths.get(id(instrs[k])) != 0:
+        return None
+    for j in range(k, len(instrs)):
+        ins = instrs[j]
+        if type(ins) is Label or ins.exc is not None or (ins.target is not None and j > k + 3):
+            return None
+        if j > k + 3 and ins.op == opcode.opmap["PRECALL"] and depths.get(id(ins)) == 2 + ins.arg:
+            break
+    else:
+        return None
+    call = instrs[j + 1] if j + 1 < len(instrs) else None
+    if type(call) is not Instr or call.op != opcode.opmap["CALL"] or call.arg != ins.arg or call.exc is not None:
+        return None
+    kwnames = ()
+    if instrs[j - 1].op == opcode.opmap["KW_NAMES"]:
+        kwnames = code.co_consts[instrs[j - 1].arg]
+    return {"index": k, "call": j, "nargs": ins.arg, "kwnames": kwnames}
+
+
+def _original(func):
+    """install_flattened 设置的函数对应的原函数，拼接时总是使用原函数，不再转换已经拼接过的字节码"""
+    chain = getattr(func, "__super_chain__", None)
+    return chain[0] if chain else func
+
+
+def _in_loop(instrs, k):
+    """instrs[k] 是否在循环中：之后有跳回到它之前的指令。3.11 的循环都用向后跳转实现"""
+    labels = {ins: i for i, ins in enumerate(instrs) if type(ins) is Label}
+    return any(
+        type(ins) is Instr and ins.target is not None and labels[ins.target] <= k
+        for ins in instrs[k + 1:]
+    )
+
+
+def _super_parent(cls, func, name):
+    """type(self) 为 cls 时 func 中 super().name 找到的函数（已经合并的换为原函数），不是普通函数时返回 None"""
+    code = func.__code__
+    if "__class__" not in code.co_freevars:
+        return None
+    try:
+        klass = func.__closure__[code.co_freevars.index("__class__")].cell_contents
+    except ValueError:
+        return None
+    mro = cls.__mro__
+    if klass not in mro:
+        return None
+    for base in mro[mro.index(klass) + 1:]:
+        if name in base.__dict__:
+            attr = base.__dict__[name]
+            return _original(attr) if type(attr) is types.FunctionType else None
+    return None
+
+
+def _bind_args(parent, npos, kwnames):
+    """super().name 调用的参数绑定到 parent 的参数，返回 [(param, ("arg", j) 或 ("const", default)), ]，
+    不含第一个参数 self；调用会抛出 TypeError 时返回 None"""
+    code = parent.__code__
+    if code.co_flags & (VARARG_FLAGS | NOT_INLINE_FLAGS):
+        return None
+    argcount = code.co_argcount
+    params = code.co_varnames[:argcount + code.co_kwonlyargcount]
+    if argcount < 1 or npos + 1 > argcount:
+        return None
+    bound = {params[1 + j]: ("arg", j) for j in range(npos)}
+    keywords = params[max(1, code.co_posonlyargcount):]
+    for j, kw in enumerate(kwnames):
+        if kw in bound or kw not in keywords:
+            return None
+        bound[kw] = ("arg", npos + j)
+    defaults = parent.__defaults__ or ()
+    kwdefaults = parent.__kwdefaults__ or {}
+    first_default = argcount - len(defaults)
+    for i, p in enumerate(params[1:], 1):
+        if p in bound:
+            continue
+        if first_default <= i < argcount:
+            bound[p] = ("const", defaults[i - first_default])
+        elif i >= argcount and p in kwdefaults:
+            bound[p] = ("const", kwdefaults[p])
+        else:
+            return None
+    return [(p, bound[p]) for p in params[1:]]
+
+
+def super_chain(cls, name):
+    """type(self) 为 cls 时 name 的 super 调用链，返回 [{"func", "instrs", "site", "binding"}, ]。
+    第一个为 MRO 中定义 name 的函数，之后每个都被前一个唯一的语句级 super().name(...) 调用，
+    最后一个的 site 为 None。不能拼接（包括不能共用第一个函数的 __globals__）时链在那里结束。
+    父类方法的 cell 只在函数开头创建一次，所以循环中的调用之后的函数都不能有 cell"""
+    for base in cls.__mro__:
+        if name in base.__dict__:
+            func = base.__dict__[name]
+            break
+    else:
+        return []
+    if type(func) is not types.FunctionType:
+        return []
+    func = _original(func)
+    if func.__code__.co_flags & NOT_INLINE_FLAGS:
+        return []
+    chain = []
+    seen = set()
+    while True:
+        seen.add(func)
+        level = {"func": func, "instrs": decode_instructions(func.__code__), "site": None, "binding": None}
+        chain.append(level)
+        site = _super_site(func, name, level["instrs"]) if func.__code__.co_argcount else None
+        if site is None:
+            break
+        parent = _super_parent(cls, func, name)
+        if parent is None or parent in seen:
+            break
+        # the flattened function must use the module dict itself, a merged copy hides later rebinding.
+        if shared_globals([level["func"] for level in chain] + [parent]) is None:
+            break
+        binding = _bind_args(parent, site["nargs"] - len(site["kwnames"]), site["kwnames"])
+        if binding is None:
+            break
+        level["site"], level["binding"] = site, binding
+        func = parent
+
+    # a call in a loop must not reuse the cells of the functions after it.
+    for idx, level in enumerate(chain[:-1]):
+        if _in_loop(level["instrs"], level["site"]["index"]) and \
+                any(later["func"].__code__.co_cellvars for later in chain[idx + 1:]):
+            level["site"] = level["binding"] = None
+            del chain[idx + 1:]
+            break
+    return chain
+
+
+def _level_locals(code, idx):
+    """第 idx 层的 co_varnames, co_cellvars 在合并后的名字，第一层不变，之后的改为 .idx.name"""
+    if idx == 0:
+        return code.co_varnames, code.co_cellvars
+    return tuple(f".{idx}.{name}" for name in code.co_varnames), tuple(f".{idx}.{name}" for name in code.co_cellvars)
+
+
+def _explicit_super(code, instrs, skip):
+    """把 super() 改为 super(__class__, self)，不再依赖栈帧中的第一个局部变量和第一个 __class__。
+    skip 为被拼接的调用的下标，参数仍是原 code 对象中的"""
+    if "__class__" not in code.co_freevars or not code.co_argcount:
+        return instrs
+    nlocals = len(code.co_varnames) + len([cv for cv in code.co_cellvars if cv not in code.co_varnames])
+    class_slot = nlocals + code.co_freevars.index("__class__")
+    load_self = "LOAD_DEREF" if code.co_varnames[0] in code.co_cellvars else "LOAD_FAST"
+    res = list(instrs)
+    for k in reversed(_super_calls(code, instrs)):
+        if k == skip:
+            continue
+        ins, precall, call = instrs[k:k + 3]
+        precall.arg = call.arg = 2
+        res[k + 1:k + 1] = [
+            Instr(opcode.opmap["LOAD_DEREF"], class_slot, exc=ins.exc, pos=ins.pos),
+            Instr(opcode.opmap[load_self], 0, exc=ins.exc, pos=ins.pos),
+        ]
+    return res
+
+
+def _splice_returns(instrs, after):
+    """RETURN_VALUE 改为带着返回值跳转到 after，返回值即为 super().name(...) 的结果"""
+    res = []
+    last = max((i for i, ins in enumerate(instrs) if type(ins) is Instr), default=-1)
+    for i, ins in enumerate(instrs):
+        if type(ins) is Instr and ins.op == opcode.opmap["RETURN_VALUE"]:
+            if i == last:
+                ins.op = opcode.opmap["NOP"]
+            else:
+                ins = make_jump_forward(after, ins.exc, ins.pos)
+        res.append(ins)
+    res.append(after)
+    return res
+
+
+def _local_instr(context, fast, deref, name, pos):
+    op = deref if name in context["co_cellvars"] else fast
+    return Instr(opcode.opmap[op], context["name_mapping_slot"][name], pos=pos)
+
+
+def _flatten_level(context, chain, plan, owners, idx):
+    """转换第 idx 层，并把下一层拼接到 super().name(...) 的位置"""
+    level = chain[idx]
+    code = level["func"].__code__
+    varnames, cellvars = _level_locals(code, idx)
+    data = segment_data(code.co_name, code, idx, plan["renames"][idx], varnames, cellvars)
+    data["free_map"] = plan["free_maps"][idx]
+    data["consts_offset"] = len(context["co_consts"])
+    data["names_offset"] = len(context["co_names"])
+    if not context["pooled"]:
+        context["co_consts"].extend(data["co_consts"])
+        context["co_names"].extend(data["co_names"])
+
+    raw = level["instrs"]
+    site = level["site"]
+    if site is not None:
+        head = raw[site["index"]:site["index"] + 4]  # super() and LOAD_METHOD, removed
+        tail = raw[site["call"]:site["call"] + 2]  # PRECALL, CALL, replaced by the parent
+        if site["kwnames"]:
+            tail.insert(0, raw[site["call"] - 1])
+    if idx:
+        raw = _explicit_super(code, raw, site["index"] if site is not None else None)
+    instrs = convert_segment(context, data, raw)
+    if idx:
+        # the parent has no frame of its own, nothing to resume.
+        for ins in instrs:
+            if type(ins) is Instr and ins.op == opcode.opmap["RESUME"]:
+                ins.op, ins.arg = opcode.opmap["NOP"], 0
+    owners.update((id(ins), idx) for ins in instrs if type(ins) is Instr)
+    if site is None:
+        return instrs
+
+    parent = chain[idx + 1]["func"].__code__
+    p_varnames, _ = _level_locals(parent, idx + 1)
+    pos = tail[-1].pos
+    glue = []
+    # the arguments are on the stack, the last one on top.
+    params = dict(zip(parent.co_varnames, p_varnames))
+    args = {source[1]: param for param, source in level["binding"] if source[0] == "arg"}
+    for j in reversed(range(site["nargs"])):
+        glue.append(_local_instr(context, "STORE_FAST", "STORE_DEREF", params[args[j]], pos))
+    for param, (kind, value) in level["binding"]:
+        if kind == "const":
+            glue.append(Instr(opcode.opmap["LOAD_CONST"], pool_const(context, value), pos=pos))
+            glue.append(_local_instr(context, "STORE_FAST", "STORE_DEREF", params[param], pos))
+    glue.append(_local_instr(context, "LOAD_FAST", "LOAD_DEREF", varnames[0], pos))
+    glue.append(_local_instr(context, "STORE_FAST", "STORE_DEREF", p_varnames[0], pos))
+    owners.update((id(ins), idx) for ins in glue)
+    body = _splice_returns(_flatten_level(context, chain, plan, owners, idx + 1), Label())
+
+    removed = {id(ins) for ins in head + tail}
+    res = []
+    for ins in instrs:
+        if ins is tail[0]:
+            res += glue + body
+        if id(ins) not in removed:
+            res.append(ins)
+    return res
+
+
+def flatten_super(cls, name, pooled=False, optimize=False, verify=True):
+    """把 cls 的方法 name 与它的 super 调用链合并为一个函数，每层的 super().name(...) 替换为父类方法的字节码，
+    省去每层的栈帧。链只有一层时返回 None。
+    父类方法的局部变量改名为 .idx.name，调用时按参数绑定赋值；父类方法中其他的 super() 改为 super(__class__, self)"""
+    chain = super_chain(cls, name)
+    if len(chain) < 2:
+        return None
+    funcs = [level["func"] for level in chain]
+    codes = [func.__code__ for func in funcs]
+    plan = plan_merge(funcs)
+    first = codes[0]
+
+    context = new_context(pooled)
+    context["co_argcount"] = first.co_argcount
+    context["co_posonlyargcount"] = first.co_posonlyargcount
+    context["co_kwonlyargcount"] = first.co_kwonlyargcount
+    context["co_flags"] = first.co_flags
+    varnames = list(first.co_varnames)
+    cellvars = list(first.co_cellvars)
+    for idx, code in enumerate(codes[1:], 1):
+        vns, cvs = _level_locals(code, idx)
+        varnames += vns
+        cellvars += cvs
+    context["co_varnames"] = varnames
+    context["co_cellvars"] = cellvars
+    names = varnames + [cv for cv in cellvars if cv not in varnames]
+    context["slot_mapping_name"] = names
+    context["name_mapping_slot"] = {name: i for i, name in enumerate(names)}
+    context["free_offset"] = len(names)
+    context["co_freevars"].extend(plan["freevars"])
+
+    instrs = []
+    if plan["freevars"]:
+        instrs.append(Instr(opcode.opmap["COPY_FREE_VARS"], len(plan["freevars"]), pos=NO_LOCATION))
+    for cv in cellvars:
+        instrs.append(Instr(opcode.opmap["MAKE_CELL"], context["name_mapping_slot"][cv], pos=NO_LOCATION))
+    owners = {}
+    instrs += _flatten_level(context, chain, plan, owners, 0)
+    unoptimized = instrs  # keeps the ids in owners alive
+    owners = {id(ins): owners.get(id(ins)) for ins in instrs if type(ins) is Instr}
+    if optimize:
+        instrs = optimize_instrs(instrs)
+    co_code, locations, exc_entries = layout_instrs(instrs)
+    ranges = segment_ranges(instrs, owners, locations)
+    del unoptimized
+    context["co_consts"].append(segment_table_const(ranges, codes))
+
+    code = types.CodeType(
+        first.co_argcount,
+        first.co_posonlyargcount,
+        first.co_kwonlyargcount,
+        len(varnames),
+        compute_stacksize(co_code, exc_entries),
+        first.co_flags,
+        co_code,
+        tuple(context["co_consts"]),
+        tuple(context["co_names"]),
+        tuple(varnames),
+        merged_filename(first.co_name, codes),
+        first.co_name,
+        first.co_qualname,
+        first.co_firstlineno,
+        encode_linetable(locations, first.co_firstlineno),
+        write_exception_table(exc_entries),
+        tuple(context["co_freevars"]),
+        tuple(cellvars),
+    )
+    if verify:
+        verify_code(code)
+    func = types.FunctionType(
+        code, plan["func_globals"], funcs[0].__name__, funcs[0].__defaults__, tuple(plan["closure"]),
+    )
+    if funcs[0].__kwdefaults__:
+        func.__kwdefaults__ = dict(funcs[0].__kwdefaults__)
+    func.__qualname__ = funcs[0].__qualname__
+    func.__module__ = funcs[0].__module__
+    func.__doc__ = funcs[0].__doc__
+    func.__dict__.update(funcs[0].__dict__)
+    func.__super_chain__ = tuple(funcs)
+    return func
+
+
+def _subclasses(cls):
+    res = []
+    todo = list(cls.__subclasses__())
+    while todo:
+        sub = todo.pop()
+        if sub not in res:
+            res.append(sub)
+            todo.extend(sub.__subclasses__())
+    return res
+
+
+def install_flattened(cls, name, **options):
+    """flatten_super 并设置为 cls.name，返回合并后的函数，链只有一层时返回 None。
+    继承 cls 的类的 MRO 会让 super 找到不同的函数时抛出 ValueError，如菱形继承。
+    之后重新定义了链中的方法时，需要 restore_super 后重新合并"""
+    func = flatten_super(cls, name, **options)
+    if func is None:
+        return None
+    funcs = func.__super_chain__
+    for sub in _subclasses(cls):
+        if any(_super_parent(sub, f, name) is not parent for f, parent in zip(funcs, funcs[1:])):
+            raise ValueError(f"super().{name} of {sub.__qualname__} does not resolve as in {cls.__qualname__}")
+    current = cls.__dict__.get(name)
+    func.__super_original__ = current.__super_original__ if hasattr(current, "__super_chain__") else current
+    setattr(cls, name, func)
+    return func
+
+
+def restore_super(cls, name):
+    """恢复 install_flattened 之前的 cls.name，返回是否恢复了"""
+    func = cls.__dict__.get(name)
+    if getattr(func, "__super_chain__", None) is None:
+        return False
+    if func.__super_original__ is None:
+        delattr(cls, name)
+    else:
+        setattr(cls, name, func.__super_original__)
+    return True
+
+
+def flatten_hierarchy(root, name, **options):
+    """对 root 和它所有定义了 name 的子类 install_flattened，父类在前，子类拼接的是父类的原函数。
+    返回合并了的类，不能合并的类跳过"""
+    classes = [root] + _subclasses(root)
+    classes.sort(key=lambda c: len(c.__mro__))
+    done = []
+    for cls in classes:
+        if name not in cls.__dict__:
+            continue
+        try:
+            if install_flattened(cls, name, **options) is not None:
+                done.append(cls)
+        except ValueError:
+            continue
+    return done
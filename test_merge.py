@@ -0,0 +1,505 @@
+# -*- coding: utf-8 -*-
+"""合并函数的回归测试
+
+    python -m pytest test_merge.py
+    python test_merge.py
+"""
+
+import os
+import dis
+import sys
+import json
+import json.decoder
+import types
+import opcode
+import inspect
+import argparse
+import tempfile
+import unittest
+import threading
+import concurrent.futures
+import importlib
+import random
+import collections
+import dataclasses
+
+import merge_fun
+import merge_fuzz
+import merge_incremental
+from merge_batch import merge_many
+from merge_bench import compare_reports
+from merge_compile import compile_spec
+from merge_diskcache import merge_func_disk_cached
+from merge_fun import segment_table, extract_merged_tb, merge_func, verify_code, compute_stacksize, \
+    parse_exception_table, resolve_lasti, MergeVerifyError, merge_func_cached, invalidate_merge_cache
+from merge_fuzz import run, TRIALS
+from merge_group import MergedCallbackGroup, merge_func_async
+from merge_incremental import MergeBuilder
+from merge_super import flatten_super, flatten_hierarchy, restore_super
+
+
+def cb_a(self, dt):
+    return dt
+
+
+def cb_b(self, dt):
+    return dt + 1
+
+
+def cb_c(self, dt):
+    return dt + 2
+
+
+class Entity(object):
+    def __init__(self):
+        self.log = []
+
+
+def make_callback(k):
+    def cb(self, dt, scale=1):
+        return dt * scale + k
+    return cb
+
+
+class MergeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        invalidate_merge_cache()
+
+    def tearDown(self):
+        invalidate_merge_cache()
+
+    def test_hit(self):
+        merged = merge_func_cached("cached", [cb_a, cb_b])
+        self.assertIs(merge_func_cached("cached", [cb_a, cb_b]), merged)
+        self.assertIsNot(merge_func_cached("cached", [cb_a, cb_b], returns="list"), merged)
+
+    def test_lru_eviction(self):
+        maxsize = merge_fun.MERGE_CACHE_MAXSIZE
+        merge_fun.MERGE_CACHE_MAXSIZE = 2
+        try:
+            first = merge_func_cached("cached", [cb_a])
+            second = merge_func_cached("cached", [cb_b])
+            self.assertIs(merge_func_cached("cached", [cb_a]), first)  # cb_a is the newest now
+            merge_func_cached("cached", [cb_c])
+            self.assertIs(merge_func_cached("cached", [cb_a]), first)
+            self.assertIsNot(merge_func_cached("cached", [cb_b]), second)
+        finally:
+            merge_fun.MERGE_CACHE_MAXSIZE = maxsize
+
+    def test_hot_reload(self):
+        cb, other = make_callback(1), make_callback(10)
+        merged = merge_func_cached("cached", [cb, other])
+        self.assertEqual(merged(None, 2), 12)
+
+        def reload(k):
+            def cb(self, dt, scale=1):
+                return dt * scale * 100 + k
+            return cb
+        cb.__code__ = reload(0).__code__
+        reloaded = merge_func_cached("cached", [cb, other])
+        self.assertIsNot(reloaded, merged)
+        self.assertEqual(reloaded(None, 2), 12)
+        self.assertEqual(merge_func_cached("cached", [other, cb])(None, 2), 201)
+
+    def test_invalidate(self):
+        merged = merge_func_cached("cached", [cb_a, cb_b])
+        other = merge_func_cached("cached", [cb_c])
+        invalidate_merge_cache(cb_a)
+        self.assertIsNot(merge_func_cached("cached", [cb_a, cb_b]), merged)
+        self.assertIs(merge_func_cached("cached", [cb_c]), other)
+        invalidate_merge_cache()
+        self.assertIsNot(merge_func_cached("cached", [cb_c]), other)
+
+    def test_reassigned_defaults(self):
+        cb, other = make_callback(0), make_callback(0)
+        for scale in range(2, 50):
+            merge_func_cached("cached", [cb, other])
+            cb.__defaults__ = other.__defaults__ = None
+            cb.__defaults__ = other.__defaults__ = (scale,)
+            self.assertEqual(merge_func_cached("cached", [cb, other])(None, 1), scale)
+
+    def test_reassigned_kwdefaults(self):
+        def cb(self, dt, *, scale=1):
+            return dt * scale
+        # scale is dropped by the signature, a local initialized to its default.
+        merged = merge_func_cached("cached", [cb, cb], signature="self, dt")
+        self.assertEqual(merged(None, 3), 3)
+        cb.__kwdefaults__ = {"scale": 2}
+        self.assertEqual(merge_func_cached("cached", [cb, cb], signature="self, dt")(None, 3), 6)
+
+
+class GroupProfileTest(unittest.TestCase):
+
+    def calls(self, stats):
+        return {f.__name__: calls for f, (calls, _) in stats.items()}
+
+    def test_group_counts_once(self):
+        group = MergedCallbackGroup("profiled", (cb_a, cb_b), background=False, profile="counters")
+        group(None, 1)
+        group(None, 1)
+        group.add(cb_c)
+        group(None, 1)
+        group.remove(cb_c)
+        group(None, 1)
+        self.assertEqual(self.calls(group.profile_stats()), {"cb_a": 4, "cb_b": 4, "cb_c": 1})
+
+    def test_groups_do_not_share_counters(self):
+        first = MergedCallbackGroup("profiled", (cb_a, cb_b), background=False, profile="counters")
+        first(None, 1)
+        first(None, 1)
+        second = MergedCallbackGroup("profiled", (cb_a, cb_b), background=False, profile="counters")
+        second(None, 1)
+        self.assertEqual(self.calls(second.profile_stats()), {"cb_a": 1, "cb_b": 1})
+
+    def test_handle_profile_stats(self):
+        handle = merge_func_async("profiled", (cb_a, cb_b), profile="counters")
+        handle.result(5)
+        handle(None, 1)
+        handle(None, 1)
+        self.assertEqual(self.calls(handle.profile_stats()), {"cb_a": 2, "cb_b": 2})
+        handle.reset_profile_stats()
+        self.assertEqual(self.calls(handle.profile_stats()), {"cb_a": 0, "cb_b": 0})
+
+
+class GroupTest(unittest.TestCase):
+
+    def test_call_does_not_wait_for_merge(self):
+        release = threading.Event()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(release.wait)  # the merge stays queued behind this
+            group = MergedCallbackGroup("on_tick", (cb_a, cb_b), returns="list", executor=executor)
+            self.assertEqual(group(None, 1), [1, 2])
+            group.add(cb_c)
+            self.assertEqual(group(None, 1), [1, 2, 3])
+            self.assertFalse(group.handle.done())
+            release.set()
+            group.handle.result(5)
+            self.assertEqual(group(None, 1), [1, 2, 3])
+        self.assertEqual(group.merged_funcs, (cb_a, cb_b, cb_c))
+        self.assertFalse(group.dirty)
+
+    def test_blocking_mode(self):
+        group = MergedCallbackGroup("on_tick", (cb_a, cb_b), returns="list", background=False)
+        self.assertEqual(group(None, 1), [1, 2])
+        self.assertEqual(group.merged_funcs, (cb_a, cb_b))
+
+
+class FlattenSuperTest(unittest.TestCase):
+
+    def make_chain(self):
+        class A(object):
+            def update(self, dt):
+                return [dt * i for i in range(2)]  # dt is a cell
+
+        class B(A):
+            def update(self, dt):
+                return super().update(dt)
+
+        class C(B):
+            def update(self, dt):
+                return super().update(dt)
+        return A, B, C
+
+    def test_hierarchy_with_cell_in_base(self):
+        A, B, C = self.make_chain()
+        originals = (C.__dict__["update"], B.__dict__["update"], A.__dict__["update"])
+        expected = C().update(3)
+        done = flatten_hierarchy(A, "update", verify=True)
+        self.assertEqual(done, [B, C])
+        self.assertEqual(C().update(3), expected)
+        self.assertEqual(B().update(3), expected)
+        # C splices the original functions, not the flattened B.update
+        self.assertEqual(C.__dict__["update"].__super_chain__, originals)
+
+    def test_restore_after_reflatten(self):
+        A, B, C = self.make_chain()
+        original = B.__dict__["update"]
+        flatten_hierarchy(A, "update")
+        flatten_hierarchy(A, "update")
+        self.assertTrue(restore_super(B, "update"))
+        self.assertIs(B.__dict__["update"], original)
+
+    def test_cell_in_loop_is_not_shared(self):
+        class P(object):
+            def run(self, x):
+                self.fs.append(lambda: x)
+
+        class Q(P):
+            def run(self, n):
+                self.fs = []
+                i = 0
+                while i < n:
+                    super().run(i)
+                    i += 1
+                return [f() for f in self.fs]
+
+        flat = flatten_super(Q, "run", verify=True)
+        # the parent needs a new cell for every call, it is not spliced into the loop.
+        self.assertIsNone(flat)
+        self.assertEqual(Q().run(3), [0, 1, 2])
+
+
+class DiskCacheTest(unittest.TestCase):
+
+    def test_same_code_from_different_files(self):
+        source = "def update(self, dt):\n    self.a = dt\n"
+        funcs = []
+        for filename in ("/src/player.py", "/src/npc.py"):
+            namespace = {}
+            exec(compile(source, filename, "exec"), namespace)
+            funcs.append(namespace["update"])
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for func in funcs:
+                merged = merge_func_disk_cached(cache_dir, "merged", [func, func])
+                self.assertEqual(merged.__code__.co_filename, func.__code__.co_filename)
+                self.assertEqual(segment_table(merged.__code__)[1][0][1], func.__code__.co_filename)
+
+
+class WideMergeTest(unittest.TestCase):
+
+    def build(self, n, nlocals):
+        """n 个函数，每个有 nlocals 个自己的局部变量和一个 cell 变量"""
+        lines = []
+        for i in range(n):
+            names = [f"v{i}_{j}" for j in range(nlocals)]
+            lines.append(f"def cb_{i}(self, dt):")
+            lines += [f"    {name} = dt + {j}" for j, name in enumerate(names)]
+            lines.append(f"    c{i} = {i}")
+            lines.append(f"    self.log.append((lambda: c{i} + {names[-1]})())")
+            lines.append(f"    return {' + '.join(names)}")
+        namespace = {}
+        exec(compile("\n".join(lines) + "\n", "<wide>", "exec"), namespace)
+        return [namespace[f"cb_{i}"] for i in range(n)]
+
+    def test_more_than_256_slots(self):
+        funcs = self.build(12, 24)
+        for options in ({}, {"optimize": True, "pooled": True}, {"isolate": True, "guards": True}):
+            merged = merge_func("wide", funcs, returns="list", **options)
+            verify_code(merged.__code__)
+            code = merged.__code__
+            self.assertGreater(len(code.co_varnames) + len(code.co_cellvars), 256)
+            self.assertIn(dis.EXTENDED_ARG, code.co_code[::2])
+            expected, actual = Entity(), Entity()
+            self.assertEqual(merged(actual, 3), [f(expected, 3) for f in funcs])
+            self.assertEqual(actual.log, expected.log)
+
+    def test_builder_more_than_256_slots(self):
+        funcs = self.build(12, 24)
+        builder = MergeBuilder("wide")
+        for func in funcs:
+            builder.append(func)
+        builder.remove(funcs[3])
+        merged = builder.build()
+        verify_code(merged.__code__)
+        self.assertGreater(len(merged.__code__.co_varnames), 256)
+        expected, actual = Entity(), Entity()
+        for func in funcs[:3] + funcs[4:]:
+            result = func(expected, 3)
+        self.assertEqual(merged(actual, 3), result)
+        self.assertEqual(actual.log, expected.log)
+
+
+class StacksizeTest(unittest.TestCase):
+
+    def codes(self, code):
+        yield code
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                yield from self.codes(const)
+
+    def test_same_as_compiler(self):
+        for module in (argparse, collections, dataclasses, inspect, json.decoder, merge_fun, merge_fuzz):
+            with open(module.__file__, encoding="utf-8") as f:
+                source = f.read()
+            for code in self.codes(compile(source, module.__file__, "exec")):
+                self.assertEqual(
+                    compute_stacksize(code.co_code, parse_exception_table(code)), code.co_stacksize, code.co_qualname,
+                )
+
+    def test_unequal_join(self):
+        op = opcode.opmap
+        # the jump reaches RETURN_VALUE with 0 values, falling through with 1.
+        co_code = bytes([
+            op["RESUME"], 0, op["LOAD_CONST"], 0, op["POP_JUMP_FORWARD_IF_TRUE"], 1, op["LOAD_CONST"], 0,
+            op["RETURN_VALUE"], 0,
+        ])
+        with self.assertRaises(MergeVerifyError):
+            compute_stacksize(co_code, [])
+
+
+class BatchTest(unittest.TestCase):
+
+    def test_process_pool(self):
+        groups = [
+            ("g0", [cb_a, cb_b]),
+            ("g1", [cb_b, cb_c, cb_a], {"returns": "list"}),
+            ("g2", [cb_c], {"optimize": True}),
+            ("g3", [cb_a, cb_c], {"guards": True, "returns": "tuple"}),
+            ("g4", [cb_b, cb_b, cb_b], {"pooled": True}),
+        ]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            merged = merge_many(groups, executor=executor, isolate=True)
+        self.assertEqual([func.__name__ for func in merged], ["g0", "g1", "g2", "g3", "g4"])
+        for group, func in zip(groups, merged):
+            options = dict(group[2]) if len(group) == 3 else {}
+            expected = merge_func(group[0], group[1], isolate=True, **options)
+            self.assertEqual(func.__code__.co_code, expected.__code__.co_code)
+            self.assertEqual(func.__code__.co_consts, expected.__code__.co_consts)
+            self.assertEqual(func(None, 5), expected(None, 5))
+
+
+class BenchCompareTest(unittest.TestCase):
+
+    def report(self, runtime, merge):
+        return {
+            "runtime": [
+                {"body": body, "n": n, "merged_ns": ns, "merged_spread": spread}
+                for (body, n), (ns, spread) in runtime.items()
+            ],
+            "merge": [
+                {"statements": size, "segments": n, "merge_ms": ms, "merge_spread": spread}
+                for (size, n), (ms, spread) in merge.items()
+            ],
+        }
+
+    def test_compare(self):
+        old = self.report(
+            {("attrs", 10): (100.0, 0.0), ("attrs", 100): (1000.0, 0.0), ("trivial", 1): (50.0, 0.0)},
+            {(10, 1): (2.0, 0.0), (100, 1): (0.0, 0.0)},
+        )
+        new = self.report(
+            {("attrs", 10): (120.0, 0.0), ("attrs", 100): (800.0, 0.0), ("closure", 1): (70.0, 0.0)},
+            {(10, 1): (2.1, 0.0), (100, 1): (3.0, 0.0)},
+        )
+        rows = {(part, key): (ratio, regressed) for part, key, _, _, ratio, regressed in compare_reports(old, new)}
+        # missing on one side, or nothing to compare with, are skipped.
+        self.assertEqual(sorted(rows), [("merge", (10, 1)), ("runtime", ("attrs", 10)), ("runtime", ("attrs", 100))])
+        self.assertTrue(rows["runtime", ("attrs", 10)][1])  # regression
+        self.assertEqual(rows["runtime", ("attrs", 100)], (0.8, False))  # improvement
+        self.assertFalse(rows["merge", (10, 1)][1])  # within the threshold
+        self.assertFalse(compare_reports(old, new, threshold=0.25)[0][5])
+
+    def test_noise_floor(self):
+        old = self.report({("attrs", 10): (100.0, 0.05)}, {})
+        new = self.report({("attrs", 10): (120.0, 0.15)}, {})
+        self.assertFalse(compare_reports(old, new)[0][5])
+        new = self.report({("attrs", 10): (130.0, 0.15)}, {})
+        self.assertTrue(compare_reports(old, new)[0][5])
+        # reports written before the spread was recorded.
+        del old["runtime"][0]["merged_spread"]
+        self.assertTrue(compare_reports(old, self.report({("attrs", 10): (120.0, 0.0)}, {}))[0][5])
+
+
+class TracebackTest(unittest.TestCase):
+
+    def test_error_in_third_segment(self):
+        source = (
+            "def first(self, dt):\n"
+            "    return dt\n"
+            "\n"
+            "def second(self, dt):\n"
+            "    return dt + 1\n"
+            "\n"
+            "def third(self, dt):\n"
+            "    x = dt + 2\n"
+            "    return x // 0\n"
+        )
+        namespace = {}
+        exec(compile(source, "/src/tick.py", "exec"), namespace)
+        funcs = [namespace["first"], namespace["second"], namespace["third"]]
+        for optimize in (False, True):
+            merged = merge_func("merged", funcs, optimize=optimize)
+            try:
+                merged(None, 1)
+            except ZeroDivisionError as e:
+                frame = extract_merged_tb(e.__traceback__)[-1]
+            self.assertEqual((frame.name, frame.filename, frame.lineno), ("third", "/src/tick.py", 9))
+
+
+class PrecompileTest(unittest.TestCase):
+
+    def build(self, tmp, body):
+        with open(os.path.join(tmp, "aot_src.py"), "w") as f:
+            f.write("def tick(self, dt):\n    return %s\n\ndef tock(self, dt):\n    return dt\n" % body)
+        sys.modules.pop("aot_src", None)
+        importlib.invalidate_caches()
+
+    def load(self, tmp):
+        sys.modules.pop("aot_merged", None)
+        importlib.invalidate_caches()
+        return importlib.import_module("aot_merged")
+
+    def test_changed_constant_is_stale(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sys.path.insert(0, tmp)
+            try:
+                spec = os.path.join(tmp, "spec.json")
+                with open(spec, "w") as f:
+                    json.dump({"groups": [{"name": "on_tick", "funcs": ["aot_src:tick", "aot_src:tock"],
+                                           "options": {"returns": "list"}}]}, f)
+                self.build(tmp, "1")
+                compile_spec(spec, os.path.join(tmp, "aot_merged.pyc"))
+                self.assertEqual(self.load(tmp).on_tick(None, 5), [1, 5])
+                # same co_code, only the constant differs.
+                self.build(tmp, "2")
+                with self.assertRaises(ImportError):
+                    self.load(tmp)
+            finally:
+                sys.path.remove(tmp)
+                for name in ("aot_src", "aot_merged"):
+                    sys.modules.pop(name, None)
+
+
+class BuilderTest(unittest.TestCase):
+
+    def test_optimize_once_per_segment(self):
+        calls = []
+        optimize_instrs = merge_incremental.optimize_instrs
+
+        def counted(instrs):
+            calls.append(len(instrs))
+            return optimize_instrs(instrs)
+        merge_incremental.optimize_instrs = counted
+        try:
+            builder = MergeBuilder("optimized", optimize=True)
+            builder.append(cb_a)
+            builder.append(cb_b)
+            merged = builder.build()
+        finally:
+            merge_incremental.optimize_instrs = optimize_instrs
+        # cb_a chained, cb_b chained when appended, cb_b as the last one in build.
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(merged(None, 1), 2)
+
+    def lines(self, func):
+        """每条指令所在的 (函数序号, 原函数的行号)，去掉连续的重复"""
+        res = []
+        for lasti in range(0, len(func.__code__.co_code), 2):
+            idx, _, _, lineno = resolve_lasti(func.__code__, lasti)
+            if idx is not None and lineno is not None and (not res or res[-1] != (idx, lineno)):
+                res.append((idx, lineno))
+        return res
+
+    def test_line_numbers(self):
+        for seed in range(20):
+            rnd = random.Random(seed)
+            funcs = merge_fuzz.build_funcs(merge_fuzz.Generator(rnd).module(4))
+            builder = MergeBuilder("lines")
+            for func in funcs + [funcs[0]]:
+                builder.append(func)
+            builder.remove(funcs[1])
+            expected = merge_func("lines", funcs[:1] + funcs[2:] + [funcs[0]])
+            self.assertEqual(self.lines(builder.build()), self.lines(expected), seed)
+
+
+class FuzzTest(unittest.TestCase):
+
+    def test_each_kind(self):
+        for kind in sorted(TRIALS):
+            with self.subTest(kind=kind):
+                self.assertEqual(run(60, "test", kind=kind), [])
+
+
+if __name__ == "__main__":
+    unittest.main()